@@ -0,0 +1,164 @@
+"""
+Benchmark the interpolation of thermal spectra from single and double
+precision tables, and check the accuracy of the single precision spectra
+and of the photon energies drawn from them.
+
+Synthetic tables with the given numbers of nodes, bins and variable
+elements are used by default, or the AtomDB APEC tables with --apec.
+Spectra are interpolated for blocks of cells as process_data does, and
+their CDFs are accumulated in double precision for either table type.
+
+    python benchmarks/bench_spectral_precision.py [--nbins 10000] [--apec]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from pyxsim.lib.spectra import invert_cdf
+from pyxsim.spectral_models import SpectralInterpolator1D, TableCIEModel
+
+
+def make_interpolators(args):
+    if args.apec:
+        var_elem = ["O", "Ne", "Mg", "Si", "S", "Fe"][: args.nvar]
+        si = {}
+        for dtype in ["float64", "float32"]:
+            amod = TableCIEModel(
+                "apec",
+                0.1,
+                10.0,
+                args.nbins,
+                0.1,
+                20.0,
+                var_elem=var_elem or None,
+                dtype=dtype,
+            )
+            amod.prepare_spectrum(0.05)
+            si[dtype] = amod.si
+        return si, amod.ebins
+    prng = np.random.default_rng(21)
+    ebins = np.linspace(0.1, 10.0, args.nbins + 1)
+    emid = 0.5 * (ebins[1:] + ebins[:-1])
+    tbins = np.linspace(0.1, 20.0, args.nT)
+    kT = tbins[:, np.newaxis]
+    cosmic = 1.0e-14 * np.exp(-emid / kT) / np.sqrt(kT)
+    lines = np.zeros((args.nT, args.nbins))
+    for e0 in prng.uniform(0.1, 10.0, 200):
+        width = 0.005 * np.sqrt(kT)
+        lines += np.exp(-0.5 * ((emid - e0) / width) ** 2) * prng.random((args.nT, 1))
+    metal = 1.0e-15 * lines
+    var = None
+    if args.nvar > 0:
+        var = metal * prng.uniform(0.1, 2.0, size=(args.nvar, 1, 1))
+    si = {}
+    for dtype in ["float64", "float32"]:
+        si[dtype] = SpectralInterpolator1D(
+            tbins,
+            cosmic.astype(dtype),
+            metal.astype(dtype),
+            None if var is None else var.astype(dtype),
+        )
+    return si, ebins
+
+
+def timeit(func, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def make_buffers(si, block_size):
+    # The spectra are written into the same arrays for every block, as
+    # they are by the thermal source models
+    shape = (block_size, si.cosmic_spec.shape[-1])
+    dtype = si.cosmic_spec.dtype
+    vspec = None
+    if si.do_var:
+        vspec = np.empty((si.var_spec.shape[0],) + shape, dtype=dtype)
+    return np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype), vspec
+
+
+def block_spectra(si, kT, block_size):
+    buffers = make_buffers(si, block_size)
+    for start in range(0, kT.size, block_size):
+        si(kT[start : start + block_size], out=buffers)
+
+
+def block_cdfs(si, kT, Z, block_size):
+    buffers = make_buffers(si, block_size)
+    cdfs = []
+    for start in range(0, kT.size, block_size):
+        cspec, mspec, vspec = si(kT[start : start + block_size], out=buffers)
+        spec = cspec
+        spec += Z[start : start + block_size, np.newaxis] * mspec
+        if vspec is not None:
+            spec += 0.5 * vspec.sum(axis=0)
+        cp = np.zeros((spec.shape[0], spec.shape[1] + 1))
+        np.cumsum(spec, axis=-1, dtype="float64", out=cp[:, 1:])
+        cp /= cp[:, -1:]
+        cdfs.append(cp)
+    return cdfs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--nbins", type=int, default=10000)
+    parser.add_argument("--nT", type=int, default=100)
+    parser.add_argument(
+        "--nvar", type=int, default=4, help="The number of variable elements."
+    )
+    parser.add_argument(
+        "--n_cells", type=int, default=20000, help="The number of cells."
+    )
+    parser.add_argument("--block_size", type=int, default=100)
+    parser.add_argument(
+        "--apec", action="store_true", help="Use the AtomDB APEC tables."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Take the best of this many runs."
+    )
+    args = parser.parse_args()
+
+    si, ebins = make_interpolators(args)
+    prng = np.random.default_rng(22)
+    kT = prng.uniform(si["float64"].tbins[0], si["float64"].tbins[-1], args.n_cells)
+    Z = prng.uniform(0.1, 1.0, args.n_cells)
+
+    tables = [si["float64"].cosmic_spec, si["float64"].metal_spec]
+    if si["float64"].do_var:
+        tables.append(si["float64"].var_spec)
+    print(f"{args.n_cells} cells, {args.nbins} bins, {args.nvar} variable elements")
+    print(f"double precision tables: {sum(t.nbytes for t in tables) / 1.0e6:.1f} MB\n")
+
+    cdfs = {}
+    print(f"{'dtype':<8s} {'interp (s)':>10s} {'cdfs (s)':>9s} {'cells/s':>10s}")
+    for dtype, interp in si.items():
+        t_interp = timeit(
+            block_spectra, interp, kT, args.block_size, repeat=args.repeat
+        )
+        t_cdfs = timeit(block_cdfs, interp, kT, Z, args.block_size, repeat=args.repeat)
+        cdfs[dtype] = np.concatenate(block_cdfs(interp, kT, Z, args.block_size))
+        print(
+            f"{dtype:<8s} {t_interp:10.3f} {t_cdfs:9.3f} "
+            f"{args.n_cells / t_cdfs:10.0f}"
+        )
+
+    # The accuracy of the CDFs, and of energies drawn from them with the
+    # same random numbers
+    n_ph = np.full(args.n_cells, 50, dtype="int64")
+    randvec = prng.uniform(size=n_ph.sum())
+    e64 = invert_cdf(cdfs["float64"], ebins, n_ph, randvec)
+    e32 = invert_cdf(cdfs["float32"], ebins, n_ph, randvec)
+    de = np.abs(e32 - e64)
+    print(f"\nmax CDF error: {np.abs(cdfs['float32'] - cdfs['float64']).max():.3g}")
+    print(f"max energy error: {de.max():.3g} keV")
+    print(f"mean energy error: {de.mean():.3g} keV")
+    print(f"bin width: {np.diff(ebins).min():.3g} keV")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Benchmark the write throughput and file size of photon lists written
+with different HDF5 storage policies.
+
+A photon list is generated once from a random power-law source, or read
+from the file given with --photons, and its data are then written again
+through a DatasetAppender with each storage policy, in buffers of the
+size which make_photons writes per chunk.
+
+    python benchmarks/bench_storage_policy.py [--photons my_photons.h5]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+
+from pyxsim.writers import DatasetAppender, StoragePolicy
+
+
+def make_test_photons(filename, n_cells):
+    from yt.testing import fake_random_ds
+
+    from pyxsim import PowerLawSourceModel, make_photons
+
+    fields = ("density", "velocity_x", "velocity_y", "velocity_z")
+    units = ("g/cm**3", "km/s", "km/s", "km/s")
+    ds = fake_random_ds(n_cells, fields=fields, units=units, length_unit="Mpc")
+
+    def _emission(field, data):
+        return data.ds.quan(1.0e47, "cm**3/g/s/keV") * data["gas", "density"]
+
+    ds.add_field(
+        ("gas", "emission"),
+        function=_emission,
+        units="keV**-1*s**-1",
+        sampling_type="local",
+    )
+    source_model = PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+    make_photons(filename, ds.all_data(), 0.05, 1000.0, 1.0e5, source_model)
+
+
+def read_photons(filename):
+    with h5py.File(filename, "r") as f:
+        d = f["data"]
+        cells = {key: d[key][()] for key in d if key != "energy"}
+        energy = d["energy"][()]
+    return cells, energy
+
+
+def write_photons(filename, cells, energy, policy, buffer_cells):
+    t0 = time.perf_counter()
+    with h5py.File(filename, "w") as f:
+        d = f.create_group("data")
+        dtypes = {key: cells[key].dtype for key in cells}
+        cell_app = DatasetAppender(d, list(cells), dtypes=dtypes, policy=policy)
+        photon_app = DatasetAppender(
+            d, ["energy"], dtypes={"energy": energy.dtype}, policy=policy
+        )
+        n_cells = cells["num_photons"].size
+        start_e = 0
+        for start_c in range(0, n_cells, buffer_cells):
+            sl = slice(start_c, start_c + buffer_cells)
+            end_e = start_e + cells["num_photons"][sl].sum()
+            cell_app.append({key: cells[key][sl] for key in cells})
+            photon_app.append({"energy": energy[start_e:end_e]})
+            start_e = end_e
+            f.flush()
+        cell_app.finalize()
+        photon_app.finalize()
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--photons", help="An existing photon list to rewrite.")
+    parser.add_argument(
+        "--n_cells",
+        type=int,
+        default=64,
+        help="The number of cells on a side of the test dataset.",
+    )
+    parser.add_argument(
+        "--buffer_cells",
+        type=int,
+        default=100000,
+        help="The number of cells written in each buffer.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Take the best of this many writes."
+    )
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    photon_file = args.photons
+    if photon_file is None:
+        photon_file = os.path.join(tmpdir, "photons.h5")
+        make_test_photons(photon_file, args.n_cells)
+    cells, energy = read_photons(photon_file)
+    n_bytes = energy.nbytes + sum(v.nbytes for v in cells.values())
+
+    policies = {
+        "h5py auto-chunks": None,
+        "64k chunks": StoragePolicy(chunk_size=65536),
+        "1M chunks": StoragePolicy(chunk_size=1048576),
+        "lzf": StoragePolicy(compression="lzf", shuffle=False),
+        "lzf + shuffle": StoragePolicy(compression="lzf"),
+        "gzip 1 + shuffle": StoragePolicy(compression="gzip", compression_level=1),
+        "gzip 4 + shuffle": StoragePolicy(compression="gzip", compression_level=4),
+        "gzip 9 + shuffle": StoragePolicy(compression="gzip", compression_level=9),
+    }
+    try:
+        import hdf5plugin  # noqa: F401
+
+        for cname in ["lz4", "zstd"]:
+            policies[f"blosc {cname}"] = StoragePolicy(
+                compression="blosc", blosc_compressor=cname
+            )
+    except ImportError:
+        print("hdf5plugin is not installed, so Blosc is not benchmarked.")
+
+    print(f"{energy.size} photons from {cells['num_photons'].size} cells")
+    print(f"{n_bytes / 1.0e6:.1f} MB of uncompressed data\n")
+    print(f"{'policy':<20s} {'write (MB/s)':>12s} {'size (MB)':>10s} {'ratio':>7s}")
+    for name, policy in policies.items():
+        filename = os.path.join(tmpdir, "bench.h5")
+        dt = min(
+            write_photons(filename, cells, energy, policy, args.buffer_cells)
+            for _ in range(args.repeat)
+        )
+        size = os.path.getsize(filename)
+        print(
+            f"{name:<20s} {n_bytes / dt / 1.0e6:12.1f} {size / 1.0e6:10.2f} "
+            f"{n_bytes / size:7.2f}"
+        )
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ except PackageNotFoundError:
 from pyxsim.event_list import EventList
 from pyxsim.photon_list import (
     PhotonList,
+    make_events,
     make_photons,
     project_photons,
     project_photons_allsky,
@@ -21,9 +22,11 @@ from pyxsim.source_models import (
     NEISourceModel,
     PowerLawSourceModel,
 )
+from pyxsim.table_cache import set_table_cache
 from pyxsim.utils import (
     compute_elem_mass_fraction,
     compute_zsolar,
     create_metal_fields,
     merge_files,
 )
+from pyxsim.writers import StoragePolicy
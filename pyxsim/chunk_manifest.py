@@ -0,0 +1,286 @@
+"""
+Manifests of the I/O chunks of a data source
+"""
+import hashlib
+import inspect
+import os
+from numbers import Number
+
+import h5py
+import numpy as np
+from unyt import unyt_array
+from yt.utilities.exceptions import YTFieldNotFound
+from yt.utilities.parallel_tools.parallel_analysis_interface import (
+    communication_system,
+    parallel_objects,
+)
+
+from pyxsim.utils import mylog
+
+comm = communication_system.communicators[-1]
+
+# Manifests of datasets which do not live on disk (e.g. stream datasets)
+# cannot be persisted, so they are only kept for the current session
+_manifest_cache = {}
+
+
+def _field_key(field):
+    if isinstance(field, tuple):
+        return ",".join(field)
+    return field
+
+
+def _dataset_stats(ds):
+    fn = ds.parameter_filename
+    if not isinstance(fn, str) or not os.path.isfile(fn):
+        return None
+    st = os.stat(fn)
+    return np.array([st.st_mtime, st.st_size], dtype="float64")
+
+
+def manifest_filename(ds):
+    """
+    The name of the file which stores the chunk manifests of the
+    dataset *ds*, or None if the dataset does not live on disk.
+    """
+    if _dataset_stats(ds) is None:
+        return None
+    return os.path.join(ds.directory, f"{ds.basename}.pyxsim_manifest.h5")
+
+
+def _field_definition(ds, field):
+    # The units of a field and the code which derives it, so that the
+    # ranges of a field are not reused after it has been redefined
+    try:
+        finfo = ds._get_field_info(field)
+    except (KeyError, YTFieldNotFound):
+        return ""
+    func = finfo._function
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        code = getattr(func, "__code__", None)
+        source = "" if code is None else code.co_code.hex() + repr(code.co_consts)
+    # Simple values which the function closes over, such as constants
+    # set when it was defined, are part of its definition too
+    for cell in getattr(func, "__closure__", None) or ():
+        try:
+            value = cell.cell_contents
+        except ValueError:
+            continue
+        if isinstance(value, (Number, str, tuple)):
+            source += repr(value)
+    return f"{finfo.units}:{source}"
+
+
+def manifest_key(data_source, fields):
+    """
+    A key which uniquely identifies the chunks of *data_source* and the
+    *fields* that the manifest stores the ranges of, including their
+    units and definitions.
+    """
+    ds = data_source.ds
+    src_hash = getattr(data_source, "_hash", None)
+    if not isinstance(src_hash, str):
+        src_hash = str(data_source)
+    field_keys = [
+        f"{_field_key(field)}:{_field_definition(ds, field)}" for field in fields
+    ]
+    s = f"{ds._hash()};{src_hash};{';'.join(field_keys)}"
+    return hashlib.md5(s.encode("utf-8")).hexdigest()
+
+
+class ChunkManifest:
+    """
+    A record of the I/O chunks of a yt data source, in the order that
+    they are iterated over: the number of cells or particles in each
+    chunk, its bounding box, and the minimum and maximum values of a
+    set of fields within it.
+
+    Parameters
+    ----------
+    fields : list of (ftype, fname) tuples
+        The fields that the minima and maxima are stored for.
+    units : list of strings
+        The units of the minima and maxima of each field.
+    num_cells : array_like
+        The number of cells or particles in each chunk.
+    left_edge : array_like
+        The left edges of the bounding boxes of the chunks, in kpc.
+    right_edge : array_like
+        The right edges of the bounding boxes of the chunks, in kpc.
+    field_min : array_like
+        The minimum values of the fields in each chunk, of shape
+        (num_chunks, num_fields).
+    field_max : array_like
+        The maximum values of the fields in each chunk, of shape
+        (num_chunks, num_fields).
+    """
+
+    def __init__(
+        self, fields, units, num_cells, left_edge, right_edge, field_min, field_max
+    ):
+        self.fields = [_field_key(field) for field in fields]
+        self.units = list(units)
+        self.num_cells = np.asarray(num_cells, dtype="int64")
+        self.left_edge = np.asarray(left_edge, dtype="float64").reshape(-1, 3)
+        self.right_edge = np.asarray(right_edge, dtype="float64").reshape(-1, 3)
+        nf = len(self.fields)
+        self.field_min = np.asarray(field_min, dtype="float64").reshape(-1, nf)
+        self.field_max = np.asarray(field_max, dtype="float64").reshape(-1, nf)
+
+    @property
+    def num_chunks(self):
+        return self.num_cells.size
+
+    @property
+    def tot_num_cells(self):
+        return int(self.num_cells.sum())
+
+    def field_range(self, ichunk, field, units=None, equivalence=None):
+        """
+        Return the minimum and maximum of *field* in chunk *ichunk*,
+        optionally converted to *units*.
+        """
+        j = self.fields.index(_field_key(field))
+        vals = (self.field_min[ichunk, j], self.field_max[ichunk, j])
+        if units is None or not np.all(np.isfinite(vals)):
+            return vals
+        ret = unyt_array(vals, self.units[j]).to_value(units, equivalence)
+        return ret[0], ret[1]
+
+    @classmethod
+    def from_data_source(cls, data_source, fields):
+        """
+        Build a manifest by iterating over the I/O chunks of
+        *data_source* and reading *fields*. In parallel, the chunks
+        are split among the processors and the results are combined.
+        """
+        ds = data_source.ds
+        dle = ds.domain_left_edge.to_value("kpc")
+        dre = ds.domain_right_edge.to_value("kpc")
+        nf = len(fields)
+        storage = {}
+        citer = data_source.chunks([], "io")
+        for sto, chunk in parallel_objects(citer, storage=storage):
+            fmin = np.full(nf, np.inf)
+            fmax = np.full(nf, -np.inf)
+            units = []
+            num_cells = 0
+            for j, field in enumerate(fields):
+                fd = chunk[field]
+                units.append(str(fd.units))
+                if j == 0:
+                    num_cells = fd.size
+                if fd.size > 0:
+                    fmin[j] = fd.d.min()
+                    fmax[j] = fd.d.max()
+            le = dle.copy()
+            re = dre.copy()
+            objs = getattr(chunk._current_chunk, "objs", None) or []
+            if len(objs) > 0 and all(hasattr(obj, "LeftEdge") for obj in objs):
+                le = np.min([obj.LeftEdge.to_value("kpc") for obj in objs], axis=0)
+                re = np.max([obj.RightEdge.to_value("kpc") for obj in objs], axis=0)
+            sto.result = (num_cells, le, re, fmin, fmax, units)
+        num_chunks = max(storage.keys()) + 1 if storage else 0
+        num_cells = np.zeros(num_chunks, dtype="int64")
+        left_edge = np.zeros((num_chunks, 3))
+        right_edge = np.zeros((num_chunks, 3))
+        field_min = np.zeros((num_chunks, nf))
+        field_max = np.zeros((num_chunks, nf))
+        units = [""] * nf
+        for ichunk, (nc, le, re, fmin, fmax, u) in storage.items():
+            num_cells[ichunk] = nc
+            left_edge[ichunk] = le
+            right_edge[ichunk] = re
+            field_min[ichunk] = fmin
+            field_max[ichunk] = fmax
+            units = u
+        return cls(
+            fields, units, num_cells, left_edge, right_edge, field_min, field_max
+        )
+
+    def write(self, filename, key, stats):
+        """
+        Store the manifest in the group *key* of the HDF5 file
+        *filename*, along with the *stats* of the dataset file
+        it was built from.
+        """
+        with h5py.File(filename, "a") as f:
+            if key in f:
+                del f[key]
+            g = f.create_group(key)
+            g.attrs["fields"] = np.array(self.fields).astype("S")
+            g.attrs["units"] = np.array(self.units).astype("S")
+            g.attrs["stats"] = stats
+            g.create_dataset("num_cells", data=self.num_cells)
+            g.create_dataset("left_edge", data=self.left_edge)
+            g.create_dataset("right_edge", data=self.right_edge)
+            g.create_dataset("field_min", data=self.field_min)
+            g.create_dataset("field_max", data=self.field_max)
+
+    @classmethod
+    def read(cls, filename, key, stats):
+        """
+        Read the manifest in the group *key* of the HDF5 file
+        *filename*. Returns None if it does not exist or if it was
+        built from a dataset file with different *stats*.
+        """
+        if not os.path.exists(filename):
+            return None
+        with h5py.File(filename, "r") as f:
+            if key not in f:
+                return None
+            g = f[key]
+            if not np.array_equal(g.attrs["stats"], stats):
+                return None
+            fields = [s.decode("utf-8") for s in g.attrs["fields"]]
+            units = [s.decode("utf-8") for s in g.attrs["units"]]
+            return cls(
+                fields,
+                units,
+                g["num_cells"][()],
+                g["left_edge"][()],
+                g["right_edge"][()],
+                g["field_min"][()],
+                g["field_max"][()],
+            )
+
+
+def get_chunk_manifest(data_source, fields):
+    """
+    Get the manifest of the I/O chunks of *data_source* which stores the
+    ranges of *fields*. If a valid manifest has been stored next to the
+    dataset on disk, it is read from there. Otherwise, it is built and
+    stored for future use.
+    """
+    ds = data_source.ds
+    key = manifest_key(data_source, fields)
+    stats = _dataset_stats(ds)
+    cache_key = (ds._hash(), key)
+    if stats is None:
+        if cache_key in _manifest_cache:
+            return _manifest_cache[cache_key]
+        manifest = ChunkManifest.from_data_source(data_source, fields)
+        _manifest_cache[cache_key] = manifest
+        return manifest
+    filename = manifest_filename(ds)
+    try:
+        manifest = ChunkManifest.read(filename, key, stats)
+    except OSError:
+        manifest = None
+    if manifest is not None:
+        mylog.info("Using the chunk manifest stored in %s.", filename)
+        return manifest
+    manifest = ChunkManifest.from_data_source(data_source, fields)
+    if comm.rank == 0:
+        try:
+            manifest.write(filename, key, stats)
+        except OSError:
+            mylog.warning(
+                "Could not write the chunk manifest to %s, so it "
+                "will be rebuilt the next time it is needed.",
+                filename,
+            )
+    comm.barrier()
+    return manifest
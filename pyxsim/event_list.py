@@ -9,6 +9,7 @@ import numpy as np
 from astropy.io import fits
 
 from pyxsim.utils import mylog, parse_value
+from pyxsim.writers import StorageFormat
 
 
 class EventList:
@@ -55,6 +56,15 @@ class EventList:
         self.tot_num_events = np.sum(self.num_events)
         self.observer = self.parameters.get("observer", "external")
 
+    def _read_events(self, f):
+        # Decode the event positions and energies from the way they are
+        # stored in the open file *f*
+        storage = StorageFormat.from_parameters(f["parameters"])
+        return {
+            field: storage.read_field(f["data"], field)
+            for field in ["xsky", "ysky", "eobs"]
+        }
+
     def write_fits_file(self, fitsfile, fov, nx, overwrite=False):
         """
         Write events to a FITS binary table file. The result is an
@@ -99,8 +109,8 @@ class EventList:
         y = []
         for fn in self.filenames:
             with h5py.File(fn, "r") as f:
-                d = f["data"]
-                xx, yy = wcs.wcs_world2pix(d["xsky"][:], d["ysky"][:], 1)
+                d = self._read_events(f)
+                xx, yy = wcs.wcs_world2pix(d["xsky"], d["ysky"], 1)
                 keepx = np.logical_and(xx >= 0.5, xx <= float(nx) + 0.5)
                 keepy = np.logical_and(yy >= 0.5, yy <= float(nx) + 0.5)
                 keep = np.logical_and(keepx, keepy)
@@ -189,24 +199,22 @@ class EventList:
                 phlist_file = f"{prefix}_phlist.{i:04d}.fits"
                 name = f"{os.path.basename(prefix)}.{i:04d}"
             with h5py.File(fn, "r") as f:
-                d = f["data"]
+                d = self._read_events(f)
                 if d["eobs"].shape[0] > 0:
                     flux = (
-                        np.sum(d["eobs"][()] * u.keV).to_value("erg")
+                        np.sum(d["eobs"] * u.keV).to_value("erg")
                         / self.parameters["exp_time"]
                         / self.parameters["area"]
                     )
 
                     if self.observer == "internal":
-                        c = SkyCoord(
-                            d["xsky"][()], d["ysky"][()], unit="deg", frame="galactic"
-                        )
+                        c = SkyCoord(d["xsky"], d["ysky"], unit="deg", frame="galactic")
                         ra = c.icrs.ra.value
                         dec = c.icrs.dec.value
                     else:
-                        ra = d["xsky"][()]
-                        dec = d["ysky"][()]
-                    src = SimputPhotonList(ra, dec, d["eobs"][()], flux, name=name)
+                        ra = d["xsky"]
+                        dec = d["ysky"]
+                    src = SimputPhotonList(ra, dec, d["eobs"], flux, name=name)
 
                     if begin_cat:
                         cat = SimputCatalog.from_source(
@@ -266,8 +274,8 @@ class EventList:
 
         for fn in self.filenames:
             with h5py.File(fn, "r") as f:
-                d = f["data"]
-                mask = np.logical_and(d["eobs"][:] >= emin, d["eobs"][:] <= emax)
+                d = self._read_events(f)
+                mask = np.logical_and(d["eobs"] >= emin, d["eobs"] <= emax)
                 xx, yy = wcs.wcs_world2pix(d["xsky"][mask], d["ysky"][mask], 1)
                 H += np.histogram2d(xx, yy, bins=[xbins, ybins])[0]
 
@@ -313,8 +321,8 @@ class EventList:
 
         for fn in self.filenames:
             with h5py.File(fn, "r") as f:
-                d = f["data"]
-                spec += np.histogram(d["eobs"][:], bins=ebins)[0]
+                d = self._read_events(f)
+                spec += np.histogram(d["eobs"], bins=ebins)[0]
 
         col1 = fits.Column(
             name="CHANNEL", format="1J", array=np.arange(nchan).astype("int32") + 1
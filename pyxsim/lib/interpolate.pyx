@@ -2,55 +2,164 @@ import numpy as np
 
 cimport cython
 cimport numpy as np
+from cython.parallel cimport prange
+from libc.math cimport log, log10
+
+# The tables and the interpolated spectra may be single or double
+# precision. The weights are computed in double precision, and then
+# applied in the precision of the tables
+ctypedef fused spec_t:
+    float
+    double
+
+
+# How the nodes of a table are spaced, which decides how the node below a
+# value is found: uniformly or uniformly in log, in which case it is
+# computed, or otherwise, in which case it is found by bisection
+cdef enum:
+    GRID_OTHER = 0
+    GRID_LINEAR = 1
+    GRID_LOG = 2
+
+
+cdef inline int grid_index(double x, const double* x_bins, int nb, int kind,
+                           double x0, double inv_dx) noexcept nogil:
+    # Find the node i with x_bins[i] <= x < x_bins[i+1], clamped to the
+    # first and last intervals of the table, as np.digitize would
+    cdef double t
+    cdef int i, lo, hi, mid
+    if x != x:
+        return nb - 2
+    if kind == GRID_LINEAR or (kind == GRID_LOG and x > 0.0):
+        if kind == GRID_LINEAR:
+            t = (x - x0) * inv_dx
+        else:
+            t = (log(x) - x0) * inv_dx
+        if t <= 0.0:
+            i = 0
+        elif t >= nb - 2:
+            i = nb - 2
+        else:
+            i = <int>t
+        # Roundoff may put the computed node one off from the right one
+        while i > 0 and x < x_bins[i]:
+            i -= 1
+        while i < nb - 2 and x >= x_bins[i+1]:
+            i += 1
+        return i
+    if x < x_bins[1]:
+        return 0
+    if x >= x_bins[nb-2]:
+        return nb - 2
+    lo = 1
+    hi = nb - 2
+    while hi - lo > 1:
+        mid = (lo + hi) >> 1
+        if x_bins[mid] <= x:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def grid_indices(const double[:] x_vals,
+                 const double[::1] x_bins,
+                 int kind,
+                 double x0,
+                 double inv_dx,
+                 int num_threads=1):
+    """
+    Find the nodes of the table *x_bins* that each of *x_vals* lies above,
+    clamped to the first and last intervals of the table. If *kind* is 1,
+    the nodes are uniformly spaced, starting at *x0* with spacing 1/*inv_dx*,
+    and if it is 2, their logs are, so the nodes are computed rather than
+    searched for. The values are split between *num_threads* threads.
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t nv = x_vals.shape[0]
+    cdef int nb = x_bins.shape[0]
+    cdef int[::1] out
+
+    output = np.zeros(nv, dtype=np.int32)
+    out = output
+    with nogil:
+        for i in prange(nv, num_threads=num_threads, schedule="static"):
+            out[i] = grid_index(x_vals[i], &x_bins[0], nb, kind, x0, inv_dx)
+    return output
+
+
+cdef inline void interp_row(const spec_t* lo_row, const spec_t* hi_row,
+                            spec_t wm, spec_t wp, spec_t* out,
+                            int ne) noexcept nogil:
+    cdef int j
+    for j in range(ne):
+        out[j] = lo_row[j] * wm + hi_row[j] * wp
 
 
 @cython.cdivision(True)
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def interp1d_spec(np.ndarray[np.float64_t, ndim=2] ctable,
-                  np.ndarray[np.float64_t, ndim=2] mtable,
-                  np.ndarray[np.float64_t, ndim=3] vtable,
+def interp1d_spec(const spec_t[:, ::1] ctable,
+                  const spec_t[:, ::1] mtable,
+                  const spec_t[:, :, ::1] vtable,
                   np.ndarray[np.float64_t, ndim=1] x_vals,
                   np.ndarray[np.float64_t, ndim=1] x_bins,
                   np.ndarray[np.int32_t, ndim=1] x_is,
-                  bint do_var):
+                  bint do_var,
+                  coutput=None,
+                  moutput=None,
+                  voutput=None,
+                  int e_lo=0,
+                  int e_hi=-1,
+                  int num_threads=1):
+    # The outputs may be passed in to be reused, since every element
+    # of them is written to. Only the energy bins from e_lo up to e_hi
+    # are interpolated, and the outputs only have these bins. The cells
+    # are split between *num_threads* threads
     cdef double x, dx_inv
-    cdef int i, x_i, j, k, nelem
+    cdef int i, x_i, k, nelem
     cdef int nt = x_vals.shape[0]
-    cdef int ne = ctable.shape[1]
-    cdef np.ndarray[np.float64_t, ndim=1] xp, xm
-    cdef np.ndarray[np.float64_t, ndim=2] coutput, moutput
-    cdef np.ndarray[np.float64_t, ndim=3] voutput
+    cdef int ne
+    cdef spec_t wm, wp
+    cdef spec_t[:, ::1] cout, mout
+    cdef spec_t[:, :, ::1] vout
 
-    coutput = np.zeros((nt, ne))
-    moutput = np.zeros((nt, ne))
+    if e_hi < 0:
+        e_hi = ctable.shape[1]
+    ne = e_hi - e_lo
+
+    dtype = np.float32 if spec_t is float else np.float64
+    if coutput is None:
+        coutput = np.zeros((nt, ne), dtype=dtype)
+    if moutput is None:
+        moutput = np.zeros((nt, ne), dtype=dtype)
+    cout = coutput
+    mout = moutput
     if do_var:
         nelem = <int>vtable.shape[0]
-        voutput = np.zeros((nelem, nt, ne))
+        if voutput is None:
+            voutput = np.zeros((nelem, nt, ne), dtype=dtype)
+        vout = voutput
     else:
         nelem = 0
+        vout = np.zeros((1, 1, 1), dtype=dtype)
 
-    xp = np.zeros(nt)
-    xm = np.zeros(nt)
-
-    for i in range(nt):
-        x_i = x_is[i]
-        x = x_vals[i]
-        dx_inv = 1.0 / (x_bins[x_i+1] - x_bins[x_i])
-        xp[i] = (x - x_bins[x_i]) * dx_inv
-        xm[i] = (x_bins[x_i+1] - x) * dx_inv
-    for i in range(nt):
-        x_i = x_is[i]
-        for j in range(ne):
-            coutput[i, j] = ctable[x_i, j] * xm[i] + ctable[x_i+1, j] * xp[i]
-            moutput[i, j] = mtable[x_i, j] * xm[i] + mtable[x_i + 1, j] * xp[i]
-    if do_var:
-        for i in range(nt):
+    with nogil:
+        for i in prange(nt, num_threads=num_threads, schedule="static"):
             x_i = x_is[i]
+            x = x_vals[i]
+            dx_inv = 1.0 / (x_bins[x_i+1] - x_bins[x_i])
+            wp = <spec_t>((x - x_bins[x_i]) * dx_inv)
+            wm = <spec_t>((x_bins[x_i+1] - x) * dx_inv)
+            interp_row(&ctable[x_i, e_lo], &ctable[x_i+1, e_lo], wm, wp,
+                       &cout[i, 0], ne)
+            interp_row(&mtable[x_i, e_lo], &mtable[x_i+1, e_lo], wm, wp,
+                       &mout[i, 0], ne)
             for k in range(nelem):
-                for j in range(ne):
-                    voutput[k, i, j] = vtable[k, x_i, j] * xm[i] + \
-                                       vtable[k, x_i + 1, j] * xp[i]
+                interp_row(&vtable[k, x_i, e_lo], &vtable[k, x_i+1, e_lo],
+                           wm, wp, &vout[k, i, 0], ne)
 
     if do_var:
         return coutput, moutput, voutput
@@ -58,86 +167,421 @@ def interp1d_spec(np.ndarray[np.float64_t, ndim=2] ctable,
         return coutput, moutput, None
 
 
+cdef inline void add_row(const spec_t* lo_row, const spec_t* hi_row,
+                         spec_t wm, spec_t wp, spec_t* out,
+                         int ne) noexcept nogil:
+    cdef int j
+    for j in range(ne):
+        out[j] += lo_row[j] * wm + hi_row[j] * wp
+
+
+cdef inline double clip_row(spec_t* row, int ne) noexcept nogil:
+    # Set the negative values of the row to zero and return its sum
+    cdef int j
+    cdef double total = 0.0
+    for j in range(ne):
+        if row[j] < 0.0:
+            row[j] = 0.0
+        total += row[j]
+    return total
+
+
+@cython.cdivision(True)
+cdef inline void cdf_row(const spec_t* row, double* cdf, double total,
+                         int ne) noexcept nogil:
+    cdef int j
+    cdef double inv_total
+    cdf[0] = 0.0
+    for j in range(ne):
+        cdf[j+1] = cdf[j] + row[j]
+    if total > 0.0:
+        inv_total = 1.0 / total
+        for j in range(ne + 1):
+            cdf[j] *= inv_total
+
+
 @cython.cdivision(True)
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def interp2d_spec(np.ndarray[np.float64_t, ndim=2] ctable,
-                  np.ndarray[np.float64_t, ndim=2] mtable,
-                  np.ndarray[np.float64_t, ndim=3] vtable,
+def interp1d_tot_spec(const spec_t[:, ::1] ctable,
+                      const spec_t[:, ::1] mtable,
+                      const spec_t[:, :, ::1] vtable,
+                      np.ndarray[np.float64_t, ndim=1] x_vals,
+                      np.ndarray[np.float64_t, ndim=1] x_bins,
+                      np.ndarray[np.int32_t, ndim=1] x_is,
+                      const double[:] metalZ,
+                      const double[:, :] elemZ,
+                      bint do_var,
+                      spec_t[:, ::1] output,
+                      double[:, ::1] cdf=None,
+                      int e_lo=0,
+                      int e_hi=-1,
+                      int num_threads=1):
+    """
+    Interpolate the total spectra of cells with metallicities *metalZ*
+    and, if *do_var*, abundances *elemZ* of the variable elements, one
+    row for each element, and write them into *output*, with negative
+    values set to zero. The abundances are folded into the interpolation
+    weights, so that the spectra of the components are never stored.
+    Only the energy bins from e_lo up to e_hi are interpolated. If *cdf*
+    is given, the normalized cumulative distribution functions of the
+    spectra are written into it in double precision. The cells are split
+    between *num_threads* threads. Returns the sums of the spectra.
+    """
+    cdef double x, dx_inv, xm, xp, total
+    cdef int i, x_i, k, nelem
+    cdef int nt = x_vals.shape[0]
+    cdef int ne
+    cdef bint do_cdf = cdf is not None
+    cdef spec_t* out_row
+    cdef np.ndarray[np.float64_t, ndim=1] sums
+
+    if e_hi < 0:
+        e_hi = ctable.shape[1]
+    ne = e_hi - e_lo
+    nelem = <int>vtable.shape[0] if do_var else 0
+
+    sums = np.zeros(nt)
+
+    with nogil:
+        for i in prange(nt, num_threads=num_threads, schedule="static"):
+            x_i = x_is[i]
+            x = x_vals[i]
+            dx_inv = 1.0 / (x_bins[x_i+1] - x_bins[x_i])
+            xp = (x - x_bins[x_i]) * dx_inv
+            xm = (x_bins[x_i+1] - x) * dx_inv
+            out_row = &output[i, 0]
+            interp_row(&ctable[x_i, e_lo], &ctable[x_i+1, e_lo],
+                       <spec_t>xm, <spec_t>xp, out_row, ne)
+            add_row(&mtable[x_i, e_lo], &mtable[x_i+1, e_lo],
+                    <spec_t>(xm * metalZ[i]), <spec_t>(xp * metalZ[i]),
+                    out_row, ne)
+            for k in range(nelem):
+                add_row(&vtable[k, x_i, e_lo], &vtable[k, x_i+1, e_lo],
+                        <spec_t>(xm * elemZ[k, i]), <spec_t>(xp * elemZ[k, i]),
+                        out_row, ne)
+            total = clip_row(out_row, ne)
+            sums[i] = total
+            if do_cdf:
+                cdf_row(out_row, &cdf[i, 0], total, ne)
+
+    return sums
+
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def interp2d_spec(const spec_t[:, ::1] ctable,
+                  const spec_t[:, ::1] mtable,
+                  const spec_t[:, :, ::1] vtable,
                   np.ndarray[np.float64_t, ndim=1] x_vals,
                   np.ndarray[np.float64_t, ndim=1] x_bins,
                   np.ndarray[np.int32_t, ndim=1] x_is,
                   np.ndarray[np.float64_t, ndim=1] y_vals,
                   np.ndarray[np.float64_t, ndim=1] y_bins,
                   np.ndarray[np.int32_t, ndim=1] y_is,
-                  bint do_var):
+                  bint do_var,
+                  int num_threads=1):
     cdef double x, dx_inv, y, dy_inv
     cdef int i, x_i, j, k, nelem, y_i
     cdef int z1, z2, z3, z4
     cdef int nt = x_vals.shape[0]
     cdef int ne = ctable.shape[1]
     cdef int ntbins = x_bins.shape[0]
-    cdef np.ndarray[np.float64_t, ndim=1] xp, xm, yp, ym
-    cdef np.ndarray[np.float64_t, ndim=2] coutput, moutput
-    cdef np.ndarray[np.float64_t, ndim=3] voutput
+    cdef spec_t wxm, wxp, wym, wyp
+    cdef spec_t[:, ::1] cout, mout
+    cdef spec_t[:, :, ::1] vout
 
-    coutput = np.zeros((nt, ne))
-    moutput = np.zeros((nt, ne))
+    dtype = np.float32 if spec_t is float else np.float64
+    coutput = np.zeros((nt, ne), dtype=dtype)
+    moutput = np.zeros((nt, ne), dtype=dtype)
+    cout = coutput
+    mout = moutput
     if do_var:
         nelem = <int>vtable.shape[0]
-        voutput = np.zeros((nelem, nt, ne))
+        voutput = np.zeros((nelem, nt, ne), dtype=dtype)
+        vout = voutput
     else:
         nelem = 0
+        vout = np.zeros((1, 1, 1), dtype=dtype)
 
-    xp = np.zeros(nt)
-    xm = np.zeros(nt)
-    yp = np.zeros(nt)
-    ym = np.zeros(nt)
-
-    for i in range(nt):
-        x_i = x_is[i]
-        x = x_vals[i]
-        dx_inv = 1.0 / (x_bins[x_i+1] - x_bins[x_i])
-        xp[i] = (x - x_bins[x_i]) * dx_inv
-        xm[i] = (x_bins[x_i+1] - x) * dx_inv
-        y_i = y_is[i]
-        y = y_vals[i]
-        dy_inv = 1.0 / (y_bins[y_i+1] - y_bins[y_i])
-        yp[i] = (y - y_bins[y_i]) * dy_inv
-        ym[i] = (y_bins[y_i+1] - y) * dy_inv
-
-    for i in range(nt):
-        x_i = x_is[i]
-        y_i = y_is[i]
-        z1 = ntbins*y_i + x_i
-        z2 = z1 + ntbins
-        z3 = z1 + 1
-        z4 = z2 + 1
-        for j in range(ne):
-            coutput[i, j] = ctable[z1, j] * xm[i] * ym[i] + \
-                            ctable[z2, j] * xm[i] * yp[i] + \
-                            ctable[z3, j] * xp[i] * ym[i] + \
-                            ctable[z4, j] * xp[i] * yp[i]
-            moutput[i, j] = mtable[z1, j] * xm[i] * ym[i] + \
-                            mtable[z2, j] * xm[i] * yp[i] + \
-                            mtable[z3, j] * xp[i] * ym[i] + \
-                            mtable[z4, j] * xp[i] * yp[i]
-    if do_var:
-        for i in range(nt):
+    with nogil:
+        for i in prange(nt, num_threads=num_threads, schedule="static"):
             x_i = x_is[i]
+            x = x_vals[i]
+            dx_inv = 1.0 / (x_bins[x_i+1] - x_bins[x_i])
             y_i = y_is[i]
-            z1 = ntbins * y_i + x_i
+            y = y_vals[i]
+            dy_inv = 1.0 / (y_bins[y_i+1] - y_bins[y_i])
+            z1 = ntbins*y_i + x_i
             z2 = z1 + ntbins
             z3 = z1 + 1
             z4 = z2 + 1
+            wxm = <spec_t>((x_bins[x_i+1] - x) * dx_inv)
+            wxp = <spec_t>((x - x_bins[x_i]) * dx_inv)
+            wym = <spec_t>((y_bins[y_i+1] - y) * dy_inv)
+            wyp = <spec_t>((y - y_bins[y_i]) * dy_inv)
+            for j in range(ne):
+                cout[i, j] = ctable[z1, j] * wxm * wym + \
+                             ctable[z2, j] * wxm * wyp + \
+                             ctable[z3, j] * wxp * wym + \
+                             ctable[z4, j] * wxp * wyp
+                mout[i, j] = mtable[z1, j] * wxm * wym + \
+                             mtable[z2, j] * wxm * wyp + \
+                             mtable[z3, j] * wxp * wym + \
+                             mtable[z4, j] * wxp * wyp
             for k in range(nelem):
                 for j in range(ne):
-                    voutput[k, i, j] = vtable[k, z1, j] * xm[i] * ym[i] + \
-                                       vtable[k, z2, j] * xm[i] * yp[i] + \
-                                       vtable[k, z3, j] * xp[i] * ym[i] + \
-                                       vtable[k, z4, j] * xp[i] * yp[i]
+                    vout[k, i, j] = vtable[k, z1, j] * wxm * wym + \
+                                    vtable[k, z2, j] * wxm * wyp + \
+                                    vtable[k, z3, j] * wxp * wym + \
+                                    vtable[k, z4, j] * wxp * wyp
 
     if do_var:
         return coutput, moutput, voutput
     else:
         return coutput, moutput, None
+
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def interp1d_flux(const double[:, ::1] table,
+                  const double[:] x_bins,
+                  const double[:] x_vals):
+    """
+    Interpolate each row of *table*, which is tabulated at the sorted
+    *x_bins*, linearly at *x_vals*. Values beyond the ends of *x_bins*
+    are zero. Returns an array with a row for each row of the table.
+    """
+    cdef Py_ssize_t nrows = table.shape[0]
+    cdef Py_ssize_t nx = x_bins.shape[0]
+    cdef Py_ssize_t nv = x_vals.shape[0]
+    cdef Py_ssize_t i, k, lo, hi, mid
+    cdef double x, xp, xm
+    cdef double[:, ::1] out
+
+    output = np.zeros((nrows, nv))
+    out = output
+
+    with nogil:
+        for i in range(nv):
+            x = x_vals[i]
+            # This is also false for NaNs
+            if not (x >= x_bins[0] and x <= x_bins[nx-1]):
+                continue
+            lo = 0
+            hi = nx - 1
+            while hi - lo > 1:
+                mid = (lo + hi) >> 1
+                if x_bins[mid] <= x:
+                    lo = mid
+                else:
+                    hi = mid
+            xp = (x - x_bins[lo]) / (x_bins[hi] - x_bins[lo])
+            xm = 1.0 - xp
+            for k in range(nrows):
+                out[k, i] = table[k, lo] * xm + table[k, hi] * xp
+
+    return output
+
+
+cdef inline void interp_row2d(const spec_t* row1, const spec_t* row2,
+                              const spec_t* row3, const spec_t* row4,
+                              spec_t w1, spec_t w2, spec_t w3, spec_t w4,
+                              spec_t* out, int ne) noexcept nogil:
+    cdef int j
+    for j in range(ne):
+        out[j] = row1[j] * w1 + row2[j] * w2 + row3[j] * w3 + row4[j] * w4
+
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def igm_cie_spec(const spec_t[:, ::1] ctable,
+                 const spec_t[:, ::1] mtable,
+                 const spec_t[:, :, ::1] vtable,
+                 const spec_t[:, ::1] cie_ctable,
+                 const spec_t[:, ::1] cie_mtable,
+                 const spec_t[:, :, ::1] cie_vtable,
+                 const double[:] kT_vals,
+                 const double[:] nH_vals,
+                 const double[::1] x_bins,
+                 x_grid,
+                 const double[::1] y_bins,
+                 y_grid,
+                 const double[::1] cie_bins,
+                 cie_grid,
+                 limits,
+                 double kT_to_K,
+                 bint do_var,
+                 int num_threads=1):
+    """
+    Interpolate the spectra of cells with temperatures *kT_vals* in keV and
+    hydrogen number densities *nH_vals* from the IGM tables, which are
+    tabulated at the log temperatures *x_bins* and log densities *y_bins*,
+    if the cell lies within *limits* (kT_min, kT_max, nH_min, nH_max), and
+    otherwise from the CIE tables, which are tabulated at the log
+    temperatures *cie_bins*. The IGM spectra are divided by the density as
+    they are interpolated. The grids are the spacings of the nodes, as
+    passed to grid_indices. The cells are split between *num_threads*
+    threads.
+    """
+    cdef double kT, nH, x, y, dx_inv, dy_inv, wxm, wxp, wym, wyp
+    cdef double kT_min, kT_max, nH_min, nH_max
+    cdef double x_x0, x_inv, y_x0, y_inv, c_x0, c_inv
+    cdef int x_kind, y_kind, c_kind
+    cdef int i, x_i, y_i, k, nelem, z1, z2, z3, z4
+    cdef int nt = kT_vals.shape[0]
+    cdef int ne = ctable.shape[1]
+    cdef int nx = x_bins.shape[0]
+    cdef int ny = y_bins.shape[0]
+    cdef int nc = cie_bins.shape[0]
+    cdef spec_t[:, ::1] cout, mout
+    cdef spec_t[:, :, ::1] vout
+
+    x_kind, x_x0, x_inv = x_grid
+    y_kind, y_x0, y_inv = y_grid
+    c_kind, c_x0, c_inv = cie_grid
+    kT_min, kT_max, nH_min, nH_max = limits
+
+    # Every cell is written to by one of the tables
+    dtype = np.float32 if spec_t is float else np.float64
+    coutput = np.empty((nt, ne), dtype=dtype)
+    moutput = np.empty((nt, ne), dtype=dtype)
+    cout = coutput
+    mout = moutput
+    if do_var:
+        nelem = <int>vtable.shape[0]
+        voutput = np.empty((nelem, nt, ne), dtype=dtype)
+        vout = voutput
+    else:
+        nelem = 0
+        vout = np.zeros((1, 1, 1), dtype=dtype)
+
+    with nogil:
+        for i in prange(nt, num_threads=num_threads, schedule="static"):
+            kT = kT_vals[i]
+            nH = nH_vals[i]
+            x = log10(kT * kT_to_K)
+            if kT >= kT_min and kT <= kT_max and nH >= nH_min and nH <= nH_max:
+                y = log10(nH)
+                x_i = grid_index(x, &x_bins[0], nx, x_kind, x_x0, x_inv)
+                y_i = grid_index(y, &y_bins[0], ny, y_kind, y_x0, y_inv)
+                dx_inv = 1.0 / (x_bins[x_i+1] - x_bins[x_i])
+                dy_inv = 1.0 / (y_bins[y_i+1] - y_bins[y_i]) / nH
+                wxm = (x_bins[x_i+1] - x) * dx_inv
+                wxp = (x - x_bins[x_i]) * dx_inv
+                wym = (y_bins[y_i+1] - y) * dy_inv
+                wyp = (y - y_bins[y_i]) * dy_inv
+                z1 = nx*y_i + x_i
+                z2 = z1 + nx
+                z3 = z1 + 1
+                z4 = z2 + 1
+                interp_row2d(&ctable[z1, 0], &ctable[z2, 0], &ctable[z3, 0],
+                             &ctable[z4, 0], <spec_t>(wxm * wym),
+                             <spec_t>(wxm * wyp), <spec_t>(wxp * wym),
+                             <spec_t>(wxp * wyp), &cout[i, 0], ne)
+                interp_row2d(&mtable[z1, 0], &mtable[z2, 0], &mtable[z3, 0],
+                             &mtable[z4, 0], <spec_t>(wxm * wym),
+                             <spec_t>(wxm * wyp), <spec_t>(wxp * wym),
+                             <spec_t>(wxp * wyp), &mout[i, 0], ne)
+                for k in range(nelem):
+                    interp_row2d(&vtable[k, z1, 0], &vtable[k, z2, 0],
+                                 &vtable[k, z3, 0], &vtable[k, z4, 0],
+                                 <spec_t>(wxm * wym), <spec_t>(wxm * wyp),
+                                 <spec_t>(wxp * wym), <spec_t>(wxp * wyp),
+                                 &vout[k, i, 0], ne)
+            else:
+                x_i = grid_index(x, &cie_bins[0], nc, c_kind, c_x0, c_inv)
+                dx_inv = 1.0 / (cie_bins[x_i+1] - cie_bins[x_i])
+                wxm = (cie_bins[x_i+1] - x) * dx_inv
+                wxp = (x - cie_bins[x_i]) * dx_inv
+                interp_row(&cie_ctable[x_i, 0], &cie_ctable[x_i+1, 0],
+                           <spec_t>wxm, <spec_t>wxp, &cout[i, 0], ne)
+                interp_row(&cie_mtable[x_i, 0], &cie_mtable[x_i+1, 0],
+                           <spec_t>wxm, <spec_t>wxp, &mout[i, 0], ne)
+                for k in range(nelem):
+                    interp_row(&cie_vtable[k, x_i, 0], &cie_vtable[k, x_i+1, 0],
+                               <spec_t>wxm, <spec_t>wxp, &vout[k, i, 0], ne)
+
+    if do_var:
+        return coutput, moutput, voutput
+    else:
+        return coutput, moutput, None
+
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def igm_cie_flux(const double[:, ::1] table,
+                 const double[:, ::1] cie_table,
+                 const double[:] kT_vals,
+                 const double[:] nH_vals,
+                 const double[::1] x_bins,
+                 x_grid,
+                 const double[::1] y_bins,
+                 y_grid,
+                 const double[::1] cie_bins,
+                 cie_grid,
+                 limits,
+                 double kT_to_K):
+    """
+    Interpolate each row of the IGM flux *table* or the CIE flux
+    *cie_table* at the cells with temperatures *kT_vals* in keV and
+    hydrogen number densities *nH_vals*, choosing the table for each cell
+    as igm_cie_spec does. The CIE fluxes beyond the ends of *cie_bins*
+    are zero. Returns an array with a row for each row of the tables.
+    """
+    cdef double kT, nH, x, y, dx_inv, dy_inv, wxm, wxp, wym, wyp
+    cdef double kT_min, kT_max, nH_min, nH_max
+    cdef double x_x0, x_inv, y_x0, y_inv, c_x0, c_inv
+    cdef int x_kind, y_kind, c_kind
+    cdef int i, x_i, y_i, k, z1, z2
+    cdef int nrows = table.shape[0]
+    cdef int nt = kT_vals.shape[0]
+    cdef int nx = x_bins.shape[0]
+    cdef int ny = y_bins.shape[0]
+    cdef int nc = cie_bins.shape[0]
+    cdef double[:, ::1] out
+
+    x_kind, x_x0, x_inv = x_grid
+    y_kind, y_x0, y_inv = y_grid
+    c_kind, c_x0, c_inv = cie_grid
+    kT_min, kT_max, nH_min, nH_max = limits
+
+    output = np.zeros((nrows, nt))
+    out = output
+
+    with nogil:
+        for i in range(nt):
+            kT = kT_vals[i]
+            nH = nH_vals[i]
+            x = log10(kT * kT_to_K)
+            if kT >= kT_min and kT <= kT_max and nH >= nH_min and nH <= nH_max:
+                y = log10(nH)
+                x_i = grid_index(x, &x_bins[0], nx, x_kind, x_x0, x_inv)
+                y_i = grid_index(y, &y_bins[0], ny, y_kind, y_x0, y_inv)
+                dx_inv = 1.0 / (x_bins[x_i+1] - x_bins[x_i])
+                dy_inv = 1.0 / (y_bins[y_i+1] - y_bins[y_i]) / nH
+                wxm = (x_bins[x_i+1] - x) * dx_inv
+                wxp = (x - x_bins[x_i]) * dx_inv
+                wym = (y_bins[y_i+1] - y) * dy_inv
+                wyp = (y - y_bins[y_i]) * dy_inv
+                z1 = nx*y_i + x_i
+                z2 = z1 + nx
+                for k in range(nrows):
+                    out[k, i] = (table[k, z1] * wxm * wym +
+                                 table[k, z2] * wxm * wyp +
+                                 table[k, z1+1] * wxp * wym +
+                                 table[k, z2+1] * wxp * wyp)
+            # This is also false for NaNs
+            elif x >= cie_bins[0] and x <= cie_bins[nc-1]:
+                x_i = grid_index(x, &cie_bins[0], nc, c_kind, c_x0, c_inv)
+                dx_inv = 1.0 / (cie_bins[x_i+1] - cie_bins[x_i])
+                wxm = (cie_bins[x_i+1] - x) * dx_inv
+                wxp = (x - cie_bins[x_i]) * dx_inv
+                for k in range(nrows):
+                    out[k, i] = cie_table[k, x_i] * wxm + cie_table[k, x_i+1] * wxp
+
+    return output
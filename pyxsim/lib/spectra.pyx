@@ -2,6 +2,7 @@ import numpy as np
 
 cimport cython
 cimport numpy as np
+from libcpp.algorithm cimport sort
 
 
 def power_law_spectrum(
@@ -46,3 +47,247 @@ def line_spectrum(
             spec[j] += N[i] * (ret[1:] - ret[:-1])
         pbar.update()
     return spec
+
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def invert_cdf(np.ndarray[np.float64_t, ndim=2] cdf,
+               np.ndarray[np.float64_t, ndim=1] edges,
+               np.ndarray[np.int64_t, ndim=1] n_ph,
+               np.ndarray[np.float64_t, ndim=1] u):
+    """
+    Draw photon energies for a block of cells by inverting their
+    cumulative distribution functions *cdf*, one row for each cell,
+    over the bin *edges*. The uniform deviates *u* are consumed in cell
+    order, *n_ph* of them for each cell, and are sorted in place within
+    each cell. The energies are interpolated just as np.interp does.
+    """
+    cdef np.int64_t num_cells = n_ph.shape[0]
+    cdef np.int64_t nedges = edges.shape[0]
+    cdef np.int64_t i, k, n, lo, hi, mid, step
+    cdef double x, slope
+    cdef np.ndarray[np.float64_t, ndim=1] energies
+
+    energies = np.empty(u.shape[0])
+
+    with nogil:
+        k = 0
+        for i in range(num_cells):
+            if n_ph[i] == 0:
+                continue
+            # NumPy sorts long runs faster than std::sort does, but the
+            # GIL is only worth taking for them
+            if n_ph[i] > 48:
+                with gil:
+                    u[k:k+n_ph[i]].sort()
+            else:
+                sort(&u[k], &u[k] + n_ph[i])
+            # The deviates are sorted, so each search starts from the bin
+            # that the last one was found in
+            lo = 0
+            for n in range(n_ph[i]):
+                x = u[k]
+                if x >= cdf[i, nedges-1]:
+                    energies[k] = edges[nedges-1]
+                else:
+                    # Find the bin with cdf[i, lo] <= x < cdf[i, lo+1],
+                    # galloping out from the last one before bisecting
+                    step = 1
+                    hi = lo + 1
+                    while hi < nedges - 1 and cdf[i, hi] <= x:
+                        lo = hi
+                        hi += step
+                        step *= 2
+                    if hi > nedges - 1:
+                        hi = nedges - 1
+                    while hi - lo > 1:
+                        mid = (lo + hi) >> 1
+                        if cdf[i, mid] <= x:
+                            lo = mid
+                        else:
+                            hi = mid
+                    if cdf[i, lo] == x:
+                        energies[k] = edges[lo]
+                    else:
+                        slope = (edges[lo+1] - edges[lo]) / (cdf[i, lo+1] - cdf[i, lo])
+                        energies[k] = slope * (x - cdf[i, lo]) + edges[lo]
+                k += 1
+
+    return energies
+
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def alias_tables(np.ndarray[np.float64_t, ndim=2] p):
+    """
+    Build Walker/Vose alias tables for the discrete distributions *p*,
+    one row for each distribution, which need not be normalized. Returns
+    the arrays of the probabilities of keeping each bin and of the bins
+    which are drawn instead of them.
+    """
+    cdef np.int64_t num_rows = p.shape[0]
+    cdef np.int64_t nbins = p.shape[1]
+    cdef np.int64_t i, j, s, l, n_small, n_large
+    cdef double norm
+    cdef np.ndarray[np.float64_t, ndim=2] prob
+    cdef np.ndarray[np.int64_t, ndim=2] alias
+    cdef np.ndarray[np.float64_t, ndim=1] scaled
+    cdef np.ndarray[np.int64_t, ndim=1] small, large
+
+    prob = np.empty((num_rows, nbins))
+    alias = np.empty((num_rows, nbins), dtype="int64")
+    scaled = np.empty(nbins)
+    small = np.empty(nbins, dtype="int64")
+    large = np.empty(nbins, dtype="int64")
+
+    with nogil:
+        for i in range(num_rows):
+            norm = 0.0
+            for j in range(nbins):
+                norm += p[i, j]
+            if norm > 0.0:
+                norm = nbins / norm
+            n_small = 0
+            n_large = 0
+            for j in range(nbins):
+                scaled[j] = p[i, j] * norm
+                alias[i, j] = j
+                if scaled[j] < 1.0:
+                    small[n_small] = j
+                    n_small += 1
+                else:
+                    large[n_large] = j
+                    n_large += 1
+            while n_small > 0 and n_large > 0:
+                n_small -= 1
+                s = small[n_small]
+                l = large[n_large-1]
+                prob[i, s] = scaled[s]
+                alias[i, s] = l
+                scaled[l] = (scaled[l] + scaled[s]) - 1.0
+                if scaled[l] < 1.0:
+                    n_large -= 1
+                    small[n_small] = l
+                    n_small += 1
+            # Whatever is left over is only off from one by roundoff
+            while n_large > 0:
+                n_large -= 1
+                prob[i, large[n_large]] = 1.0
+            while n_small > 0:
+                n_small -= 1
+                prob[i, small[n_small]] = 1.0
+
+    return prob, alias
+
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def alias_sample(np.ndarray[np.float64_t, ndim=2] prob,
+                 np.ndarray[np.int64_t, ndim=2] alias,
+                 np.ndarray[np.int64_t, ndim=1] n_ph,
+                 np.ndarray[np.float64_t, ndim=1] u):
+    """
+    Draw the bins of photons from the alias tables *prob* and *alias*
+    made by :func:`alias_tables`, *n_ph* photons from each row, using
+    one of the uniform deviates *u* for each photon.
+    """
+    cdef np.int64_t num_rows = n_ph.shape[0]
+    cdef np.int64_t nbins = prob.shape[1]
+    cdef np.int64_t i, j, k, n
+    cdef double x
+    cdef np.ndarray[np.int64_t, ndim=1] bins
+
+    bins = np.empty(u.shape[0], dtype="int64")
+
+    with nogil:
+        k = 0
+        for i in range(num_rows):
+            for n in range(n_ph[i]):
+                # The integer part of the deviate picks the bin, and the
+                # fractional part whether to keep it or take its alias
+                x = u[k] * nbins
+                j = <np.int64_t>x
+                if j >= nbins:
+                    j = nbins - 1
+                if x - j < prob[i, j]:
+                    bins[k] = j
+                else:
+                    bins[k] = alias[i, j]
+                k += 1
+
+    return bins
+
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def mixture_sample(np.ndarray[np.float64_t, ndim=2] cdf,
+                   np.ndarray[np.float64_t, ndim=1] edges,
+                   np.ndarray[np.int64_t, ndim=1] n_ph,
+                   np.ndarray[np.int64_t, ndim=1] x_i,
+                   np.ndarray[np.float64_t, ndim=2] weights,
+                   int num_nodes,
+                   np.ndarray[np.float64_t, ndim=1] u):
+    """
+    Draw photon energies for a block of cells whose spectra are mixtures
+    of the spectra of the components of a table at its nodes. *cdf* has
+    the cumulative distribution functions over the bin *edges* of each
+    component at each of the *num_nodes* nodes, component by component.
+    Cell i mixes the spectra at nodes x_i[i] and x_i[i]+1 with the
+    *weights* of each component at each of these two nodes, in the order
+    (component 0, node 0), (component 0, node 1), (component 1, node 0),
+    and so on. Two of the uniform deviates *u* are used for each of the
+    *n_ph* photons of each cell, the first to pick the component and node
+    and the second to invert its distribution function.
+    """
+    cdef np.int64_t num_cells = n_ph.shape[0]
+    cdef np.int64_t num_weights = weights.shape[1]
+    cdef np.int64_t nedges = edges.shape[0]
+    cdef np.int64_t i, k, n, m, row, lo, hi, mid
+    cdef double total, target, acc, x, slope
+    cdef np.ndarray[np.float64_t, ndim=1] energies
+
+    energies = np.empty(u.shape[0] // 2)
+
+    with nogil:
+        k = 0
+        for i in range(num_cells):
+            if n_ph[i] == 0:
+                continue
+            total = 0.0
+            for m in range(num_weights):
+                total += weights[i, m]
+            for n in range(n_ph[i]):
+                target = u[2*k] * total
+                acc = 0.0
+                row = -1
+                for m in range(num_weights):
+                    if weights[i, m] > 0.0:
+                        row = m
+                        acc += weights[i, m]
+                        if target < acc:
+                            break
+                row = (row >> 1) * num_nodes + x_i[i] + (row & 1)
+                x = u[2*k+1]
+                if x >= cdf[row, nedges-1]:
+                    energies[k] = edges[nedges-1]
+                else:
+                    lo = 0
+                    hi = nedges - 1
+                    while hi - lo > 1:
+                        mid = (lo + hi) >> 1
+                        if cdf[row, mid] <= x:
+                            lo = mid
+                        else:
+                            hi = mid
+                    if cdf[row, lo] == x:
+                        energies[k] = edges[lo]
+                    else:
+                        slope = (edges[lo+1] - edges[lo]) / (cdf[row, lo+1] - cdf[row, lo])
+                        energies[k] = slope * (x - cdf[row, lo]) + edges[lo]
+                k += 1
+
+    return energies
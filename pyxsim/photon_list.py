@@ -1,6 +1,9 @@
 """
 Classes for generating lists of photons
 """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import h5py
 import numpy as np
 from soxs import __version__ as soxs_version
@@ -17,14 +20,23 @@ from yt.utilities.parallel_tools.parallel_analysis_interface import (
 from yt.utilities.physical_constants import clight
 
 from pyxsim import __version__ as pyxsim_version
+from pyxsim.chunk_manifest import get_chunk_manifest
 from pyxsim.lib.sky_functions import (
     doppler_shift,
     pixel_to_cel,
     scatter_events,
     scatter_events_allsky,
 )
+from pyxsim.process_pool import DataSourceRecipe, pool_size, pool_starmap
 from pyxsim.spectral_models import absorb_models
-from pyxsim.utils import mylog, parse_value
+from pyxsim.utils import chunk_prng, draw_seed, merge_files, mylog, parse_value
+from pyxsim.writers import (
+    BackgroundWriter,
+    DatasetAppender,
+    StorageFormat,
+    chunk_rows,
+    presize,
+)
 
 comm = communication_system.communicators[-1]
 
@@ -117,6 +129,14 @@ def make_photons(
     bulk_velocity=None,
     observer="external",
     fields_to_keep=None,
+    write_queue_size=2,
+    flush_every=1,
+    estimate_counts=False,
+    n_threads=None,
+    pool=None,
+    load_func=None,
+    storage_precision="float64",
+    storage_policy=None,
 ):
     r"""
     Write a photon list dataset to disk from a yt data source and assuming a
@@ -172,6 +192,58 @@ def make_photons(
         A 3-element array or list specifying the local velocity frame of
         reference. If not a :class:`~yt.units.yt_array.YTArray`, it is assumed
         to have units of km/s. Default: [0.0, 0.0, 0.0] km/s.
+    write_queue_size : integer, optional
+        The photons from each chunk of the data source are written to disk on
+        a background thread while the next chunk is being processed. This sets
+        the maximum number of chunks which can be waiting to be written. If 0,
+        the photons are written without using a background thread. Default: 2
+    flush_every : integer, optional
+        Flush the photon list to disk after this many chunks have been
+        written. If None, it is only flushed when it is closed. Default: 1
+    estimate_counts : boolean, optional
+        If True, make a first pass over the data source which estimates the
+        number of photons and cells with photons from the band flux of the
+        source model, and allocate the photon list datasets at that size up
+        front instead of growing them as photons are generated. If the
+        estimate is exceeded, the datasets grow as usual. Default: False
+    n_threads : integer, optional
+        If set, the chunks of the data source are processed in parallel by
+        this many threads, and the photons are written out in chunk order.
+        Each chunk is given its own random number generator seeded from the
+        source model's, so the photons do not depend on the number of
+        threads, though they differ from the photons generated if this is
+        not set. Default: None
+    pool : :class:`~concurrent.futures.ProcessPoolExecutor` or :class:`multiprocessing.pool.Pool`, optional
+        If set, the chunks of the data source are shared among the workers
+        of this process pool, each of which opens the dataset itself and
+        writes its photons to the file "{photon_prefix}.{worker:04d}.h5".
+        These are then combined into a virtual photon list in the file
+        "{photon_prefix}.h5" which refers to them. As with *n_threads*, each
+        chunk is given its own random number generator. This cannot be
+        used together with MPI. Default: None
+    load_func : callable, optional
+        The function which the workers of *pool* use to load the dataset,
+        given its filename. It must be picklable, e.g. defined at the top
+        level of a module. This can be used to pass arguments to
+        :func:`~yt.load` or to add derived fields to the dataset. Workers
+        which are forked from this process use the dataset which is
+        already loaded. Default: :func:`~yt.load`
+    storage_precision : string, optional
+        The precision that the photon list is stored at. "float64" stores
+        everything in double precision. "float32" stores the positions,
+        widths, and velocities, which are relative to the *center* and
+        *bulk_velocity*, and the energies in single precision. "uint16"
+        and "uint32" do the same, except that the energies are stored as
+        integer codes on an evenly spaced grid across the energy range of
+        the source model, which is recorded in the parameters of the file.
+        If the source model's photons have no fixed energy range, e.g. for
+        a broadened line, the energies are stored in single precision.
+        The photon list is decoded transparently when it is read.
+        Default: "float64"
+    storage_policy : :class:`~pyxsim.writers.StoragePolicy`, optional
+        The HDF5 chunk layout and compression of the photon list. If not
+        set, the datasets are not compressed, and their chunk size is
+        chosen by h5py or from the estimated number of photons.
 
     Returns
     -------
@@ -188,266 +260,559 @@ def make_photons(
     >>> n_photons, n_cells = pyxsim.make_photons(sp, redshift, area,
     ...                                          time, thermal_model)
     """
-    ds = data_source.ds
-
     if photon_prefix.endswith(".h5"):
         photon_prefix = photon_prefix[:-3]
 
+    args = (redshift, area, exp_time, source_model)
+    kwargs = {
+        "point_sources": point_sources,
+        "parameters": parameters,
+        "center": center,
+        "dist": dist,
+        "cosmology": cosmology,
+        "velocity_fields": velocity_fields,
+        "bulk_velocity": bulk_velocity,
+        "observer": observer,
+        "fields_to_keep": fields_to_keep,
+        "write_queue_size": write_queue_size,
+        "flush_every": flush_every,
+        "estimate_counts": estimate_counts,
+        "n_threads": n_threads,
+        "storage_precision": storage_precision,
+        "storage_policy": storage_policy,
+    }
+
+    if pool is not None:
+        return _make_photons_pool(
+            pool, load_func, photon_prefix, data_source, args, kwargs
+        )
+
     if comm.size > 1:
         photon_file = f"{photon_prefix}.{comm.rank:04d}.h5"
     else:
         photon_file = f"{photon_prefix}.h5"
 
-    if parameters is None:
-        parameters = {}
-    if cosmology is None:
-        if hasattr(ds, "cosmology"):
-            cosmo = ds.cosmology
+    return _make_photons(photon_file, data_source, *args, **kwargs)
+
+
+class _PhotonGenerator:
+    """
+    Set up a source model on a data source, and generate photons from
+    the chunks of the data source with it.
+    """
+
+    def __init__(
+        self,
+        data_source,
+        redshift,
+        area,
+        exp_time,
+        source_model,
+        point_sources=False,
+        parameters=None,
+        center=None,
+        dist=None,
+        cosmology=None,
+        velocity_fields=None,
+        bulk_velocity=None,
+        observer="external",
+        fields_to_keep=None,
+    ):
+        ds = data_source.ds
+
+        if parameters is None:
+            parameters = {}
+        if cosmology is None:
+            if hasattr(ds, "cosmology"):
+                cosmo = ds.cosmology
+            else:
+                cosmo = Cosmology()
         else:
-            cosmo = Cosmology()
-    else:
-        cosmo = cosmology
-
-    if observer == "external":
-        if dist is None:
-            if redshift <= 0.0:
-                msg = (
-                    "If redshift <= 0.0, you must specify a distance to the "
-                    "source using the 'dist' argument!"
-                )
-                mylog.error(msg)
-                raise ValueError(msg)
-            D_A = cosmo.angular_diameter_distance(0.0, redshift).to("Mpc")
+            cosmo = cosmology
+
+        if observer == "external":
+            if dist is None:
+                if redshift <= 0.0:
+                    msg = (
+                        "If redshift <= 0.0, you must specify a distance to the "
+                        "source using the 'dist' argument!"
+                    )
+                    mylog.error(msg)
+                    raise ValueError(msg)
+                D_A = cosmo.angular_diameter_distance(0.0, redshift).to("Mpc")
+            else:
+                D_A = parse_value(dist, "kpc")
+                if redshift > 0.0:
+                    mylog.warning(
+                        "Redshift must be zero for nearby sources. "
+                        "Resetting redshift to 0.0."
+                    )
+                    redshift = 0.0
         else:
-            D_A = parse_value(dist, "kpc")
+            D_A = parse_value(0.0, "kpc")
             if redshift > 0.0:
                 mylog.warning(
-                    "Redshift must be zero for nearby sources. "
+                    "Redshift must be zero for internal observers. "
                     "Resetting redshift to 0.0."
                 )
                 redshift = 0.0
-    else:
-        D_A = parse_value(0.0, "kpc")
-        if redshift > 0.0:
-            mylog.warning(
-                "Redshift must be zero for internal observers. "
-                "Resetting redshift to 0.0."
-            )
-            redshift = 0.0
-
-    if isinstance(center, str):
-        if center == "center" or center == "c":
-            parameters["center"] = ds.domain_center
-        elif center == "max" or center == "m":
-            parameters["center"] = ds.find_max("density")[-1]
-    elif isinstance(center, unyt_array):
-        parameters["center"] = center.in_units("code_length")
-    elif isinstance(center, tuple):
-        if center[0] == "min":
-            parameters["center"] = ds.find_min(center[1])[-1]
-        elif center[0] == "max":
-            parameters["center"] = ds.find_max(center[1])[-1]
+
+        if isinstance(center, str):
+            if center == "center" or center == "c":
+                parameters["center"] = ds.domain_center
+            elif center == "max" or center == "m":
+                parameters["center"] = ds.find_max("density")[-1]
+        elif isinstance(center, unyt_array):
+            parameters["center"] = center.in_units("code_length")
+        elif isinstance(center, tuple):
+            if center[0] == "min":
+                parameters["center"] = ds.find_min(center[1])[-1]
+            elif center[0] == "max":
+                parameters["center"] = ds.find_max(center[1])[-1]
+            else:
+                raise RuntimeError
+        elif isinstance(center, (list, np.ndarray)):
+            parameters["center"] = ds.arr(center, "code_length")
+        elif center is None:
+            if hasattr(data_source, "left_edge"):
+                parameters["center"] = 0.5 * (
+                    data_source.left_edge + data_source.right_edge
+                )
+            else:
+                parameters["center"] = data_source.get_field_parameter("center")
+
+        if bulk_velocity is None:
+            bulk_velocity = ds.arr([0.0] * 3, "km/s")
+        elif isinstance(bulk_velocity, unyt_array):
+            bulk_velocity = bulk_velocity.to("km/s")
+        elif isinstance(bulk_velocity, (list, np.ndarray)):
+            bulk_velocity = ds.arr(bulk_velocity, "km/s")
+        parameters["bulk_velocity"] = bulk_velocity
+
+        parameters["fid_exp_time"] = parse_value(exp_time, "s")
+        parameters["fid_area"] = parse_value(area, "cm**2")
+        parameters["fid_redshift"] = redshift
+        parameters["observer"] = observer
+        parameters["hubble"] = cosmo.hubble_constant
+        parameters["omega_matter"] = cosmo.omega_matter
+        parameters["omega_lambda"] = cosmo.omega_lambda
+        parameters["center"].convert_to_units("kpc")
+        parameters["fid_d_a"] = D_A
+
+        if observer == "external":
+            if redshift > 0.0:
+                mylog.info(
+                    "Cosmology: h = %g, omega_matter = %g, omega_lambda = %g",
+                    cosmo.hubble_constant,
+                    cosmo.omega_matter,
+                    cosmo.omega_lambda,
+                )
+            else:
+                mylog.info("Observing local source at distance %g.", D_A)
         else:
-            raise RuntimeError
-    elif isinstance(center, (list, np.ndarray)):
-        parameters["center"] = ds.arr(center, "code_length")
-    elif center is None:
-        if hasattr(data_source, "left_edge"):
-            parameters["center"] = 0.5 * (
-                data_source.left_edge + data_source.right_edge
+            mylog.info("The observer is internal to the source.")
+
+        local_exp_time = parameters["fid_exp_time"].v
+        D_A = parameters["fid_d_a"].to_value("cm")
+        dist_fac = 1.0 / (4.0 * np.pi)
+        if observer == "external":
+            dist_fac /= D_A * D_A * (1.0 + redshift) ** 2
+
+        self.spectral_norm = parameters["fid_area"].v * local_exp_time * dist_fac
+
+        self.dw = ds.domain_width.to_value("kpc")
+        self.le, self.re = find_object_bounds(data_source)
+        self.c = parameters["center"].to_value("kpc")
+
+        source_model.setup_model("photons", data_source, redshift)
+
+        p_fields, v_fields, w_field = determine_fields(
+            ds, source_model.ftype, point_sources
+        )
+
+        if velocity_fields is not None:
+            v_fields = velocity_fields
+
+        fields_store = []
+        if fields_to_keep is not None:
+            for field in fields_to_keep:
+                fd = ds._get_field_info(field)
+                fields_store.append(fd.name)
+
+        if p_fields[0] == ("index", "x"):
+            parameters["data_type"] = "cells"
+        else:
+            parameters["data_type"] = "particles"
+
+        source_model.set_pv(
+            p_fields,
+            v_fields,
+            self.le,
+            self.re,
+            self.dw,
+            self.c,
+            ds.periodicity,
+            observer,
+        )
+
+        self.data_source = data_source
+        self.source_model = source_model
+        self.parameters = parameters
+        self.bulk_velocity = bulk_velocity
+        self.periodicity = ds.periodicity
+        self.p_fields = p_fields
+        self.v_fields = v_fields
+        self.w_field = w_field
+        self.fields_store = fields_store
+        self._factors = {}
+
+    def write_info(self, info):
+        info.attrs["yt_version"] = yt_version
+        info.attrs["pyxsim_version"] = pyxsim_version
+        info.attrs["soxs_version"] = soxs_version
+        info.attrs["dataset"] = str(self.data_source.ds)
+        info.attrs["data_source"] = str(self.data_source)
+        info.attrs["source_model"] = repr(self.source_model)
+
+    def write_parameters(self, p):
+        parameters = self.parameters
+        p.create_dataset("fid_area", data=float(parameters["fid_area"]))
+        p.create_dataset("fid_exp_time", data=float(parameters["fid_exp_time"]))
+        p.create_dataset("fid_redshift", data=parameters["fid_redshift"])
+        p.create_dataset("hubble", data=parameters["hubble"])
+        p.create_dataset("omega_matter", data=parameters["omega_matter"])
+        p.create_dataset("omega_lambda", data=parameters["omega_lambda"])
+        p.create_dataset("fid_d_a", data=parameters["fid_d_a"].to_value("Mpc"))
+        p.create_dataset("data_type", data=parameters["data_type"])
+        p.create_dataset("observer", data=parameters["observer"])
+        p.create_dataset("center", data=parameters["center"].d)
+        p.create_dataset("bulk_velocity", data=parameters["bulk_velocity"].d)
+        p.create_dataset("velocity_fields", data=np.array(self.v_fields).astype("S"))
+
+    def estimate_counts(self):
+        """
+        Estimate the number of photons and the number of cells or
+        particles with photons, or return None if the source model
+        cannot.
+        """
+        estimate = self.source_model.estimate_photons(
+            self.data_source, self.spectral_norm
+        )
+        if estimate is None:
+            mylog.warning(
+                "This source model cannot estimate the number of photons, "
+                "so the datasets will be grown as photons are generated."
             )
         else:
-            parameters["center"] = data_source.get_field_parameter("center")
-
-    if bulk_velocity is None:
-        bulk_velocity = ds.arr([0.0] * 3, "km/s")
-    elif isinstance(bulk_velocity, unyt_array):
-        bulk_velocity = bulk_velocity.to("km/s")
-    elif isinstance(bulk_velocity, (list, np.ndarray)):
-        bulk_velocity = ds.arr(bulk_velocity, "km/s")
-    parameters["bulk_velocity"] = bulk_velocity
-
-    parameters["fid_exp_time"] = parse_value(exp_time, "s")
-    parameters["fid_area"] = parse_value(area, "cm**2")
-    parameters["fid_redshift"] = redshift
-    parameters["observer"] = observer
-    parameters["hubble"] = cosmo.hubble_constant
-    parameters["omega_matter"] = cosmo.omega_matter
-    parameters["omega_lambda"] = cosmo.omega_lambda
-    parameters["center"].convert_to_units("kpc")
-    parameters["fid_d_a"] = D_A
-
-    if observer == "external":
-        if redshift > 0.0:
             mylog.info(
-                "Cosmology: h = %g, omega_matter = %g, omega_lambda = %g",
-                cosmo.hubble_constant,
-                cosmo.omega_matter,
-                cosmo.omega_lambda,
+                "Expecting %d photons from %d cells/particles.",
+                estimate[0],
+                estimate[1],
             )
-        else:
-            mylog.info("Observing local source at distance %g.", D_A)
-    else:
-        mylog.info("The observer is internal to the source.")
+        return estimate
 
-    local_exp_time = parameters["fid_exp_time"].v
-    D_A = parameters["fid_d_a"].to_value("cm")
-    dist_fac = 1.0 / (4.0 * np.pi)
-    if observer == "external":
-        dist_fac /= D_A * D_A * (1.0 + redshift) ** 2
+    def process_chunk(self, chunk, prng=None):
+        """
+        Generate the photons from a single chunk. Returns a dict of the
+        fields of the cells or particles with photons and the array of
+        photon energies, or None if there are no photons.
+        """
+        chunk_data = self.source_model.process_data(
+            "photons", chunk, self.spectral_norm, prng=prng
+        )
 
-    spectral_norm = parameters["fid_area"].v * local_exp_time * dist_fac
+        if chunk_data is None:
+            return None
+
+        chunk_nc, number_of_photons, idxs, energies = chunk_data
+
+        if np.sum(number_of_photons) == 0:
+            return None
+
+        if idxs.dtype == bool:
+            idxs = np.flatnonzero(idxs)
+        n_cells = idxs.size
+
+        # The positions, velocities, and widths of the cells are gathered
+        # into the rows of a single buffer
+        buf = np.empty((7, n_cells))
+
+        cell_data = {}
+        for i, ax in enumerate("xyz"):
+            pos = self._gather(chunk, self.p_fields[i], idxs, "kpc", buf[i])
+            # Fix photon coordinates for regions crossing a periodic boundary
+            if self.periodicity[i]:
+                tfl = pos < self.le[i]
+                tfr = pos > self.re[i]
+                pos[tfl] += self.dw[i]
+                pos[tfr] -= self.dw[i]
+            # Coordinates are centered
+            pos -= self.c[i]
+            cell_data[ax] = pos
+
+            vel = self._gather(chunk, self.v_fields[i], idxs, "km/s", buf[i + 3])
+            # Velocities have the bulk velocity subtracted off
+            vel -= self.bulk_velocity.v[i]
+            cell_data[f"v{ax}"] = vel
+
+        cell_data["num_photons"] = number_of_photons
+
+        if self.w_field is None:
+            buf[6] = 0.0
+            cell_data["dx"] = buf[6]
+        else:
+            cell_data["dx"] = self._gather(chunk, self.w_field, idxs, "kpc", buf[6])
+
+        for field in self.fields_store:
+            cell_data[field[1]] = np.take(chunk[field].d, idxs)
+
+        return cell_data, energies
+
+    def _gather(self, chunk, field, idxs, units, out):
+        # Gather the elements *idxs* of a field of a chunk into *out* in the
+        # given units. The conversion factor from the units of the field is
+        # only worked out once for each field and set of units.
+        arr = chunk[field]
+        key = (field, str(arr.units), units)
+        factor = self._factors.get(key)
+        if factor is None:
+            factor = self._factors[key] = arr.uq.to_value(units)
+        if arr.dtype == out.dtype:
+            np.take(arr.d, idxs, out=out)
+        else:
+            out[:] = arr.d[idxs]
+        if factor != 1.0:
+            out *= factor
+        return out
 
-    dw = ds.domain_width.to_value("kpc")
-    le, re = find_object_bounds(data_source)
-    c = parameters["center"].to_value("kpc")
+    def generate(self, n_threads=None, chunk_share=None, seed=None, func=None):
+        """
+        Generate the photons from the chunks of the data source, yielding
+        the result of :meth:`process_chunk` for each chunk with photons,
+        in chunk order. If *func* is set, it is applied to each result,
+        on the same thread as :meth:`process_chunk`.
+        """
+        source_model = self.source_model
+
+        def _process_chunk(chunk, prng):
+            buf = self.process_chunk(chunk, prng=prng)
+            if buf is not None and func is not None:
+                buf = func(buf)
+            return buf
+
+        chunks = parallel_objects(enumerate(self.data_source.chunks([], "io")))
+        if chunk_share is not None:
+            # Only process this worker's share of the chunks
+            worker, n_workers = chunk_share
+            chunks = (
+                (ichunk, chunk)
+                for ichunk, chunk in chunks
+                if ichunk % n_workers == worker
+            )
 
-    source_model.setup_model("photons", data_source, redshift)
+        # Each chunk gets its own stream of random numbers if the chunks are
+        # processed in parallel, so that the photons do not depend on how the
+        # chunks are shared out
+        if seed is None and n_threads is not None:
+            seed = draw_seed(source_model.prng)
 
-    p_fields, v_fields, w_field = determine_fields(
-        ds, source_model.ftype, point_sources
-    )
+        if n_threads is None:
 
-    if velocity_fields is not None:
-        v_fields = velocity_fields
+            for ichunk, chunk in chunks:
 
-    fields_store = []
-    if fields_to_keep is not None:
-        for field in fields_to_keep:
-            fd = ds._get_field_info(field)
-            fields_store.append(fd.name)
+                if source_model.skip_chunk(ichunk):
+                    continue
 
-    if p_fields[0] == ("index", "x"):
-        parameters["data_type"] = "cells"
-    else:
-        parameters["data_type"] = "particles"
+                prng = None if seed is None else chunk_prng(seed, ichunk)
+                buf = _process_chunk(chunk, prng)
 
-    source_model.set_pv(p_fields, v_fields, le, re, dw, c, ds.periodicity, observer)
+                if buf is not None:
+                    yield buf
 
-    f = h5py.File(photon_file, "w")
+        else:
 
-    # Info
-    info = f.create_group("info")
-    info.attrs["yt_version"] = yt_version
-    info.attrs["pyxsim_version"] = pyxsim_version
-    info.attrs["soxs_version"] = soxs_version
-    info.attrs["dataset"] = str(data_source.ds)
-    info.attrs["data_source"] = str(data_source)
-    info.attrs["source_model"] = repr(source_model)
+            read_fields = source_model.get_chunk_fields()
+            if read_fields is None:
+                raise RuntimeError(
+                    f"{type(source_model).__name__} does not support generating "
+                    f"photons with 'n_threads'!"
+                )
+            read_fields += list(self.p_fields) + list(self.v_fields)
+            read_fields += self.fields_store
+            if self.w_field is not None:
+                read_fields.append(self.w_field)
+            read_fields = list(dict.fromkeys(read_fields))
+
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                for ichunk, chunk in chunks:
+
+                    if source_model.skip_chunk(ichunk):
+                        continue
+
+                    # yt reuses the same object for every chunk, so the fields
+                    # are read here before the chunk is handed off to a thread
+                    fields = {field: chunk[field] for field in read_fields}
+                    pending.append(
+                        executor.submit(
+                            _process_chunk, fields, chunk_prng(seed, ichunk)
+                        )
+                    )
 
-    # Parameters
+                    # Hand the chunks on in order, and limit the number of
+                    # them which are held in memory at once
+                    while len(pending) > 2 * n_threads:
+                        buf = pending.popleft().result()
+                        if buf is not None:
+                            yield buf
 
-    p = f.create_group("parameters")
-    p.create_dataset("fid_area", data=float(parameters["fid_area"]))
-    p.create_dataset("fid_exp_time", data=float(parameters["fid_exp_time"]))
-    p.create_dataset("fid_redshift", data=parameters["fid_redshift"])
-    p.create_dataset("hubble", data=parameters["hubble"])
-    p.create_dataset("omega_matter", data=parameters["omega_matter"])
-    p.create_dataset("omega_lambda", data=parameters["omega_lambda"])
-    p.create_dataset("fid_d_a", data=float(parameters["fid_d_a"]))
-    p.create_dataset("data_type", data=parameters["data_type"])
-    p.create_dataset("observer", data=parameters["observer"])
-    p.create_dataset("center", data=parameters["center"].d)
-    p.create_dataset("bulk_velocity", data=parameters["bulk_velocity"].d)
-    p.create_dataset("velocity_fields", data=np.array(v_fields).astype("S"))
-
-    n_cells = 0
-    n_photons = 0
-    c_offset = 0
-    p_offset = 0
-    c_size = init_chunk
-    p_size = init_chunk
+                while len(pending) > 0:
+                    buf = pending.popleft().result()
+                    if buf is not None:
+                        yield buf
 
-    cell_fields = ["x", "y", "z", "vx", "vy", "vz", "num_photons", "dx"]
-    if len(fields_store) > 0:
-        for field in fields_store:
-            cell_fields.append(field[1])
+    def cleanup(self):
+        self.source_model.cleanup_model("photons")
 
-    d = f.create_group("data")
-    for field in cell_fields + ["energy"]:
-        if field == "num_photons":
-            dtype = "int64"
-        else:
-            dtype = "float64"
-        d.create_dataset(
-            field,
-            data=np.zeros(init_chunk, dtype=dtype),
-            maxshape=(None,),
-            dtype=dtype,
-            chunks=True,
-        )
 
-    f.flush()
+def _make_photons(
+    photon_file,
+    data_source,
+    redshift,
+    area,
+    exp_time,
+    source_model,
+    point_sources=False,
+    parameters=None,
+    center=None,
+    dist=None,
+    cosmology=None,
+    velocity_fields=None,
+    bulk_velocity=None,
+    observer="external",
+    fields_to_keep=None,
+    write_queue_size=2,
+    flush_every=1,
+    estimate_counts=False,
+    n_threads=None,
+    storage_precision="float64",
+    storage_policy=None,
+    chunk_share=None,
+    seed=None,
+):
+    gen = _PhotonGenerator(
+        data_source,
+        redshift,
+        area,
+        exp_time,
+        source_model,
+        point_sources=point_sources,
+        parameters=parameters,
+        center=center,
+        dist=dist,
+        cosmology=cosmology,
+        velocity_fields=velocity_fields,
+        bulk_velocity=bulk_velocity,
+        observer=observer,
+        fields_to_keep=fields_to_keep,
+    )
 
-    for chunk in parallel_objects(data_source.chunks([], "io")):
+    energy_range = None
+    if storage_precision.startswith("uint"):
+        energy_range = source_model.photon_energy_range()
+    storage = StorageFormat(
+        storage_precision,
+        float_fields=["x", "y", "z", "vx", "vy", "vz", "dx"],
+        energy_field="energy",
+        energy_range=energy_range,
+    )
 
-        chunk_data = source_model.process_data("photons", chunk, spectral_norm)
+    f = h5py.File(photon_file, "w")
 
-        if chunk_data is not None:
+    # Info
+    gen.write_info(f.create_group("info"))
 
-            chunk_nc, number_of_photons, idxs, energies = chunk_data
+    # Parameters
 
-            chunk_nph = np.sum(number_of_photons)
+    p = f.create_group("parameters")
+    gen.write_parameters(p)
+    storage.write_parameters(p)
 
-            if chunk_nph == 0:
-                continue
+    cell_fields = ["x", "y", "z", "vx", "vy", "vz", "num_photons", "dx"]
+    if len(gen.fields_store) > 0:
+        for field in gen.fields_store:
+            cell_fields.append(field[1])
 
-            if c_size < n_cells + chunk_nc:
-                while chunk_nc + n_cells > c_size:
-                    c_size *= 2
-                for field in cell_fields:
-                    d[field].resize((c_size,))
+    cell_size = init_chunk
+    photon_size = init_chunk
+    cell_rows = None
+    photon_rows = None
+    estimate = None
+    if estimate_counts:
+        estimate = gen.estimate_counts()
+        if estimate is not None:
+            cell_size = presize(estimate[1])
+            photon_size = presize(estimate[0])
+            cell_rows = chunk_rows(cell_size)
+            photon_rows = chunk_rows(photon_size)
 
-            if p_size < n_photons + chunk_nph:
-                while chunk_nph + n_photons > p_size:
-                    p_size *= 2
-                d["energy"].resize((p_size,))
+    d = f.create_group("data")
+    cells = DatasetAppender(
+        d,
+        cell_fields,
+        dtypes={"num_photons": "int64", **storage.dtypes},
+        init_size=cell_size,
+        chunk_rows=cell_rows,
+        policy=storage_policy,
+    )
+    photons = DatasetAppender(
+        d,
+        ["energy"],
+        dtypes=storage.dtypes,
+        init_size=photon_size,
+        chunk_rows=photon_rows,
+        policy=storage_policy,
+    )
 
-            for i, ax in enumerate("xyz"):
-                pos = chunk[p_fields[i]][idxs].to_value("kpc")
-                # Fix photon coordinates for regions crossing a periodic boundary
-                if ds.periodicity[i]:
-                    tfl = pos < le[i]
-                    tfr = pos > re[i]
-                    pos[tfl] += dw[i]
-                    pos[tfr] -= dw[i]
+    f.flush()
 
-                vel = chunk[v_fields[i]][idxs].to_value("km/s")
-                # Coordinates are centered
-                d[ax][c_offset : c_offset + chunk_nc] = pos - c[i]
-                # Velocities have the bulk velocity subtracted off
-                d[f"v{ax}"][c_offset : c_offset + chunk_nc] = vel - bulk_velocity.v[i]
+    def _encode(buf):
+        cell_data, energies = buf
+        return storage.encode(cell_data), storage.encode({"energy": energies})
 
-            d["num_photons"][c_offset : c_offset + chunk_nc] = number_of_photons
-            d["energy"][p_offset : p_offset + chunk_nph] = energies
+    def _write_chunk(buf):
+        cell_data, photon_data = buf
+        cells.append(cell_data)
+        photons.append(photon_data)
 
-            if w_field is None:
-                d["dx"][c_offset : c_offset + chunk_nc] = 0.0
-            else:
-                d["dx"][c_offset : c_offset + chunk_nc] = chunk[w_field][idxs].to_value(
-                    "kpc"
-                )
+    writer = BackgroundWriter(
+        _write_chunk, f.flush, queue_size=write_queue_size, flush_every=flush_every
+    )
 
-            for field in fields_store:
-                d[field[1]][c_offset : c_offset + chunk_nc] = chunk[field][idxs]
+    for buf in gen.generate(
+        n_threads=n_threads, chunk_share=chunk_share, seed=seed, func=_encode
+    ):
+        # The write happens on a background thread, while we move on to
+        # the next chunk
+        writer.put(buf)
 
-            n_cells += chunk_nc
-            n_photons += chunk_nph
-            c_offset = n_cells
-            p_offset = n_photons
+    writer.close()
 
-        f.flush()
+    n_cells = cells.offset
+    n_photons = photons.offset
 
-    if c_size > n_cells:
-        for field in cell_fields:
-            d[field].resize((n_cells,))
+    if estimate is not None and photons.offset > photon_size:
+        mylog.info(
+            "The photon list outgrew its estimated size of %d photons.",
+            photon_size,
+        )
 
-    if p_size > n_photons:
-        d["energy"].resize((n_photons,))
+    cells.finalize()
+    photons.finalize()
 
     f.close()
 
-    source_model.cleanup_model("photons")
+    gen.cleanup()
 
     all_nphotons = comm.mpi_allreduce(n_photons)
     all_ncells = comm.mpi_allreduce(n_cells)
@@ -459,6 +824,66 @@ def make_photons(
     return all_nphotons, all_ncells
 
 
+def _make_photons_worker(worker, n_workers, photon_file, recipe, args, kwargs, seed):
+    data_source = recipe.load()
+    return _make_photons(
+        photon_file,
+        data_source,
+        *args,
+        **kwargs,
+        chunk_share=(worker, n_workers),
+        seed=seed,
+    )
+
+
+def _make_photons_pool(pool, load_func, photon_prefix, data_source, args, kwargs):
+    if comm.size > 1:
+        raise RuntimeError("A process pool cannot be used together with MPI!")
+    source_model = args[3]
+    recipe = DataSourceRecipe(data_source, load_func=load_func)
+    n_workers = pool_size(pool)
+    seed = draw_seed(source_model.prng)
+    # Build the chunk manifest here first, so that it is built and stored
+    # once rather than by every worker at the same time
+    fields = source_model.get_manifest_fields(data_source.ds)
+    if fields is not None:
+        get_chunk_manifest(data_source, fields)
+    photon_files = [f"{photon_prefix}.{i:04d}.h5" for i in range(n_workers)]
+    tasks = [
+        (i, n_workers, photon_files[i], recipe, args, kwargs, seed)
+        for i in range(n_workers)
+    ]
+    counts = pool_starmap(pool, _make_photons_worker, tasks)
+    merge_files(photon_files, f"{photon_prefix}.h5", overwrite=True, virtual=True)
+    n_photons = sum(n[0] for n in counts)
+    n_cells = sum(n[1] for n in counts)
+    mylog.info(
+        "Generated %d photons from %d cells/particles with %d workers.",
+        n_photons,
+        n_cells,
+        n_workers,
+    )
+    return n_photons, n_cells
+
+
+def _view_list(value, n_views, name):
+    # A list or 2D array of per-view values is split up across the views,
+    # whereas a single value (a string, None, or a vector of numbers) is
+    # shared by all of them
+    if isinstance(value, (list, tuple)) or (
+        isinstance(value, np.ndarray) and value.ndim == 2
+    ):
+        if len(value) > 0 and all(
+            v is None or isinstance(v, str) or np.ndim(v) > 0 for v in value
+        ):
+            if len(value) != n_views:
+                raise ValueError(
+                    f"Got {len(value)} values of '{name}' for {n_views} views!"
+                )
+            return list(value)
+    return [value] * n_views
+
+
 def _project_photons(
     obs,
     photon_prefix,
@@ -475,63 +900,339 @@ def _project_photons(
     kernel="top_hat",
     save_los=False,
     prng=None,
+    pool=None,
+    storage_precision=None,
+    storage_policy=None,
 ):
 
-    from yt.funcs import ensure_numpy_array
-
-    prng = parse_prng(prng)
-
     if photon_prefix.endswith(".h5"):
         photon_prefix = photon_prefix[:-3]
 
-    if event_prefix.endswith(".h5"):
-        event_prefix = event_prefix[:-3]
+    multi_view = not isinstance(event_prefix, str)
+    if multi_view:
+        event_prefixes = list(event_prefix)
+        if len(event_prefixes) == 0:
+            raise ValueError("At least one event prefix must be given!")
+    else:
+        event_prefixes = [event_prefix]
+    event_prefixes = [
+        prefix[:-3] if prefix.endswith(".h5") else prefix for prefix in event_prefixes
+    ]
+    if len(set(event_prefixes)) < len(event_prefixes):
+        raise ValueError("Each view must be written to a different event list!")
+    n_views = len(event_prefixes)
+
+    args = (
+        _view_list(normal, n_views, "normal"),
+        _view_list(sky_center, n_views, "sky_center"),
+        absorb_model,
+        nH,
+        abund_table,
+        no_shifting,
+        _view_list(north_vector, n_views, "north_vector"),
+        flat_sky,
+        sigma_pos,
+        kernel,
+        save_los,
+        storage_precision,
+        storage_policy,
+    )
 
-    if not isinstance(normal, str):
-        L = np.array(normal)
-        orient = Orientation(L, north_vector=north_vector)
-        x_hat = orient.unit_vectors[0]
-        y_hat = orient.unit_vectors[1]
-        z_hat = orient.unit_vectors[2]
-        north_vector = orient.north_vector
+    if pool is not None:
+        all_nevents = _project_photons_pool(
+            pool, obs, photon_prefix, event_prefixes, args, prng
+        )
     else:
-        x_hat = np.zeros(3)
-        y_hat = np.zeros(3)
-        z_hat = np.zeros(3)
-        north_vector = None
+        if comm.size > 1:
+            photon_file = f"{photon_prefix}.{comm.rank:04d}.h5"
+            event_files = [f"{prefix}.{comm.rank:04d}.h5" for prefix in event_prefixes]
+        else:
+            photon_file = f"{photon_prefix}.h5"
+            event_files = [f"{prefix}.h5" for prefix in event_prefixes]
+
+        n_events = _project_photon_file(obs, photon_file, event_files, *args, prng)
+
+        all_nevents = [comm.mpi_allreduce(n) for n in n_events]
+
+    for prefix, n in zip(event_prefixes, all_nevents):
+        if multi_view:
+            mylog.info("Detected %d events for %s.", n, prefix)
+        else:
+            mylog.info("Detected %d events.", n)
+
+    return all_nevents if multi_view else all_nevents[0]
+
+
+def _project_photons_pool(pool, obs, photon_prefix, event_prefixes, args, prng):
+    import os
+    from glob import glob
 
     if comm.size > 1:
-        photon_file = f"{photon_prefix}.{comm.rank:04d}.h5"
-        event_file = f"{event_prefix}.{comm.rank:04d}.h5"
-    else:
-        photon_file = f"{photon_prefix}.h5"
-        event_file = f"{event_prefix}.h5"
+        raise RuntimeError("A process pool cannot be used together with MPI!")
+    photon_files = sorted(glob(f"{photon_prefix}.[0-9][0-9][0-9][0-9].h5"))
+    if len(photon_files) == 0:
+        raise RuntimeError(
+            f"No photon lists written by the workers of a process pool, "
+            f"{photon_prefix}.XXXX.h5, were found!"
+        )
+    # Each worker's photon list gets its own stream of random numbers
+    seed = draw_seed(parse_prng(prng))
+    tasks = []
+    event_files = []
+    for photon_file in photon_files:
+        worker = int(photon_file[-7:-3])
+        worker_files = [f"{prefix}.{worker:04d}.h5" for prefix in event_prefixes]
+        # No event file is written for a photon list without photons, so
+        # remove any left over from before so it isn't merged in below
+        for event_file in worker_files:
+            if os.path.exists(event_file):
+                os.remove(event_file)
+        event_files.append(worker_files)
+        tasks.append((obs, photon_file, worker_files, *args, chunk_prng(seed, worker)))
+    n_events = np.sum(pool_starmap(pool, _project_photon_file, tasks), axis=0)
+    for i, prefix in enumerate(event_prefixes):
+        view_files = [files[i] for files in event_files if os.path.exists(files[i])]
+        if len(view_files) > 0:
+            merge_files(view_files, f"{prefix}.h5", overwrite=True, virtual=True)
+    return [int(n) for n in n_events]
+
+
+class _EventProjector:
+    """
+    Project photons from cells or particles onto the sky to make events,
+    applying Doppler shifts and foreground absorption.
+    """
 
-    sky_center = ensure_numpy_array(sky_center)
+    def __init__(
+        self,
+        observer,
+        data_type,
+        D_A,
+        normal,
+        sky_center,
+        absorb_model=None,
+        nH=None,
+        abund_table="angr",
+        no_shifting=False,
+        north_vector=None,
+        flat_sky=False,
+        sigma_pos=None,
+        kernel="top_hat",
+    ):
+        from yt.funcs import ensure_numpy_array
+
+        if observer == "internal" and isinstance(normal, str):
+            raise RuntimeError(
+                "Must specify a vector for 'normal' if you are "
+                "doing an 'internal' observation!"
+            )
 
-    scale_shift = -1.0 / clight.to_value("km/s")
-    scale_shift2 = scale_shift * scale_shift
+        if sigma_pos is not None and data_type == "particles":
+            raise RuntimeError(
+                "The 'smooth_positions' argument should "
+                "not be used with particle-based datasets!"
+            )
 
-    if isinstance(absorb_model, str):
-        if absorb_model not in absorb_models:
-            raise KeyError(f"{absorb_model} is not a known absorption model!")
-        absorb_model = absorb_models[absorb_model]
-    if absorb_model is not None:
+        if not isinstance(normal, str):
+            L = np.array(normal)
+            orient = Orientation(L, north_vector=north_vector)
+            self.x_hat = orient.unit_vectors[0]
+            self.y_hat = orient.unit_vectors[1]
+            self.z_hat = orient.unit_vectors[2]
+            north_vector = orient.north_vector
+            self.norm = normal
+        else:
+            self.x_hat = np.zeros(3)
+            self.y_hat = np.zeros(3)
+            self.z_hat = np.zeros(3)
+            north_vector = None
+            self.norm = "xyz".index(normal)
+
+        if isinstance(absorb_model, str):
+            if absorb_model not in absorb_models:
+                raise KeyError(f"{absorb_model} is not a known absorption model!")
+            absorb_model = absorb_models[absorb_model]
+        if absorb_model is not None:
+            if nH is None:
+                raise RuntimeError(
+                    "You specified an absorption model, but didn't "
+                    "specify a value for nH!"
+                )
+            absorb_model = absorb_model(nH, abund_table=abund_table)
+            if comm.rank == 0:
+                mylog.info(
+                    "Foreground galactic absorption: using the %s model and nH = %g.",
+                    absorb_model._name,
+                    nH,
+                )
         if nH is None:
-            raise RuntimeError(
-                "You specified an absorption model, but didn't "
-                "specify a value for nH!"
+            nH = 0.0
+
+        self.observer = observer
+        self.data_type = data_type
+        self.D_A = D_A
+        self.normal = normal
+        self.sky_center = ensure_numpy_array(sky_center)
+        self.absorb_model = absorb_model
+        self.nH = nH
+        self.abund_table = abund_table
+        self.no_shifting = no_shifting
+        self.north_vector = north_vector
+        self.flat_sky = flat_sky
+        self.sigma_pos = sigma_pos
+        self.kernel = kernel
+
+    def write_parameters(self, pe, exp_time, area):
+        abs_model_name = self.absorb_model._name if self.absorb_model else "none"
+        pe.create_dataset("exp_time", data=exp_time)
+        pe.create_dataset("area", data=area)
+        pe.create_dataset("sky_center", data=self.sky_center)
+        pe.create_dataset("observer", data=self.observer)
+        pe.create_dataset("no_shifting", data=int(self.no_shifting))
+        pe.create_dataset("flat_sky", data=int(self.flat_sky))
+        pe.create_dataset("normal", data=self.normal)
+        if self.north_vector is not None:
+            pe.create_dataset("north_vector", data=self.north_vector)
+        pe.create_dataset("absoption_model", data=abs_model_name)
+        if self.absorb_model is not None:
+            pe.create_dataset("nH", data=self.nH)
+            pe.create_dataset("abund_table", data=self.abund_table)
+        if self.sigma_pos is not None:
+            pe.create_dataset("sigma_pos", data=self.sigma_pos)
+        pe.create_dataset("kernel", data=self.kernel)
+
+    def event_storage(self, storage_precision, energy_range=None):
+        return StorageFormat(
+            storage_precision,
+            float_fields=["xsky", "ysky", "los"],
+            offsets={"xsky": self.sky_center[0], "ysky": self.sky_center[1]},
+            energy_field="eobs",
+            energy_range=energy_range,
+        )
+
+    def project(self, n_ph, x, y, z, dx, vx, vy, vz, eobs, prng):
+        """
+        Project the photons with energies *eobs* from cells or particles
+        with *n_ph* photons each, the positions *x*, *y*, *z* and widths
+        *dx* in kpc, and the velocities *vx*, *vy*, *vz* in km/s, which
+        are not used if there is no Doppler shifting. The arrays may be
+        modified in place. Returns a dict of the events, or None if no
+        events were detected.
+        """
+        sky_center = self.sky_center
+        x_hat, y_hat, z_hat = self.x_hat, self.y_hat, self.z_hat
+
+        if self.observer == "internal":
+            r = np.sqrt(x * x + y * y + z * z)
+        else:
+            r = None
+
+        if not self.no_shifting:
+            scale_shift = -1.0 / clight.to_value("km/s")
+            scale_shift2 = scale_shift * scale_shift
+            if self.observer == "internal":
+                vn = -(vx * x + vy * y + vz * z) / r
+            else:
+                if isinstance(self.normal, str):
+                    vn = {"x": vx, "y": vy, "z": vz}[self.normal]
+                else:
+                    vn = vx * z_hat[0] + vy * z_hat[1] + vz * z_hat[2]
+            v2 = vx * vx + vy * vy + vz * vz
+            doppler_shift(vn * scale_shift, v2 * scale_shift2, n_ph, eobs)
+
+        if self.absorb_model is None:
+            det = np.ones(eobs.size, dtype="bool")
+            num_det = eobs.size
+        else:
+            det = self.absorb_model.absorb_photons(eobs, prng=prng)
+            num_det = det.sum()
+
+        if num_det == 0:
+            return None
+
+        if self.observer == "external":
+
+            if self.data_type == "particles":
+                dx *= 0.5
+
+            xsky, ysky, los = scatter_events(
+                self.norm,
+                prng,
+                self.kernel,
+                self.data_type,
+                num_det,
+                det,
+                n_ph,
+                x,
+                y,
+                z,
+                dx,
+                x_hat,
+                y_hat,
+                z_hat,
             )
-        absorb_model = absorb_model(nH, abund_table=abund_table)
-        if comm.rank == 0:
-            mylog.info(
-                "Foreground galactic absorption: using the %s model and nH = %g.",
-                absorb_model._name,
-                nH,
+
+            if self.data_type == "cells" and self.sigma_pos is not None:
+                sigma = self.sigma_pos * np.repeat(dx, n_ph)[det]
+                xsky += sigma * prng.normal(loc=0.0, scale=1.0, size=num_det)
+                ysky += sigma * prng.normal(loc=0.0, scale=1.0, size=num_det)
+
+            xsky /= self.D_A
+            ysky /= self.D_A
+
+            if self.flat_sky:
+                xsky = sky_center[0] - np.rad2deg(xsky)
+                ysky = sky_center[1] + np.rad2deg(ysky)
+            else:
+                pixel_to_cel(xsky, ysky, sky_center)
+
+        elif self.observer == "internal":
+
+            xsky, ysky, los = scatter_events_allsky(
+                self.data_type,
+                self.kernel,
+                prng,
+                num_det,
+                det,
+                n_ph,
+                x,
+                y,
+                z,
+                dx,
+                x_hat,
+                y_hat,
+                z_hat,
             )
-    abs_model_name = absorb_model._name if absorb_model else "none"
-    if nH is None:
-        nH = 0.0
+
+        return {"xsky": xsky, "ysky": ysky, "eobs": eobs[det], "los": los}
+
+
+def _project_photon_file(
+    obs,
+    photon_file,
+    event_files,
+    normals,
+    sky_centers,
+    absorb_model,
+    nH,
+    abund_table,
+    no_shifting,
+    north_vectors,
+    flat_sky,
+    sigma_pos,
+    kernel,
+    save_los,
+    storage_precision,
+    storage_policy,
+    prng,
+):
+    # Project the photons in one photon list for each of the views given
+    # by the lists *normals*, *sky_centers*, and *north_vectors* into the
+    # corresponding *event_files*. Each block of cells is read only once
+    # and then projected for every view, one after the other, drawing from
+    # the same *prng*.
+
+    prng = parse_prng(prng)
 
     f = h5py.File(photon_file, "r")
 
@@ -549,74 +1250,87 @@ def _project_photons(
             f"does not work with '{observer}' photon lists!"
         )
 
-    if observer == "internal" and isinstance(normal, str):
-        raise RuntimeError(
-            "Must specify a vector for 'normal' if you are "
-            "doing an 'internal' observation!"
-        )
-
-    if sigma_pos is not None and data_type == "particles":
-        raise RuntimeError(
-            "The 'smooth_positions' argument should "
-            "not be used with particle-based datasets!"
+    projectors = [
+        _EventProjector(
+            observer,
+            data_type,
+            p["fid_d_a"][()] * 1.0e3,
+            normal,
+            sky_center,
+            absorb_model=absorb_model,
+            nH=nH,
+            abund_table=abund_table,
+            no_shifting=no_shifting,
+            north_vector=north_vector,
+            flat_sky=flat_sky,
+            sigma_pos=sigma_pos,
+            kernel=kernel,
         )
+        for normal, sky_center, north_vector in zip(normals, sky_centers, north_vectors)
+    ]
+    n_views = len(projectors)
 
     d = f["data"]
+    pstorage = StorageFormat.from_parameters(p)
 
-    D_A = p["fid_d_a"][()] * 1.0e3
+    n_events = [0] * n_views
 
     if d["energy"].size == 0:
 
         mylog.warning("No photons are in file %s, so I am done.", photon_file)
-        n_events = 0
 
     else:
 
-        fe = h5py.File(event_file, "w")
-
-        ie = fe.create_group("info")
-        ie.attrs["pyxsim_version"] = pyxsim_version
-        ie.attrs["yt_version"] = yt_version
-        ie.attrs["soxs_version"] = soxs_version
-        ie.attrs["photon_file"] = photon_file
-
-        pe = fe.create_group("parameters")
-        pe.create_dataset("exp_time", data=float(p["fid_exp_time"][()]))
-        pe.create_dataset("area", data=float(p["fid_area"][()]))
-        pe.create_dataset("sky_center", data=sky_center)
-        pe.create_dataset("observer", data=observer)
-        pe.create_dataset("no_shifting", data=int(no_shifting))
-        pe.create_dataset("flat_sky", data=int(flat_sky))
-        pe.create_dataset("normal", data=normal)
-        if north_vector is not None:
-            pe.create_dataset("north_vector", data=north_vector)
-        pe.create_dataset("absoption_model", data=abs_model_name)
-        if absorb_model is not None:
-            pe.create_dataset("nH", data=nH)
-            pe.create_dataset("abund_table", data=abund_table)
-        if sigma_pos is not None:
-            pe.create_dataset("sigma_pos", data=sigma_pos)
-        pe.create_dataset("kernel", data=kernel)
         event_fields = ["xsky", "ysky", "eobs"]
         if save_los:
             event_fields.append("los")
 
-        n_events = 0
-        e_offset = 0
-        e_size = init_chunk
-        cell_chunk = init_chunk
-        start_e = 0
+        if storage_precision is None:
+            storage_precision = pstorage.precision
+        energy_range = None
+        if storage_precision.startswith("uint"):
+            energy_range = _event_energy_range(d, pstorage, no_shifting)
+
+        # Every photon yields at most one event, so the number of
+        # photons bounds the size of the event list
+        n_photons = d["energy"].size
+
+        event_handles = []
+        storages = []
+        appenders = []
+        for projector, event_file in zip(projectors, event_files):
 
-        de = fe.create_group("data")
-        for field in event_fields:
-            de.create_dataset(
-                field, data=np.zeros(init_chunk), maxshape=(None,), chunks=True
+            fe = h5py.File(event_file, "w")
+
+            ie = fe.create_group("info")
+            ie.attrs["pyxsim_version"] = pyxsim_version
+            ie.attrs["yt_version"] = yt_version
+            ie.attrs["soxs_version"] = soxs_version
+            ie.attrs["photon_file"] = photon_file
+
+            pe = fe.create_group("parameters")
+            projector.write_parameters(
+                pe, float(p["fid_exp_time"][()]), float(p["fid_area"][()])
+            )
+            storage = projector.event_storage(storage_precision, energy_range)
+            storage.write_parameters(pe)
+
+            de = fe.create_group("data")
+            event_handles.append(fe)
+            storages.append(storage)
+            appenders.append(
+                DatasetAppender(
+                    de,
+                    event_fields,
+                    dtypes=storage.dtypes,
+                    init_size=n_photons,
+                    chunk_rows=chunk_rows(n_photons),
+                    policy=storage_policy,
+                )
             )
 
-        if isinstance(normal, str):
-            norm = "xyz".index(normal)
-        else:
-            norm = normal
+        cell_chunk = init_chunk
+        start_e = 0
 
         n_cells = d["num_photons"].size
 
@@ -628,124 +1342,38 @@ def _project_photons(
 
             end_c = min(start_c + cell_chunk, n_cells)
 
-            n_ph = d["num_photons"][start_c:end_c]
-            x = d["x"][start_c:end_c]
-            y = d["y"][start_c:end_c]
-            z = d["z"][start_c:end_c]
-            dx = d["dx"][start_c:end_c]
+            cells = slice(start_c, end_c)
+            n_ph = d["num_photons"][cells]
+            x = pstorage.read_field(d, "x", cells)
+            y = pstorage.read_field(d, "y", cells)
+            z = pstorage.read_field(d, "z", cells)
+            dx = pstorage.read_field(d, "dx", cells)
             end_e = start_e + n_ph.sum()
-            eobs = d["energy"][start_e:end_e]
+            eobs = pstorage.read_field(d, "energy", slice(start_e, end_e))
 
-            if observer == "internal":
-                r = np.sqrt(x * x + y * y + z * z)
+            if no_shifting:
+                vx = vy = vz = None
             else:
-                r = None
-
-            if not no_shifting:
-                if observer == "internal":
-                    vn = (
-                        -(
-                            d["vx"][start_c:end_c] * x
-                            + d["vy"][start_c:end_c] * y
-                            + d["vz"][start_c:end_c] * z
-                        )
-                        / r
-                    )
-                else:
-                    if isinstance(normal, str):
-                        vn = d[f"v{normal}"][start_c:end_c]
-                    else:
-                        vn = (
-                            d["vx"][start_c:end_c] * z_hat[0]
-                            + d["vy"][start_c:end_c] * z_hat[1]
-                            + d["vz"][start_c:end_c] * z_hat[2]
-                        )
-                v2 = (
-                    d["vx"][start_c:end_c] * d["vx"][start_c:end_c]
-                    + d["vy"][start_c:end_c] * d["vy"][start_c:end_c]
-                    + d["vz"][start_c:end_c] * d["vz"][start_c:end_c]
-                )
-                doppler_shift(vn * scale_shift, v2 * scale_shift2, n_ph, eobs)
+                vx = pstorage.read_field(d, "vx", cells)
+                vy = pstorage.read_field(d, "vy", cells)
+                vz = pstorage.read_field(d, "vz", cells)
 
-            if absorb_model is None:
-                det = np.ones(eobs.size, dtype="bool")
-                num_det = eobs.size
-            else:
-                det = absorb_model.absorb_photons(eobs, prng=prng)
-                num_det = det.sum()
-
-            if num_det > 0:
-
-                if observer == "external":
-
-                    if data_type == "particles":
-                        dx *= 0.5
-
-                    xsky, ysky, los = scatter_events(
-                        norm,
-                        prng,
-                        kernel,
-                        data_type,
-                        num_det,
-                        det,
-                        n_ph,
-                        x,
-                        y,
-                        z,
-                        dx,
-                        x_hat,
-                        y_hat,
-                        z_hat,
-                    )
+            for i, projector in enumerate(projectors):
 
-                    if data_type == "cells" and sigma_pos is not None:
-                        sigma = sigma_pos * np.repeat(dx, n_ph)[det]
-                        xsky += sigma * prng.normal(loc=0.0, scale=1.0, size=num_det)
-                        ysky += sigma * prng.normal(loc=0.0, scale=1.0, size=num_det)
-
-                    xsky /= D_A
-                    ysky /= D_A
-
-                    if flat_sky:
-                        xsky = sky_center[0] - np.rad2deg(xsky)
-                        ysky = sky_center[1] + np.rad2deg(ysky)
-                    else:
-                        pixel_to_cel(xsky, ysky, sky_center)
-
-                elif observer == "internal":
-
-                    xsky, ysky, los = scatter_events_allsky(
-                        data_type,
-                        kernel,
-                        prng,
-                        num_det,
-                        det,
-                        n_ph,
-                        x,
-                        y,
-                        z,
-                        dx,
-                        x_hat,
-                        y_hat,
-                        z_hat,
-                    )
+                # The energies and widths may be modified in place, so all
+                # but the last view get their own copies of them
+                if i < n_views - 1:
+                    args = (x, y, z, dx.copy(), vx, vy, vz, eobs.copy())
+                else:
+                    args = (x, y, z, dx, vx, vy, vz, eobs)
 
-                if e_size < n_events + num_det:
-                    while n_events + num_det > e_size:
-                        e_size *= 2
-                    for field in event_fields:
-                        de[field].resize((e_size,))
+                event_data = projector.project(n_ph, *args, prng)
 
-                de["xsky"][e_offset : e_offset + num_det] = xsky
-                de["ysky"][e_offset : e_offset + num_det] = ysky
-                de["eobs"][e_offset : e_offset + num_det] = eobs[det]
-                if save_los:
-                    de["los"][e_offset : e_offset + num_det] = los
+                if event_data is not None:
 
-                n_events += num_det
-                e_offset = n_events
+                    appenders[i].append(storages[i].encode(event_data))
 
-                f.flush()
+                    n_events[i] += event_data["eobs"].size
 
             pbar.update(end_c - start_c + 1)
 
@@ -753,19 +1381,41 @@ def _project_photons(
 
         pbar.close()
 
-        if e_size > n_events:
-            for field in event_fields:
-                de[field].resize((n_events,))
-
-        fe.close()
+        for events, fe in zip(appenders, event_handles):
+            events.finalize()
+            fe.close()
 
     f.close()
 
-    all_nevents = comm.mpi_allreduce(n_events)
+    return n_events
 
-    mylog.info("Detected %d events.", all_nevents)
 
-    return all_nevents
+def _event_energy_range(d, storage, no_shifting, block_size=1000000):
+    # The range of the energies of the photons, widened by the largest
+    # Doppler shift that they can be given
+    energy = d["energy"]
+    if "energy" in storage.scales:
+        emin = storage.offsets["energy"]
+        emax = emin + storage.scales["energy"] * np.iinfo(energy.dtype).max
+    else:
+        emin, emax = np.inf, -np.inf
+        for start in range(0, energy.size, block_size):
+            e = energy[start : start + block_size]
+            emin = min(emin, e.min())
+            emax = max(emax, e.max())
+    if not no_shifting:
+        n_cells = d["num_photons"].size
+        v2 = 0.0
+        for start in range(0, n_cells, block_size):
+            cells = slice(start, start + block_size)
+            v2 = max(
+                v2,
+                sum(storage.read_field(d, f"v{ax}", cells) ** 2 for ax in "xyz").max(),
+            )
+        beta = np.sqrt(v2) / clight.to_value("km/s")
+        emin *= np.sqrt((1.0 - beta) / (1.0 + beta))
+        emax *= np.sqrt((1.0 + beta) / (1.0 - beta))
+    return float(emin), float(emax)
 
 
 def project_photons(
@@ -783,6 +1433,9 @@ def project_photons(
     kernel="top_hat",
     save_los=False,
     prng=None,
+    pool=None,
+    storage_precision=None,
+    storage_policy=None,
 ):
     r"""
     Projects photons onto an image plane given a line of sight, and
@@ -794,16 +1447,22 @@ def project_photons(
         The prefix of the filename(s) containing the photon list. If run in
         serial, the filename will be "{photon_prefix}.h5", if run in
         parallel, the filenames will be "{photon_prefix}.{mpi_rank}.h5".
-    event_prefix : string
+    event_prefix : string or list of strings
         The prefix of the filename(s) which will be written to contain the
         event list. If run in serial, the filename will be "{event_prefix}.h5",
         if run in parallel, the filename will be "{event_prefix}.{mpi_rank}.h5".
+        If a list of prefixes is given, the photons are projected along
+        several lines of sight at once, one for each prefix, with each block
+        of photons read from the photon list only once.
     normal : character or array-like
         Normal vector to the plane of projection. If "x", "y", or "z", will
         assume to be along that axis (and will probably be faster). Otherwise,
-        should be an off-axis normal vector, e.g [1.0, 2.0, -3.0]
+        should be an off-axis normal vector, e.g [1.0, 2.0, -3.0]. If
+        *event_prefix* is a list, this may also be a list with a normal for
+        each of the views, e.g. ["x", "y", [1.0, 2.0, -3.0]].
     sky_center : array-like
-        Center RA, Dec of the events in degrees.
+        Center RA, Dec of the events in degrees. If *event_prefix* is a list,
+        this may also be a list with a center for each of the views.
     absorb_model : string
         A model for foreground galactic absorption, to simulate the
         absorption of events before being detected. Known options for
@@ -832,7 +1491,8 @@ def project_photons(
         orientation of the plane of projection. If not set, an arbitrary
         grid-aligned north_vector perpendicular to the normal is chosen.
         Ignored in the case where a particular axis (e.g., "x", "y", or
-        "z") is explicitly specified.
+        "z") is explicitly specified. If *event_prefix* is a list, this may
+        also be a list with a vector (or None) for each of the views.
     sigma_pos : float, optional
         Apply a gaussian smoothing operation to the sky positions of the
         events. This may be useful when the binned events appear blocky due
@@ -856,10 +1516,27 @@ def project_photons(
         if you have a reason to generate the same set of random numbers,
         such as for a test. Default is to use the :mod:`numpy.random`
         module.
+    pool : :class:`~concurrent.futures.ProcessPoolExecutor` or :class:`multiprocessing.pool.Pool`, optional
+        If set, the photon lists "{photon_prefix}.{worker:04d}.h5" written by
+        the workers of a process pool in :func:`~pyxsim.photon_list.make_photons`
+        are projected by the workers of this pool to the event lists
+        "{event_prefix}.{worker:04d}.h5". These are then combined into a
+        virtual event list in the file "{event_prefix}.h5" which refers to
+        them. This cannot be used together with MPI. Default: None
+    storage_precision : string, optional
+        The precision that the event list is stored at, one of "float64",
+        "float32", "uint16", or "uint32", as for
+        :func:`~pyxsim.photon_list.make_photons`. For all but "float64", the
+        sky positions are stored in single precision relative to the sky
+        center. If not set, the precision of the photon list is used.
+    storage_policy : :class:`~pyxsim.writers.StoragePolicy`, optional
+        The HDF5 chunk layout and compression of the event list. If not
+        set, the datasets are not compressed.
 
     Returns
     -------
-    A integer for the number of events created
+    A integer for the number of events created, or a list of them, one
+    for each view, if *event_prefix* is a list.
 
     Examples
     --------
@@ -867,6 +1544,12 @@ def project_photons(
     >>> n_events = pyxsim.project_photons("my_photons.h5", "my_events.h5", L,
     ...                                   [30., 45.], absorb_model='tbabs',
     ...                                   nH=0.04)
+
+    Project the same photons along the three axes of the simulation:
+
+    >>> n_events = pyxsim.project_photons("my_photons.h5",
+    ...                                   ["events_x", "events_y", "events_z"],
+    ...                                   ["x", "y", "z"], [30., 45.])
     """
     return _project_photons(
         "external",
@@ -884,6 +1567,9 @@ def project_photons(
         kernel=kernel,
         save_los=save_los,
         prng=prng,
+        pool=pool,
+        storage_precision=storage_precision,
+        storage_policy=storage_policy,
     )
 
 
@@ -899,6 +1585,9 @@ def project_photons_allsky(
     kernel="top_hat",
     save_los=False,
     prng=None,
+    pool=None,
+    storage_precision=None,
+    storage_policy=None,
 ):
     r"""
     Projects photons onto the sky sphere given a normal vector ("z" or "up" in
@@ -911,14 +1600,18 @@ def project_photons_allsky(
         The prefix of the filename(s) containing the photon list. If run in
         serial, the filename will be "{photon_prefix}.h5", if run in
         parallel, the filenames will be "{photon_prefix}.{mpi_rank}.h5".
-    event_prefix : string
+    event_prefix : string or list of strings
         The prefix of the filename(s) which will be written to contain the
         event list. If run in serial, the filename will be "{event_prefix}.h5",
         if run in parallel, the filename will be "{event_prefix}.{mpi_rank}.h5".
+        If a list of prefixes is given, the photons are projected along
+        several lines of sight at once, one for each prefix, with each block
+        of photons read from the photon list only once.
     normal : array-like
         The vector determining the "z" or "up" vector for the spherical coordinate
         system for the all-sky projection, something like [1.0, 2.0, -3.0]. It
-        will be normalized before use.
+        will be normalized before use. If *event_prefix* is a list, this may
+        also be a list with a vector for each of the views.
     absorb_model : string
         A model for foreground galactic absorption, to simulate the
         absorption of events before being detected. Known options are "wabs"
@@ -946,6 +1639,8 @@ def project_photons_allsky(
         A vector defining what direction will be placed at the center of
         the lat/lon coordinate system. If not set, an arbitrary
         grid-aligned center_vector perpendicular to the normal is chosen.
+        If *event_prefix* is a list, this may also be a list with a vector
+        (or None) for each of the views.
     kernel : string, optional
         The kernel used when smoothing positions of X-rays originating from
         SPH particles, "gaussian" or "top_hat". Default: "top_hat".
@@ -957,10 +1652,27 @@ def project_photons_allsky(
         if you have a reason to generate the same set of random numbers,
         such as for a test. Default is to use the :mod:`numpy.random`
         module.
+    pool : :class:`~concurrent.futures.ProcessPoolExecutor` or :class:`multiprocessing.pool.Pool`, optional
+        If set, the photon lists "{photon_prefix}.{worker:04d}.h5" written by
+        the workers of a process pool in :func:`~pyxsim.photon_list.make_photons`
+        are projected by the workers of this pool to the event lists
+        "{event_prefix}.{worker:04d}.h5". These are then combined into a
+        virtual event list in the file "{event_prefix}.h5" which refers to
+        them. This cannot be used together with MPI. Default: None
+    storage_precision : string, optional
+        The precision that the event list is stored at, one of "float64",
+        "float32", "uint16", or "uint32", as for
+        :func:`~pyxsim.photon_list.make_photons`. For all but "float64", the
+        sky positions are stored in single precision relative to the sky
+        center. If not set, the precision of the photon list is used.
+    storage_policy : :class:`~pyxsim.writers.StoragePolicy`, optional
+        The HDF5 chunk layout and compression of the event list. If not
+        set, the datasets are not compressed.
 
     Returns
     -------
-    A integer for the number of events created
+    A integer for the number of events created, or a list of them, one
+    for each view, if *event_prefix* is a list.
 
     Examples
     --------
@@ -981,8 +1693,343 @@ def project_photons_allsky(
         save_los=save_los,
         north_vector=center_vector,
         prng=prng,
+        pool=pool,
+        storage_precision=storage_precision,
+        storage_policy=storage_policy,
+    )
+
+
+def make_events(
+    event_prefix,
+    data_source,
+    redshift,
+    area,
+    exp_time,
+    source_model,
+    normal,
+    sky_center,
+    point_sources=False,
+    parameters=None,
+    center=None,
+    dist=None,
+    cosmology=None,
+    velocity_fields=None,
+    bulk_velocity=None,
+    observer="external",
+    absorb_model=None,
+    nH=None,
+    abund_table="angr",
+    no_shifting=False,
+    north_vector=None,
+    sigma_pos=None,
+    flat_sky=False,
+    kernel="top_hat",
+    save_los=False,
+    prng=None,
+    write_queue_size=2,
+    flush_every=1,
+    estimate_counts=False,
+    n_threads=None,
+    storage_precision="float64",
+    storage_policy=None,
+):
+    r"""
+    Generate photons from a yt data source and a source model and project
+    them onto the sky in a single pass, writing only the event list to
+    disk. This is equivalent to calling
+    :func:`~pyxsim.photon_list.make_photons` and then
+    :func:`~pyxsim.photon_list.project_photons` (or
+    :func:`~pyxsim.photon_list.project_photons_allsky` for an internal
+    observer) once, without writing and reading the photon list in between.
+    The events are not the same as those from the two separate steps, since
+    the random numbers are drawn in a different order.
+
+    Parameters
+    ----------
+    event_prefix : string
+        The prefix of the filename(s) which will be written to contain the
+        event list. If run in serial, the filename will be "{event_prefix}.h5",
+        if run in parallel, the filename will be "{event_prefix}.{mpi_rank}.h5".
+    data_source : :class:`~yt.data_objects.data_containers.YTSelectionContainer`
+        The data source from which the photons will be generated.
+    redshift : float
+        The cosmological redshift for the photons.
+    area : float, (value, unit) tuple, :class:`~yt.units.yt_array.YTQuantity`, or :class:`~astropy.units.Quantity`
+        The collecting area to determine the number of photons. If units are
+        not specified, it is assumed to be in cm^2.
+    exp_time : float, (value, unit) tuple, :class:`~yt.units.yt_array.YTQuantity`, or :class:`~astropy.units.Quantity`
+        The exposure time to determine the number of photons. If units are
+        not specified, it is assumed to be in seconds.
+    source_model : :class:`~pyxsim.source_models.sources.SourceModel`
+        A source model used to generate the photons.
+    normal : character or array-like
+        Normal vector to the plane of projection. If "x", "y", or "z", will
+        assume to be along that axis (and will probably be faster). Otherwise,
+        should be an off-axis normal vector, e.g [1.0, 2.0, -3.0]. For an
+        internal observer, this must be a vector, which sets the direction
+        of the lat = 0, lon = 0 point of the sky.
+    sky_center : array-like
+        Center RA, Dec of the events in degrees. Not used for an internal
+        observer.
+    point_sources : boolean, optional
+        If True, the photons will be assumed to be generated from the exact
+        positions of the cells or particles and not smeared around within
+        a volume. Default: False
+    parameters : dict, optional
+        A dictionary of parameters to be passed for the source model to use,
+        if necessary.
+    center : string or array_like, optional
+        The origin of the photon spatial coordinates. Accepts "c", "max", or
+        a coordinate. If array-like and without units, it is assumed to be in
+        units of kpc. If not specified, pyxsim attempts to use the "center"
+        field parameter of the data_source.
+    dist : float, (value, unit) tuple, :class:`~yt.units.yt_array.YTQuantity`, or :class:`~astropy.units.Quantity`, optional
+        The angular diameter distance, used for nearby sources. This may be
+        optionally supplied instead of it being determined from the
+        *redshift* and given *cosmology*. If units are not specified, it is
+        assumed to be in kpc. To use this, the redshift must be set to zero.
+    cosmology : :class:`~yt.utilities.cosmology.Cosmology`, optional
+        Cosmological information. If not supplied, we try to get the
+        cosmology from the dataset. Otherwise, LCDM with the default yt
+        parameters is assumed.
+    velocity_fields : list of fields
+        The yt fields to use for the velocity. If not specified, the
+        following will be assumed:
+        ['velocity_x', 'velocity_y', 'velocity_z'] for grid datasets
+        ['particle_velocity_x', 'particle_velocity_y', 'particle_velocity_z'] for particle datasets
+    bulk_velocity : array-like, optional
+        A 3-element array or list specifying the local velocity frame of
+        reference. If not a :class:`~yt.units.yt_array.YTArray`, it is assumed
+        to have units of km/s. Default: [0.0, 0.0, 0.0] km/s.
+    observer : string, optional
+        "external" or "internal". For an internal observer, the events are
+        spread over the whole sky in Galactic coordinates, and
+        *north_vector* sets the direction of the lat = 90 point of the sky.
+        Default: "external"
+    absorb_model : string
+        A model for foreground galactic absorption, to simulate the
+        absorption of events before being detected. Known options for
+        are "wabs" and "tbabs".
+    nH : float, optional
+        The foreground column density in units of 10^22 cm^{-2}. Only used
+        if absorption is applied.
+    abund_table : string
+        The abundance table to be used for abundances in the
+        absorption model (only used for TBabs). Default is set in the SOXS
+        configuration file, the default for which is "angr".
+        Built-in options are:
+        "angr" : from Anders E. & Grevesse N. (1989, Geochimica et
+        Cosmochimica Acta 53, 197)
+        "aspl" : from Asplund M., Grevesse N., Sauval A.J. & Scott
+        P. (2009, ARAA, 47, 481)
+        "feld" : from Feldman U. (1992, Physica Scripta, 46, 202)
+        "wilm" : from Wilms, Allen & McCray (2000, ApJ 542, 914
+        except for elements not listed which are given zero abundance)
+        "lodd" : from Lodders, K (2003, ApJ 591, 1220)
+        "cl17.03" : the default abundance table in Cloudy 17.03
+    no_shifting : boolean, optional
+        If set, the photon energies will not be Doppler shifted. Default: False
+    north_vector : a sequence of floats
+        A vector defining the "up" direction. This option sets the
+        orientation of the plane of projection. If not set, an arbitrary
+        grid-aligned north_vector perpendicular to the normal is chosen.
+        Ignored in the case where a particular axis (e.g., "x", "y", or
+        "z") is explicitly specified.
+    sigma_pos : float, optional
+        Apply a gaussian smoothing operation to the sky positions of the
+        events. This may be useful when the binned events appear blocky due
+        to their uniform distribution within simulation cells. However, this
+        will move the events away from their originating position on the
+        sky, and so may distort surface brightness profiles and/or spectra.
+        Should probably only be used for visualization purposes. Supply a
+        float here to smooth with a standard deviation with this fraction
+        of the cell size. Default: None
+    flat_sky : boolean, optional
+        If set, we assume that the sky is "flat" and RA, Dec positions are
+        computed using simple linear offsets
+    kernel : string, optional
+        The kernel used when smoothing positions of X-rays originating from
+        SPH particles, "gaussian" or "top_hat". Default: "top_hat".
+    save_los : boolean, optional
+        If True, save the line-of-sight positions along the projection axis in
+        units of kpc to the events list. Default: False
+    prng : integer or :class:`~numpy.random.RandomState` object
+        A pseudo-random number generator for the projection. The photons
+        are generated with the random number generator of the source
+        model. Default is to use the :mod:`numpy.random` module.
+    write_queue_size : integer, optional
+        The events from each chunk of the data source are written to disk on
+        a background thread while the next chunk is being processed. This sets
+        the maximum number of chunks which can be waiting to be written. If 0,
+        the events are written without using a background thread. Default: 2
+    flush_every : integer, optional
+        Flush the event list to disk after this many chunks have been
+        written. If None, it is only flushed when it is closed. Default: 1
+    estimate_counts : boolean, optional
+        If True, make a first pass over the data source which estimates the
+        number of photons from the band flux of the source model, and
+        allocate the event list datasets at that size up front instead of
+        growing them as events are detected. Default: False
+    n_threads : integer, optional
+        If set, the photons from the chunks of the data source are generated
+        in parallel by this many threads, and are projected in chunk order.
+        As for :func:`~pyxsim.photon_list.make_photons`, each chunk is then
+        given its own random number generator. Default: None
+    storage_precision : string, optional
+        The precision that the event list is stored at, one of "float64",
+        "float32", "uint16", or "uint32", as for
+        :func:`~pyxsim.photon_list.make_photons`. For all but "float64", the
+        sky positions are stored in single precision relative to the sky
+        center. Since the Doppler shifts of the photons are not known in
+        advance, the energies are only stored as integer codes if
+        *no_shifting* is True, and are otherwise stored in single precision.
+        Default: "float64"
+    storage_policy : :class:`~pyxsim.writers.StoragePolicy`, optional
+        The HDF5 chunk layout and compression of the event list. If not
+        set, the datasets are not compressed.
+
+    Returns
+    -------
+    A integer for the number of events created
+
+    Examples
+    --------
+    >>> thermal_model = pyxsim.CIESourceModel(0.1, 10.0, 1000, 0.3)
+    >>> sp = ds.sphere("c", (500., "kpc"))
+    >>> n_events = pyxsim.make_events("my_events", sp, 0.05, 6000.0, 2.0e5,
+    ...                               thermal_model, "z", [30., 45.],
+    ...                               absorb_model="tbabs", nH=0.04)
+    """
+    if event_prefix.endswith(".h5"):
+        event_prefix = event_prefix[:-3]
+
+    if comm.size > 1:
+        event_file = f"{event_prefix}.{comm.rank:04d}.h5"
+    else:
+        event_file = f"{event_prefix}.h5"
+
+    prng = parse_prng(prng)
+
+    if observer == "internal":
+        sky_center = [0.0, 0.0]
+
+    gen = _PhotonGenerator(
+        data_source,
+        redshift,
+        area,
+        exp_time,
+        source_model,
+        point_sources=point_sources,
+        parameters=parameters,
+        center=center,
+        dist=dist,
+        cosmology=cosmology,
+        velocity_fields=velocity_fields,
+        bulk_velocity=bulk_velocity,
+        observer=observer,
+    )
+
+    parameters = gen.parameters
+
+    projector = _EventProjector(
+        observer,
+        parameters["data_type"],
+        parameters["fid_d_a"].to_value("kpc"),
+        normal,
+        sky_center,
+        absorb_model=absorb_model,
+        nH=nH,
+        abund_table=abund_table,
+        no_shifting=no_shifting,
+        north_vector=north_vector,
+        flat_sky=flat_sky,
+        sigma_pos=sigma_pos,
+        kernel=kernel,
     )
 
+    energy_range = None
+    if storage_precision.startswith("uint"):
+        # The Doppler shifts are not known until the photons have been
+        # generated, so the range of the energies is only known without them
+        if no_shifting:
+            energy_range = source_model.photon_energy_range()
+    storage = projector.event_storage(storage_precision, energy_range)
+
+    fe = h5py.File(event_file, "w")
+
+    gen.write_info(fe.create_group("info"))
+
+    pe = fe.create_group("parameters")
+    projector.write_parameters(
+        pe, float(parameters["fid_exp_time"]), float(parameters["fid_area"])
+    )
+    storage.write_parameters(pe)
+
+    event_fields = ["xsky", "ysky", "eobs"]
+    if save_los:
+        event_fields.append("los")
+
+    event_size = init_chunk
+    event_rows = None
+    if estimate_counts:
+        estimate = gen.estimate_counts()
+        # Every photon yields at most one event
+        if estimate is not None:
+            event_size = presize(estimate[0])
+            event_rows = chunk_rows(event_size)
+
+    de = fe.create_group("data")
+    events = DatasetAppender(
+        de,
+        event_fields,
+        dtypes=storage.dtypes,
+        init_size=event_size,
+        chunk_rows=event_rows,
+        policy=storage_policy,
+    )
+
+    fe.flush()
+
+    writer = BackgroundWriter(
+        events.append, fe.flush, queue_size=write_queue_size, flush_every=flush_every
+    )
+
+    n_photons = 0
+    n_events = 0
+    for cell_data, energies in gen.generate(n_threads=n_threads):
+        n_photons += energies.size
+        event_data = projector.project(
+            cell_data["num_photons"],
+            cell_data["x"],
+            cell_data["y"],
+            cell_data["z"],
+            cell_data["dx"],
+            cell_data["vx"],
+            cell_data["vy"],
+            cell_data["vz"],
+            energies,
+            prng,
+        )
+        if event_data is not None:
+            n_events += event_data["eobs"].size
+            writer.put(storage.encode(event_data))
+
+    writer.close()
+
+    events.finalize()
+
+    fe.close()
+
+    gen.cleanup()
+
+    all_nphotons = comm.mpi_allreduce(n_photons)
+    all_nevents = comm.mpi_allreduce(n_events)
+
+    mylog.info("Number of photons generated: %d", all_nphotons)
+    mylog.info("Detected %d events.", all_nevents)
+
+    return all_nevents
+
 
 class PhotonList:
     def __init__(self, filespec):
@@ -1054,8 +2101,9 @@ class PhotonList:
 
         for fn in self.filenames:
             with h5py.File(fn, "r") as f:
-                d = f["data"]
-                spec += np.histogram(d["energy"][:], bins=ebins)[0]
+                storage = StorageFormat.from_parameters(f["parameters"])
+                energy = storage.read_field(f["data"], "energy")
+                spec += np.histogram(energy, bins=ebins)[0]
 
         col1 = fits.Column(
             name="CHANNEL", format="1J", array=np.arange(nchan).astype("int32") + 1
@@ -0,0 +1,96 @@
+"""
+Running photon generation and projection on a pool of processes
+"""
+import os
+
+from yt.data_objects.data_containers import YTDataContainer
+from yt.data_objects.static_output import _cached_datasets
+
+# Datasets which have been loaded by this (worker) process
+_loaded_datasets = {}
+
+
+def pool_size(pool):
+    """
+    The number of workers of a :class:`~concurrent.futures.ProcessPoolExecutor`
+    or a :class:`multiprocessing.pool.Pool`.
+    """
+    n = getattr(pool, "_max_workers", None) or getattr(pool, "_processes", None)
+    if n is None:
+        n = os.cpu_count()
+    return n
+
+
+def pool_starmap(pool, func, args):
+    """
+    Call *func* with each tuple of arguments in *args* on *pool*, which
+    may be a :class:`~concurrent.futures.Executor` or a
+    :class:`multiprocessing.pool.Pool`, and return the results in order.
+    """
+    if hasattr(pool, "starmap"):
+        return pool.starmap(func, args)
+    return list(pool.map(func, *zip(*args)))
+
+
+class DataSourceRecipe:
+    """
+    A picklable description of a yt data source, from which a worker
+    process can rebuild it. Workers which were forked from the process
+    which made the recipe use the dataset it already has open, and
+    other workers load the dataset from disk.
+
+    Parameters
+    ----------
+    data_source : :class:`~yt.data_objects.data_containers.YTSelectionContainer`
+        The data source to describe.
+    load_func : callable, optional
+        The function which workers use to load the dataset, given its
+        filename. It must be picklable, e.g. defined at the top level of
+        a module. This can be used to pass arguments to :func:`~yt.load`
+        or to add derived fields to the dataset. Default: :func:`~yt.load`
+    """
+
+    def __init__(self, data_source, load_func=None):
+        ds = data_source.ds
+        self.ds_hash = ds._hash()
+        self.filename = ds.parameter_filename
+        self.load_func = load_func
+        self.type_name = data_source._type_name
+        self.args = []
+        for name in data_source._con_args:
+            arg = getattr(data_source, name)
+            if isinstance(arg, YTDataContainer):
+                # e.g. the base object of a cut region
+                arg = DataSourceRecipe(arg, load_func=load_func)
+            self.args.append(arg)
+        self.field_parameters = data_source.field_parameters
+
+    def _get_ds(self):
+        for ds in _cached_datasets.values():
+            if ds._hash() == self.ds_hash:
+                return ds
+        if self.filename not in _loaded_datasets:
+            if not os.path.exists(self.filename):
+                raise RuntimeError(
+                    f"Cannot load the dataset {self.filename} in a worker "
+                    f"process, since it is not on disk!"
+                )
+            if self.load_func is None:
+                from yt import load as load_func
+            else:
+                load_func = self.load_func
+            _loaded_datasets[self.filename] = load_func(self.filename)
+        return _loaded_datasets[self.filename]
+
+    def load(self):
+        """
+        Rebuild the data source.
+        """
+        ds = self._get_ds()
+        args = [
+            arg.load() if isinstance(arg, DataSourceRecipe) else arg
+            for arg in self.args
+        ]
+        data_source = getattr(ds, self.type_name)(*args)
+        data_source.field_parameters.update(self.field_parameters)
+        return data_source
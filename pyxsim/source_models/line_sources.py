@@ -88,7 +88,7 @@ class LineSourceModel(SourceModel):
                 )
         self.ftype = self.emission_field[0]
         if mode == "spectrum":
-            self.setup_pbar(data_source, self.emission_field)
+            self.setup_pbar(data_source, [self.emission_field])
 
     def __repr__(self):
         rets = [
@@ -153,7 +153,36 @@ class LineSourceModel(SourceModel):
     def make_fluxf(self, emin, emax, energy=False):
         return {"emin": emin, "emax": emax}
 
-    def process_data(self, mode, chunk, spectral_norm, fluxf=None, ebins=None):
+    def make_photon_fluxf(self):
+        # The whole line, including its wings
+        return self.make_fluxf(
+            unyt_quantity(-np.inf, "keV"), unyt_quantity(np.inf, "keV")
+        )
+
+    def photon_energy_range(self):
+        # A broadened line has no bounds
+        if self.sigma is None:
+            return self.e0.v * self.scale_factor, self.e0.v * self.scale_factor
+        return None
+
+    def expected_photons(self, chunk, spectral_norm, fluxf):
+        F = self.process_data("photon_field", chunk, spectral_norm, fluxf=fluxf)
+        return np.ravel((F * spectral_norm * self.scale_factor).in_cgs().d)
+
+    def get_chunk_fields(self):
+        fields = [self.emission_field]
+        if self.sigma is not None and not isinstance(self.sigma, unyt_quantity):
+            fields.append(self.sigma)
+        if self.observer == "internal":
+            fields += list(self.p_fields)
+        return fields
+
+    def process_data(
+        self, mode, chunk, spectral_norm, fluxf=None, ebins=None, prng=None
+    ):
+
+        if prng is None:
+            prng = self.prng
 
         num_cells = len(chunk[self.emission_field])
 
@@ -172,13 +201,13 @@ class LineSourceModel(SourceModel):
                 r2 = self.compute_radius(pos)
                 F /= r2
 
-            number_of_photons = self.prng.poisson(lam=F.in_cgs().d)
+            number_of_photons = prng.poisson(lam=F.in_cgs().d)
 
             energies = self.e0 * np.ones(number_of_photons.sum())
 
             if isinstance(self.sigma, unyt_quantity):
                 dE = (
-                    self.prng.normal(
+                    prng.normal(
                         loc=0.0, scale=float(self.sigma), size=number_of_photons.sum()
                     )
                     * self.e0.uq
@@ -191,7 +220,7 @@ class LineSourceModel(SourceModel):
                     if number_of_photons[i] > 0:
                         end_e = start_e + number_of_photons[i]
                         dE = (
-                            self.prng.normal(
+                            prng.normal(
                                 loc=0.0,
                                 scale=float(sigma[i]),
                                 size=number_of_photons[i],
@@ -70,7 +70,7 @@ class PowerLawSourceModel(SourceModel):
                 )
         self.ftype = self.emission_field[0]
         if mode == "spectrum":
-            self.setup_pbar(data_source, self.emission_field)
+            self.setup_pbar(data_source, [self.emission_field])
 
     def __repr__(self):
         rets = [
@@ -137,7 +137,30 @@ class PowerLawSourceModel(SourceModel):
     def make_fluxf(self, emin, emax, energy=False):
         return {"emin": emin, "emax": emax}
 
-    def process_data(self, mode, chunk, spectral_norm, fluxf=None, ebins=None):
+    def make_photon_fluxf(self):
+        return self.make_fluxf(self.emin, self.emax)
+
+    def photon_energy_range(self):
+        return self.emin.v * self.scale_factor, self.emax.v * self.scale_factor
+
+    def expected_photons(self, chunk, spectral_norm, fluxf):
+        norm = super().expected_photons(chunk, spectral_norm, fluxf)
+        return norm * spectral_norm * self.scale_factor
+
+    def get_chunk_fields(self):
+        fields = [self.emission_field]
+        if not isinstance(self.alpha, Number):
+            fields.append(self.alpha)
+        if self.observer == "internal":
+            fields += list(self.p_fields)
+        return fields
+
+    def process_data(
+        self, mode, chunk, spectral_norm, fluxf=None, ebins=None, prng=None
+    ):
+
+        if prng is None:
+            prng = self.prng
 
         num_cells = len(chunk[self.emission_field])
 
@@ -176,7 +199,7 @@ class PowerLawSourceModel(SourceModel):
                     r2 = self.compute_radius(pos)
                     norm /= r2
 
-                number_of_photons = self.prng.poisson(lam=norm)
+                number_of_photons = prng.poisson(lam=norm)
 
                 energies = np.zeros(number_of_photons.sum())
 
@@ -185,7 +208,7 @@ class PowerLawSourceModel(SourceModel):
                 for i in range(num_cells):
                     if number_of_photons[i] > 0:
                         end_e = start_e + number_of_photons[i]
-                        u = self.prng.uniform(size=number_of_photons[i])
+                        u = prng.uniform(size=number_of_photons[i])
                         if alpha[i] == 1:
                             e = ei * (ef / ei) ** u
                         else:
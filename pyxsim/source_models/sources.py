@@ -5,17 +5,15 @@ from tqdm.auto import tqdm
 from unyt.array import unyt_quantity
 from yt.utilities.cosmology import Cosmology
 from yt.utilities.parallel_tools.parallel_analysis_interface import (
-    communication_system,
     parallel_capable,
     parallel_objects,
 )
 
+from pyxsim.chunk_manifest import get_chunk_manifest
 from pyxsim.utils import ParallelProgressBar, parse_value
 
 cm2_per_kpc2 = unyt_quantity(1.0, "kpc**2").to_value("cm**2")
 
-comm = communication_system.communicators[-1]
-
 
 class SourceModel:
     def __init__(self, prng=None):
@@ -23,18 +21,36 @@ class SourceModel:
         self.redshift = None
         self.prng = parse_prng(prng)
         self.observer = "external"
+        self.manifest = None
+
+    def __getstate__(self):
+        # Progress bars cannot be pickled, so source models are sent to
+        # other processes without them
+        state = self.__dict__.copy()
+        state["pbar"] = None
+        return state
 
-    def process_data(self, mode, chunk, spectral_norm, fluxf=None):
+    def process_data(self, mode, chunk, spectral_norm, fluxf=None, prng=None):
         # This needs to be implemented for every
         # source model specifically
         pass
 
-    def setup_pbar(self, data_source, field):
-        citer = data_source.chunks([], "io")
-        num_cells = 0
-        for chunk in parallel_objects(citer):
-            num_cells += chunk[field].size
-        self.tot_num_cells = comm.mpi_allreduce(num_cells)
+    def get_chunk_fields(self):
+        # Source models should return the fields that process_data reads
+        # from a chunk in "photons" mode, so that the chunk can be read
+        # ahead of being processed on another thread
+        return None
+
+    def get_manifest_fields(self, ds):
+        # Source models which build a chunk manifest when they are set up
+        # to make photons should return the fields that it records
+        return None
+
+    def setup_pbar(self, data_source, fields):
+        # The first field determines the number of cells or particles,
+        # the ranges of all of them are recorded in the chunk manifest
+        self.manifest = get_chunk_manifest(data_source, fields)
+        self.tot_num_cells = self.manifest.tot_num_cells
         if parallel_capable:
             self.pbar = ParallelProgressBar("Processing cells/particles ")
         else:
@@ -42,6 +58,12 @@ class SourceModel:
                 leave=True, total=self.tot_num_cells, desc="Processing cells/particles "
             )
 
+    def skip_chunk(self, ichunk):
+        # Source models which can determine from the chunk manifest
+        # that a chunk will not emit should override this, and update
+        # the progress bar for the skipped cells/particles
+        return False
+
     def setup_model(self, mode, data_source, redshift):
         # This needs to be implemented for every
         # source model specifically
@@ -76,6 +98,56 @@ class SourceModel:
         # source model specifically
         pass
 
+    def make_photon_fluxf(self):
+        # Source models which can estimate the number of photons they
+        # will generate should return the photon flux function over the
+        # whole energy range of the photons here
+        return None
+
+    def photon_energy_range(self):
+        # Source models whose photon energies are bounded should return
+        # the minimum and maximum energy in keV in the observer frame,
+        # after the model has been set up
+        return None
+
+    def expected_photons(self, chunk, spectral_norm, fluxf):
+        # The mean number of photons generated from each cell or particle
+        # in the chunk, for an external observer
+        return np.ravel(
+            self.process_data("photon_field", chunk, spectral_norm, fluxf=fluxf)
+        )
+
+    def estimate_photons(self, data_source, spectral_norm):
+        """
+        Estimate the number of photons which will be generated from
+        *data_source* and the number of cells or particles which will
+        have photons, from the band flux of the source over the energy
+        range of the photons. In parallel, these are estimates for the
+        chunks which are processed on this processor. Returns None if
+        the source model cannot make an estimate.
+        """
+        fluxf = self.make_photon_fluxf()
+        if fluxf is None:
+            return None
+        n_photons = 0.0
+        n_cells = 0.0
+        for chunk in parallel_objects(data_source.chunks([], "io")):
+            lam = self.expected_photons(chunk, spectral_norm, fluxf)
+            if lam.size == 0:
+                continue
+            if self.observer == "internal":
+                pos = np.array(
+                    [
+                        np.ravel(chunk[self.p_fields[i]].to_value("kpc"))
+                        for i in range(3)
+                    ]
+                )
+                lam = lam / self.compute_radius(pos)
+            n_photons += lam.sum()
+            # The probability that a cell or particle has any photons
+            n_cells += -np.expm1(-lam).sum()
+        return n_photons, n_cells
+
     def _make_dist_fac(self, ds, redshift, dist, cosmology, per_sa=False):
         if dist is None:
             if cosmology is None:
@@ -8,6 +8,7 @@ from unyt.array import unyt_quantity
 from yt.data_objects.static_output import Dataset
 from yt.utilities.exceptions import YTFieldNotFound
 
+from pyxsim.lib.spectra import alias_sample, alias_tables, invert_cdf, mixture_sample
 from pyxsim.source_models.sources import SourceModel
 from pyxsim.spectral_models import (
     CloudyCIESpectralModel,
@@ -15,7 +16,7 @@ from pyxsim.spectral_models import (
     MekalSpectralModel,
     TableCIEModel,
 )
-from pyxsim.utils import compute_H_abund, mylog, parse_value
+from pyxsim.utils import BufferPool, compute_H_abund, mylog, parse_value
 
 
 class ThermalSourceModel(SourceModel):
@@ -42,6 +43,9 @@ class ThermalSourceModel(SourceModel):
         h_fraction=None,
         nH_min=None,
         nH_max=None,
+        block_size=100,
+        max_memory=None,
+        counts_first=False,
     ):
         super().__init__(prng=prng)
         self.spectral_model = spectral_model
@@ -95,6 +99,21 @@ class ThermalSourceModel(SourceModel):
         self.bin_edges = np.log10(self.ebins) if self.binscale == "log" else self.ebins
         self.nbins = self.emid.size
         self.model_vers = self.spectral_model.model_vers
+        if block_size != "auto" and int(block_size) < 1:
+            raise ValueError(f"Invalid block size {block_size}!")
+        self.block_size = block_size
+        self.max_memory = max_memory
+        self.counts_first = counts_first
+        self._count_fluxf = None
+        self._spectrum_weights = None
+        self._pool = BufferPool()
+
+    def __getstate__(self):
+        # The flux function cannot be pickled, so it is made again
+        # by the processes which the source model is sent to
+        state = super().__getstate__()
+        state["_count_fluxf"] = None
+        return state
 
     def _prep_repr(self):
         class_name = self.__class__.__name__
@@ -114,6 +133,8 @@ class ThermalSourceModel(SourceModel):
             "abund_table": self.abund_table,
             "h_fraction": self.h_fraction,
             "var_elem": self.var_elem,
+            "block_size": self.block_size,
+            "counts_first": self.counts_first,
         }
         return class_name, strs
 
@@ -201,8 +222,29 @@ class ThermalSourceModel(SourceModel):
         if self.nh_field is not None:
             mylog.info("Using nH field '%s'.", self.nh_field)
         self.spectral_model.prepare_spectrum(redshift)
+        if mode == "photons" and self.method == "mixture":
+            if self._density_dependence:
+                raise RuntimeError(
+                    f"The 'mixture' method is not supported by "
+                    f"{type(self).__name__}!"
+                )
+            self._node_sums, self._node_cdfs = self.spectral_model.si.node_cdfs()
+        self._count_fluxf = None
+        if mode == "photons" and self.counts_first and self.method != "mixture":
+            self._count_fluxf = self.make_photon_fluxf()
+        self._windows = None
+        if not self._density_dependence:
+            self._windows = self.spectral_model.si.windows
+        self._spectrum_weights = None
+        if mode == "spectrum" and not self._density_dependence:
+            si = self.spectral_model.si
+            # Spectra which are never clipped can be summed from the
+            # weights of the nodes of the table
+            if si.is_non_negative():
+                num_comps = 2 + (si.var_spec.shape[0] if si.do_var else 0)
+                self._spectrum_weights = np.zeros((num_comps, si.tbins.size))
         if mode in ["photons", "spectrum"]:
-            self.setup_pbar(data_source, self.temperature_field)
+            self.setup_pbar(data_source, self.get_manifest_fields(ds))
 
     def make_spectrum(
         self, data_source, emin, emax, nbins, redshift=0.0, dist=None, cosmology=None
@@ -241,11 +283,18 @@ class ThermalSourceModel(SourceModel):
         """
         self.setup_model("spectrum", data_source, redshift)
         spectral_norm = 1.0
-        spec = np.zeros(nbins)
+        spec = np.zeros(self.nbins)
         ebins = np.linspace(emin, emax, nbins + 1)
-        for chunk in data_source.chunks([], "io"):
+        for ichunk, chunk in enumerate(data_source.chunks([], "io")):
+            if self.skip_chunk(ichunk):
+                continue
             s = self.process_data("spectrum", chunk, spectral_norm)
-            spec += regrid_spectrum(ebins, self.ebins, s)
+            if s is not None:
+                spec += s
+        if self._spectrum_weights is not None:
+            spec += self.spectral_model.si.weighted_spectrum(self._spectrum_weights)
+        # Regridding is linear, so the spectrum is only regridded once
+        spec = regrid_spectrum(ebins, self.ebins, spec)
         spec /= np.diff(ebins)
         self.cleanup_model("spectrum")
         return self._make_spectrum(
@@ -255,7 +304,54 @@ class ThermalSourceModel(SourceModel):
     def make_fluxf(self, emin, emax, energy=False):
         return self.spectral_model.make_fluxf(emin, emax, energy=energy)
 
-    def process_data(self, mode, chunk, spectral_norm, fluxf=None):
+    def make_photon_fluxf(self):
+        # Photons are drawn from every bin of the spectrum
+        return self.make_fluxf(-np.inf, np.inf)
+
+    def photon_energy_range(self):
+        return self.ebins[0], self.ebins[-1]
+
+    def skip_chunk(self, ichunk):
+        if self.manifest is None:
+            return False
+        kT_lo, kT_hi = self.manifest.field_range(
+            ichunk, self.temperature_field, "keV", "thermal"
+        )
+        em_hi = self.manifest.field_range(ichunk, self.emission_measure_field)[1]
+        # No cells in this chunk are within the temperature bounds or
+        # have any emission, so we don't need to read it at all
+        skip = kT_hi < self.kT_min or kT_lo > self.kT_max or not em_hi > 0.0
+        if skip:
+            self.pbar.update(self.manifest.num_cells[ichunk])
+        return skip
+
+    def get_manifest_fields(self, ds):
+        return [
+            ds._get_field_info(self.temperature_field).name,
+            ds._get_field_info(self.emission_measure_field).name,
+        ]
+
+    def get_chunk_fields(self):
+        fields = [self.temperature_field, self.emission_measure_field]
+        if self.max_density is not None:
+            fields.append(self.density_field)
+        if self.nh_field is not None:
+            fields.append(self.nh_field)
+        if not isinstance(self.h_fraction, Number):
+            fields.append(self.h_fraction)
+        if not self._nei and not isinstance(self.Zmet, Number):
+            fields.append(self.Zmet)
+        for value in self.var_elem.values():
+            if not isinstance(value, Number):
+                fields.append(value)
+        if self.observer == "internal":
+            fields += list(self.p_fields)
+        return fields
+
+    def process_data(self, mode, chunk, spectral_norm, fluxf=None, prng=None):
+
+        if prng is None:
+            prng = self.prng
 
         spec = np.zeros(self.nbins)
 
@@ -345,77 +441,165 @@ class ThermalSourceModel(SourceModel):
             r2 = self.compute_radius(pos)
             cell_nrm /= r2
 
-        num_photons_max = 10000000
         number_of_photons = np.zeros(num_cells, dtype="int64")
-        energies = np.zeros(num_photons_max)
+        energies = self._pool.get("energies", (0,))
 
         start_e = 0
         end_e = 0
 
         idxs = np.where(cut)[0]
 
-        for ck in chunked(range(num_cells), 100):
+        if mode == "spectrum" and self._spectrum_weights is not None:
+            # Only the weights of the nodes of the table are summed for the
+            # cells within it, and the spectrum is made from them once all
+            # of the chunks have been processed. The spectra of the cells
+            # beyond the ends of the table are extrapolated and clipped, so
+            # they are still made cell by cell
+            inside = self._add_node_weights(kT, metalZ, elemZ, cell_nrm)
+            self.pbar.update(inside.sum())
+            outside = ~inside
+            num_cells = outside.sum()
+            if num_cells == 0:
+                return spec
+            kT, cell_nrm, metalZ, idxs = (
+                kT[outside],
+                cell_nrm[outside],
+                metalZ[outside],
+                idxs[outside],
+            )
+            if elemZ is not None:
+                elemZ = elemZ[:, outside]
+
+        cell_counts = None
+        if mode == "photons" and self.counts_first and self.method != "mixture":
+            # The numbers of photons are drawn first from the total fluxes
+            # of the cells, and then spectra are only made for the cells
+            # which have photons
+            cell_counts = self._count_photons(kT, nH, metalZ, elemZ, cell_nrm, prng)
+            active = cell_counts > 0
+            self.pbar.update(num_cells - active.sum())
+            num_cells = int(active.sum())
+            cell_counts = cell_counts[active]
+            kT, cell_nrm, metalZ, idxs = (
+                kT[active],
+                cell_nrm[active],
+                metalZ[active],
+                idxs[active],
+            )
+            if nH is not None:
+                nH = nH[active]
+            if elemZ is not None:
+                elemZ = elemZ[:, active]
+            number_of_photons = number_of_photons[active]
+
+        e_lo, e_hi = 0, self.nbins
+        windows = None
+        order = None
+        if mode == "spectrum" or (mode == "photons" and self.method != "mixture"):
+            windows = self._windows
+        if windows is not None:
+            # Cells with the same windows are put in the same blocks, so
+            # that the windows of the blocks are as small as possible
+            si = self.spectral_model.si
+            cell_lo, cell_hi = si.cell_windows(self.spectral_model._Tconv(kT))
+            order = np.lexsort((cell_hi, cell_lo))
+            cell_lo, cell_hi = cell_lo[order], cell_hi[order]
+            kT, cell_nrm, metalZ, idxs = (
+                kT[order],
+                cell_nrm[order],
+                metalZ[order],
+                idxs[order],
+            )
+            if elemZ is not None:
+                elemZ = elemZ[:, order]
+            if cell_counts is not None:
+                cell_counts = cell_counts[order]
+
+        for ck in chunked(range(num_cells), self._get_block_size()):
 
             ibegin = ck[0]
             iend = ck[-1] + 1
             nck = iend - ibegin
 
+            if windows is not None:
+                e_lo = cell_lo[ibegin:iend].min()
+                e_hi = cell_hi[ibegin:iend].max()
+
             cnm = cell_nrm[ibegin:iend]
 
             kTi = kT[ibegin:iend]
 
-            if mode in ["photons", "spectrum"]:
+            if mode == "photons" and self.method == "mixture":
 
-                if self._density_dependence:
-                    nHi = nH[ibegin:iend]
-                    cspec, mspec, vspec = self.spectral_model.get_spectrum(kTi, nHi)
-                else:
-                    cspec, mspec, vspec = self.spectral_model.get_spectrum(kTi)
+                cell_n, cell_e = self._mixture_photons(
+                    kTi,
+                    metalZ[ibegin:iend],
+                    None if elemZ is None else elemZ[:, ibegin:iend],
+                    cnm,
+                    prng,
+                )
+                number_of_photons[ibegin:iend] = cell_n
+                end_e += cell_e.size
+                energies = self._pool.get("energies", (end_e,), keep=start_e)
+                energies[start_e:end_e] = cell_e
+                start_e = end_e
 
-                tot_spec = cspec
-                tot_spec += metalZ[ibegin:iend, np.newaxis] * mspec
-                if self.num_var_elem > 0:
-                    tot_spec += np.sum(
-                        elemZ[:, ibegin:iend, np.newaxis] * vspec, axis=0
-                    )
-                np.clip(tot_spec, 0.0, None, out=tot_spec)
+                self.pbar.update(nck)
 
-                if mode == "photons":
+            elif mode in ["photons", "spectrum"]:
 
-                    spec_sum = tot_spec.sum(axis=-1)
-                    cell_norm = spec_sum * cnm
+                tot_spec, spec_sum, cp = self._total_spectrum(
+                    kTi,
+                    None if nH is None else nH[ibegin:iend],
+                    metalZ[ibegin:iend],
+                    None if elemZ is None else elemZ[:, ibegin:iend],
+                    e_lo,
+                    e_hi,
+                    mode == "photons" and self.method == "invert_cdf",
+                )
 
-                    cell_n = np.atleast_1d(self.prng.poisson(lam=cell_norm))
+                if mode == "photons":
+
+                    if cell_counts is None:
+                        cell_norm = spec_sum * cnm
+                        cell_n = np.atleast_1d(prng.poisson(lam=cell_norm))
+                    else:
+                        cell_n = cell_counts[ibegin:iend]
 
                     number_of_photons[ibegin:iend] = cell_n
                     end_e += int(cell_n.sum())
 
-                    norm_factor = 1.0 / spec_sum
-                    p = norm_factor[:, np.newaxis] * tot_spec
-                    cp = np.insert(np.cumsum(p, axis=-1), 0, 0.0, axis=1)
-                    ei = start_e
-                    for icell in range(nck):
-                        cn = cell_n[icell]
-                        if cn == 0:
-                            continue
-                        if self.method == "invert_cdf":
-                            randvec = self.prng.uniform(size=cn)
-                            randvec.sort()
-                            cell_e = np.interp(randvec, cp[icell, :], self.bin_edges)
-                        elif self.method == "accept_reject":
-                            eidxs = self.prng.choice(self.nbins, size=cn, p=p[icell, :])
-                            cell_e = self.emid[eidxs]
-                        while ei + cn > num_photons_max:
-                            num_photons_max *= 2
-                        if num_photons_max > energies.size:
-                            energies.resize(num_photons_max, refcheck=False)
-                        energies[ei : ei + cn] = cell_e
-                        ei += cn
+                    energies = self._pool.get("energies", (end_e,), keep=start_e)
+                    if self.method == "invert_cdf":
+                        # All of the photons of the block are drawn at once,
+                        # which gives the same random numbers as drawing
+                        # them cell by cell
+                        randvec = prng.uniform(size=end_e - start_e)
+                        energies[start_e:end_e] = invert_cdf(
+                            cp,
+                            self.bin_edges[e_lo : e_hi + 1],
+                            cell_n.astype("int64", copy=False),
+                            randvec,
+                        )
+                    elif self.method == "accept_reject":
+                        # Tables are only built for the cells with photons
+                        active = cell_n > 0
+                        prob, alias = alias_tables(
+                            tot_spec[active].astype("float64", copy=False)
+                        )
+                        randvec = prng.uniform(size=end_e - start_e)
+                        eidxs = alias_sample(
+                            prob,
+                            alias,
+                            cell_n[active].astype("int64", copy=False),
+                            randvec,
+                        )
+                        energies[start_e:end_e] = self.emid[e_lo + eidxs]
                     start_e = end_e
 
                 elif mode == "spectrum":
 
-                    spec += np.sum(tot_spec * cnm[:, np.newaxis], axis=0)
+                    spec[e_lo:e_hi] += np.sum(tot_spec * cnm[:, np.newaxis], axis=0)
 
                 self.pbar.update(nck)
 
@@ -435,10 +619,23 @@ class ThermalSourceModel(SourceModel):
                 ret[idxs[ibegin:iend]] = tot_flux * cnm
 
         if mode == "photons":
+            if order is None:
+                ee = energies[:end_e].copy()
+            else:
+                # The cells, and their photons, are put back in the order
+                # of the chunk, as they are without windows
+                inverse = np.argsort(order)
+                cell_n = number_of_photons[inverse]
+                starts = np.cumsum(number_of_photons) - number_of_photons
+                offsets = np.cumsum(cell_n) - cell_n
+                perm = np.repeat(starts[inverse] - offsets, cell_n)
+                perm += np.arange(end_e)
+                ee = energies[perm]
+                number_of_photons = cell_n
+                idxs = idxs[inverse]
             active_cells = number_of_photons > 0
             idxs = idxs[active_cells]
             ncells = idxs.size
-            ee = energies[:end_e].copy()
             if self.binscale == "log":
                 ee = 10**ee
             return ncells, number_of_photons[active_cells], idxs, ee
@@ -447,6 +644,125 @@ class ThermalSourceModel(SourceModel):
         else:
             return np.resize(ret, orig_shape)
 
+    def _get_block_size(self):
+        if self.block_size != "auto":
+            return int(self.block_size)
+        max_memory = self.max_memory
+        if max_memory is None:
+            max_memory = 268435456
+        if self._density_dependence:
+            # The spectra of each cell, plus the temporary arrays which are
+            # made while they are summed and sampled from
+            cell_bytes = 8 * self.nbins * (6 + 2 * self.num_var_elem)
+        else:
+            # Only the total spectrum of each cell is made, plus the CDF
+            # or alias tables and the temporary arrays made from it
+            cell_bytes = 8 * self.nbins * 5
+        return max(1, int(max_memory // cell_bytes))
+
+    def _total_spectrum(self, kT, nH, metalZ, elemZ, e_lo, e_hi, do_cdf):
+        # Get the total spectra of a block of cells in the bins from e_lo
+        # up to e_hi, their sums, and their normalized CDFs if do_cdf
+        num_cells = kT.size
+        num_bins = e_hi - e_lo
+        cdf = None
+        if do_cdf:
+            cdf = self._pool.get("cdf", (num_cells, num_bins + 1))
+        if not self._density_dependence:
+            # The spectra of the components are mixed as they are
+            # interpolated, so only the total spectra are ever stored
+            tot_spec = self._pool.get(
+                "tspec", (num_cells, num_bins), dtype=self.spectral_model.dtype
+            )
+            spec_sum = self.spectral_model.get_total_spectrum(
+                kT, metalZ, elemZ, tot_spec, cdf=cdf, window=(e_lo, e_hi)
+            )
+            return tot_spec, spec_sum, cdf
+        cspec, mspec, vspec = self.spectral_model.get_spectrum(kT, nH)
+        # The abundances are applied in the precision of the
+        # spectra, so that single precision spectra stay that way
+        dtype = cspec.dtype
+        tot_spec = cspec
+        mspec *= metalZ[:, np.newaxis].astype(dtype, copy=False)
+        tot_spec += mspec
+        if self.num_var_elem > 0:
+            vspec *= elemZ[:, :, np.newaxis].astype(dtype, copy=False)
+            tot_spec += np.sum(vspec, axis=0)
+        np.clip(tot_spec, 0.0, None, out=tot_spec)
+        spec_sum = tot_spec.sum(axis=-1, dtype="float64")
+        if do_cdf:
+            # The spectra are only needed for their CDFs, so they
+            # are normalized in place
+            norm_factor = 1.0 / spec_sum
+            p = np.multiply(norm_factor[:, np.newaxis], tot_spec, out=tot_spec)
+            cdf[:, 0] = 0.0
+            np.cumsum(p, axis=-1, dtype="float64", out=cdf[:, 1:])
+        return tot_spec, spec_sum, cdf
+
+    def _count_photons(self, kT, nH, metalZ, elemZ, cell_nrm, prng):
+        if self._count_fluxf is None:
+            self._count_fluxf = self.make_photon_fluxf()
+        if self._density_dependence:
+            cflux, mflux, vflux = self._count_fluxf(kT, nH)
+        else:
+            cflux, mflux, vflux = self._count_fluxf(kT)
+        tot_flux = cflux + metalZ * mflux
+        if self.num_var_elem > 0:
+            tot_flux += np.sum(elemZ * vflux, axis=0)
+        np.clip(tot_flux, 0.0, None, out=tot_flux)
+        return np.atleast_1d(prng.poisson(lam=tot_flux * cell_nrm))
+
+    def _add_node_weights(self, kT, metalZ, elemZ, cell_nrm):
+        # The spectrum of each cell is a sum of the spectra of the
+        # components of the table at two nodes, so the spectrum of all of
+        # the cells only depends on the sum of their weights at each node
+        si = self.spectral_model.si
+        t_vals = np.atleast_1d(self.spectral_model._Tconv(kT))
+        inside = (t_vals >= si.tbins[0]) & (t_vals <= si.tbins[-1])
+        x_i, xm, xp = si.node_weights(t_vals[inside])
+        num_nodes = si.tbins.size
+        coeffs = [np.ones(x_i.size), metalZ[inside]]
+        if elemZ is not None:
+            coeffs += list(elemZ[:, inside])
+        for k, coeff in enumerate(coeffs):
+            w = coeff * cell_nrm[inside]
+            self._spectrum_weights[k] += np.bincount(
+                x_i, weights=w * xm, minlength=num_nodes
+            )
+            self._spectrum_weights[k] += np.bincount(
+                x_i + 1, weights=w * xp, minlength=num_nodes
+            )
+        return inside
+
+    def _mixture_photons(self, kT, metalZ, elemZ, cell_nrm, prng):
+        # The spectrum of each cell is a mixture of the spectra of the
+        # components of the table at the two nodes that it is interpolated
+        # between, so the photons are drawn from these spectra directly
+        # without making the spectrum of the cell
+        si = self.spectral_model.si
+        x_i, xm, xp = si.node_weights(np.atleast_1d(self.spectral_model._Tconv(kT)))
+        num_comps = self._node_sums.shape[0]
+        coeffs = np.ones((kT.size, num_comps))
+        coeffs[:, 1] = metalZ
+        if elemZ is not None:
+            coeffs[:, 2:] = elemZ.T
+        weights = np.empty((kT.size, num_comps, 2))
+        weights[:, :, 0] = xm[:, np.newaxis] * coeffs * self._node_sums[:, x_i].T
+        weights[:, :, 1] = xp[:, np.newaxis] * coeffs * self._node_sums[:, x_i + 1].T
+        weights = weights.reshape(kT.size, 2 * num_comps)
+        cell_n = np.atleast_1d(prng.poisson(lam=weights.sum(axis=-1) * cell_nrm))
+        randvec = prng.uniform(size=2 * cell_n.sum())
+        cell_e = mixture_sample(
+            self._node_cdfs,
+            self.bin_edges,
+            cell_n.astype("int64", copy=False),
+            x_i,
+            weights,
+            si.tbins.size,
+            randvec,
+        )
+        return cell_n, cell_e
+
     def cleanup_model(self, mode):
         if mode in ["spectrum", "photons"]:
             self.pbar.close()
@@ -527,7 +843,8 @@ class IGMSourceModel(ThermalSourceModel):
     method : string, optional
         The method used to generate the photon energies from the spectrum:
         "invert_cdf": Invert the cumulative distribution function of the spectrum.
-        "accept_reject": Acceptance-rejection method using the spectrum.
+        "accept_reject": Draw the energies from the centers of the bins of
+        the spectrum, using alias tables built from it.
         The first method should be sufficient for most cases.
     model_vers : string, optional
         The version of the IGM tables to use in the calculations.
@@ -542,6 +859,36 @@ class IGMSourceModel(ThermalSourceModel):
         A pseudo-random number generator. Typically will only be specified
         if you have a reason to generate the same set of random numbers,
         such as for a test. Default is to use the :mod:`numpy.random` module.
+    block_size : integer or string, optional
+        The number of cells or particles whose spectra are computed at once
+        when generating photons. If "auto", it is chosen from the number of
+        bins and of variable elements so that the spectra of each block take
+        up about *max_memory* bytes. Default: 100
+    max_memory : integer, optional
+        The approximate memory in bytes used for the spectra of each block
+        of cells or particles if *block_size* is "auto". Default: 268435456
+        (256 MB)
+    dtype : string, optional
+        The precision of the spectral tables and of the spectra which are
+        interpolated from them, "float64" or "float32". Single precision
+        halves the memory which they take up, and the time which it takes
+        to interpolate them. Default: "float64"
+    counts_first : boolean, optional
+        If True, the number of photons from each cell or particle is drawn
+        first from its total flux, and then its spectrum is only made if
+        it has any photons. This is much faster when most of the cells or
+        particles have no photons, but draws different random numbers.
+        Default: False
+    max_redshift : float, optional
+        If set, the spectral tables are made once in the rest frame, for the
+        energies of the bins at all redshifts up to this one, and the tables
+        for each redshift that the source is set up at are rebinned from
+        them. This is much faster when the same source model is used at many
+        redshifts, such as for the slices of a light cone. Default: None,
+        which makes the tables for each redshift from the raw tables
+    interp_threads : integer, optional
+        The number of threads which interpolate the spectra of the cells
+        or particles in parallel, within each process. Default: 1
     """
 
     _nei = False
@@ -567,6 +914,12 @@ class IGMSourceModel(ThermalSourceModel):
         method="invert_cdf",
         model_vers="4_lo",
         prng=None,
+        block_size=100,
+        max_memory=None,
+        dtype="float64",
+        counts_first=False,
+        max_redshift=None,
+        interp_threads=1,
     ):
         var_elem_keys = list(var_elem.keys()) if var_elem else None
         spectral_model = IGMSpectralModel(
@@ -578,6 +931,9 @@ class IGMSourceModel(ThermalSourceModel):
             cxb_factor=cxb_factor,
             var_elem=var_elem_keys,
             model_vers=model_vers,
+            dtype=dtype,
+            max_redshift=max_redshift,
+            num_threads=interp_threads,
         )
         nH_min = 10 ** spectral_model.Dvals[0]
         nH_max = 10 ** spectral_model.Dvals[-1]
@@ -600,6 +956,9 @@ class IGMSourceModel(ThermalSourceModel):
             temperature_field=temperature_field,
             h_fraction=h_fraction,
             emission_measure_field=emission_measure_field,
+            block_size=block_size,
+            max_memory=max_memory,
+            counts_first=counts_first,
         )
         self.nh_field = nh_field
         self.resonant_scattering = resonant_scattering
@@ -666,7 +1025,13 @@ class CIESourceModel(ThermalSourceModel):
     method : string, optional
         The method used to generate the photon energies from the spectrum:
         "invert_cdf": Invert the cumulative distribution function of the spectrum.
-        "accept_reject": Acceptance-rejection method using the spectrum.
+        "accept_reject": Draw the energies from the centers of the bins of
+        the spectrum, using alias tables built from it.
+        "mixture": Draw the energies from the spectra at the two temperature
+        nodes of the table that the spectrum of each cell is interpolated
+        between, without making the spectrum of the cell. This gives the
+        same spectra as "invert_cdf", but is much faster when there are
+        many energy bins and few photons per cell.
         The first method should be sufficient for most cases.
     thermal_broad : boolean, optional
         Whether the spectral lines should be thermally
@@ -708,6 +1073,45 @@ class CIESourceModel(ThermalSourceModel):
         A pseudo-random number generator. Typically, will only be specified
         if you have a reason to generate the same set of random numbers,
         such as for a test. Default is to use the :mod:`numpy.random` module.
+    block_size : integer or string, optional
+        The number of cells or particles whose spectra are computed at once
+        when generating photons. If "auto", it is chosen from the number of
+        bins and of variable elements so that the spectra of each block take
+        up about *max_memory* bytes. Default: 100
+    max_memory : integer, optional
+        The approximate memory in bytes used for the spectra of each block
+        of cells or particles if *block_size* is "auto". Default: 268435456
+        (256 MB)
+    dtype : string, optional
+        The precision of the spectral tables and of the spectra which are
+        interpolated from them, "float64" or "float32". Single precision
+        halves the memory which they take up, and the time which it takes
+        to interpolate them. Default: "float64"
+    flux_tol : float, optional
+        If set, the energy window of the spectrum at each temperature node
+        of the table which holds all but this fraction of its flux, e.g.
+        1.0e-8, is found. The spectra of the cells or particles are then
+        only computed and sampled from within the windows of the nodes that
+        they are interpolated between, which is much faster for cool gas
+        over a broad band. Zero leaves out only the bins with no emission.
+        Default: None, which uses all of the bins
+    counts_first : boolean, optional
+        If True, the number of photons from each cell or particle is drawn
+        first from its total flux, and then its spectrum is only made if
+        it has any photons. This is much faster when most of the cells or
+        particles have no photons, but draws different random numbers.
+        Not used by the "mixture" method, which already does this.
+        Default: False
+    max_redshift : float, optional
+        If set, the spectral tables are made once in the rest frame, for the
+        energies of the bins at all redshifts up to this one, and the tables
+        for each redshift that the source is set up at are rebinned from
+        them. This is much faster when the same source model is used at many
+        redshifts, such as for the slices of a light cone. Default: None,
+        which makes the tables for each redshift from the raw tables
+    interp_threads : integer, optional
+        The number of threads which interpolate the spectra of the cells
+        or particles in parallel, within each process. Default: 1
 
     Examples
     --------
@@ -740,6 +1144,13 @@ class CIESourceModel(ThermalSourceModel):
         nolines=False,
         abund_table="angr",
         prng=None,
+        block_size=100,
+        max_memory=None,
+        dtype="float64",
+        flux_tol=None,
+        counts_first=False,
+        max_redshift=None,
+        interp_threads=1,
     ):
         var_elem_keys = list(var_elem.keys()) if var_elem else None
         if model in ["apec", "spex"]:
@@ -758,10 +1169,22 @@ class CIESourceModel(ThermalSourceModel):
                 nolines=nolines,
                 nei=self._nei,
                 abund_table=abund_table,
+                dtype=dtype,
+                flux_tol=flux_tol,
+                max_redshift=max_redshift,
+                num_threads=interp_threads,
             )
         elif model == "mekal":
             spectral_model = MekalSpectralModel(
-                emin, emax, nbins, binscale=binscale, var_elem=var_elem_keys
+                emin,
+                emax,
+                nbins,
+                binscale=binscale,
+                var_elem=var_elem_keys,
+                dtype=dtype,
+                flux_tol=flux_tol,
+                max_redshift=max_redshift,
+                num_threads=interp_threads,
             )
         elif model == "cloudy":
             if abund_table != "feld":
@@ -777,6 +1200,10 @@ class CIESourceModel(ThermalSourceModel):
                 binscale=binscale,
                 var_elem=var_elem_keys,
                 model_vers=model_vers,
+                dtype=dtype,
+                flux_tol=flux_tol,
+                max_redshift=max_redshift,
+                num_threads=interp_threads,
             )
         self.model = model
         super().__init__(
@@ -796,6 +1223,9 @@ class CIESourceModel(ThermalSourceModel):
             temperature_field=temperature_field,
             emission_measure_field=emission_measure_field,
             h_fraction=h_fraction,
+            block_size=block_size,
+            max_memory=max_memory,
+            counts_first=counts_first,
         )
         self.var_elem_keys = self.spectral_model.var_elem_names
         self.var_ion_keys = self.spectral_model.var_ion_names
@@ -859,7 +1289,13 @@ class NEISourceModel(CIESourceModel):
     method : string, optional
         The method used to generate the photon energies from the spectrum:
         "invert_cdf": Invert the cumulative distribution function of the spectrum.
-        "accept_reject": Acceptance-rejection method using the spectrum.
+        "accept_reject": Draw the energies from the centers of the bins of
+        the spectrum, using alias tables built from it.
+        "mixture": Draw the energies from the spectra at the two temperature
+        nodes of the table that the spectrum of each cell is interpolated
+        between, without making the spectrum of the cell. This gives the
+        same spectra as "invert_cdf", but is much faster when there are
+        many energy bins and few photons per cell.
         The first method should be sufficient for most cases.
     thermal_broad : boolean, optional
         Whether or not the spectral lines should be thermally
@@ -892,6 +1328,45 @@ class NEISourceModel(CIESourceModel):
         A pseudo-random number generator. Typically will only be specified
         if you have a reason to generate the same set of random numbers,
         such as for a test. Default is to use the :mod:`numpy.random` module.
+    block_size : integer or string, optional
+        The number of cells or particles whose spectra are computed at once
+        when generating photons. If "auto", it is chosen from the number of
+        bins and of variable elements so that the spectra of each block take
+        up about *max_memory* bytes. Default: 100
+    max_memory : integer, optional
+        The approximate memory in bytes used for the spectra of each block
+        of cells or particles if *block_size* is "auto". Default: 268435456
+        (256 MB)
+    dtype : string, optional
+        The precision of the spectral tables and of the spectra which are
+        interpolated from them, "float64" or "float32". Single precision
+        halves the memory which they take up, and the time which it takes
+        to interpolate them. Default: "float64"
+    flux_tol : float, optional
+        If set, the energy window of the spectrum at each temperature node
+        of the table which holds all but this fraction of its flux, e.g.
+        1.0e-8, is found. The spectra of the cells or particles are then
+        only computed and sampled from within the windows of the nodes that
+        they are interpolated between, which is much faster for cool gas
+        over a broad band. Zero leaves out only the bins with no emission.
+        Default: None, which uses all of the bins
+    counts_first : boolean, optional
+        If True, the number of photons from each cell or particle is drawn
+        first from its total flux, and then its spectrum is only made if
+        it has any photons. This is much faster when most of the cells or
+        particles have no photons, but draws different random numbers.
+        Not used by the "mixture" method, which already does this.
+        Default: False
+    max_redshift : float, optional
+        If set, the spectral tables are made once in the rest frame, for the
+        energies of the bins at all redshifts up to this one, and the tables
+        for each redshift that the source is set up at are rebinned from
+        them. This is much faster when the same source model is used at many
+        redshifts, such as for the slices of a light cone. Default: None,
+        which makes the tables for each redshift from the raw tables
+    interp_threads : integer, optional
+        The number of threads which interpolate the spectra of the cells
+        or particles in parallel, within each process. Default: 1
 
     Examples
     --------
@@ -934,6 +1409,13 @@ class NEISourceModel(CIESourceModel):
         nolines=False,
         abund_table="angr",
         prng=None,
+        block_size=100,
+        max_memory=None,
+        dtype="float64",
+        flux_tol=None,
+        counts_first=False,
+        max_redshift=None,
+        interp_threads=1,
     ):
         super().__init__(
             "apec",
@@ -956,6 +1438,13 @@ class NEISourceModel(CIESourceModel):
             nolines=nolines,
             abund_table=abund_table,
             prng=prng,
+            block_size=block_size,
+            max_memory=max_memory,
+            counts_first=counts_first,
+            dtype=dtype,
+            flux_tol=flux_tol,
+            max_redshift=max_redshift,
+            interp_threads=interp_threads,
         )
 
     def _prep_repr(self):
@@ -1,8 +1,9 @@
 """
 Photon emission and absoprtion models.
 """
+from functools import partial
+
 import numpy as np
-from scipy.interpolate import interp1d
 from soxs.constants import K_per_keV
 from soxs.spectra import get_tbabs_absorb, get_wabs_absorb
 from soxs.thermal_spectra import (
@@ -14,25 +15,95 @@ from soxs.thermal_spectra import (
 from soxs.utils import parse_prng, regrid_spectrum
 from yt.units.yt_array import YTArray, YTQuantity
 
-from pyxsim.lib.interpolate import interp1d_spec, interp2d_spec
+from pyxsim.lib.interpolate import (
+    grid_indices,
+    igm_cie_flux,
+    igm_cie_spec,
+    interp1d_flux,
+    interp1d_spec,
+    interp1d_tot_spec,
+    interp2d_spec,
+)
+from pyxsim.table_cache import get_tables
+
+# Band flux tables are shared by all of the spectral models with the same
+# tables, and by all of the fields and datasets that they are used for
+_band_flux_cache = {}
+
+
+def _grid_spacing(bins):
+    """
+    How the nodes *bins* of a table are spaced, so that the kernels can
+    compute the node below a value rather than search for it: 1 if they
+    are uniformly spaced, 2 if their logs are, and 0 otherwise, along with
+    the first node and the inverse of the spacing, of the logs for 2.
+    """
+    if bins.size > 2:
+        for kind, x in [(1, bins), (2, np.log(bins) if bins[0] > 0.0 else None)]:
+            if x is None:
+                continue
+            dx = np.diff(x)
+            if dx[0] > 0.0 and np.allclose(dx, dx[0], rtol=1.0e-6, atol=0.0):
+                return kind, x[0], (x.size - 1) / (x[-1] - x[0])
+    return 0, 0.0, 0.0
 
 
 class SpectralInterpolator1D:
-    def __init__(self, tbins, cosmic_spec, metal_spec, var_spec):
+    def __init__(
+        self, tbins, cosmic_spec, metal_spec, var_spec, flux_tol=None, num_threads=1
+    ):
         self.tbins = tbins.astype("float64")
-        self.cosmic_spec = cosmic_spec
-        self.metal_spec = metal_spec
+        self.t_grid = _grid_spacing(self.tbins)
+        self.num_threads = num_threads
+        self.cosmic_spec = np.ascontiguousarray(cosmic_spec)
+        self.metal_spec = np.ascontiguousarray(metal_spec)
         if var_spec is None:
-            self.var_spec = np.zeros((1, 1, 1))
+            self.var_spec = np.zeros((1, 1, 1), dtype=cosmic_spec.dtype)
             self.do_var = False
         else:
-            self.var_spec = var_spec
+            self.var_spec = np.ascontiguousarray(var_spec)
             self.do_var = True
+        if flux_tol is None:
+            self.windows = None
+        else:
+            self.windows = self._node_windows(flux_tol)
 
-    def __call__(self, t_vals):
-        x_i = (np.digitize(t_vals, self.tbins) - 1).astype("int32")
-        if np.any((x_i == -1) | (x_i == len(self.tbins) - 1)):
-            x_i = np.minimum(np.maximum(x_i, 0), len(self.tbins) - 2)
+    def _node_windows(self, flux_tol):
+        # The window of each node is the union of the windows of its
+        # components, each of which leaves out at most the fraction
+        # flux_tol of the component's flux, split between the two ends.
+        # So, no spectrum mixed from the components leaves out more.
+        tables = [self.cosmic_spec, self.metal_spec]
+        if self.do_var:
+            tables += list(self.var_spec)
+        num_nodes, nbins = self.cosmic_spec.shape
+        windows = np.zeros((num_nodes, 2), dtype="int64")
+        windows[:, 0] = nbins
+        for table in tables:
+            cflux = np.cumsum(np.abs(table), axis=-1, dtype="float64")
+            tot_flux = cflux[:, -1:]
+            lo = np.argmax(cflux > 0.5 * flux_tol * tot_flux, axis=-1)
+            hi = np.argmax(cflux >= (1.0 - 0.5 * flux_tol) * tot_flux, axis=-1) + 1
+            has_flux = tot_flux[:, 0] > 0.0
+            windows[has_flux, 0] = np.minimum(windows[has_flux, 0], lo[has_flux])
+            windows[has_flux, 1] = np.maximum(windows[has_flux, 1], hi[has_flux])
+        # Nodes without any emission get an empty window
+        np.minimum(windows[:, 0], windows[:, 1], out=windows[:, 0])
+        return windows
+
+    def node_indices(self, t_vals):
+        """
+        Get the indices of the lower of the two table nodes that the
+        spectra at *t_vals* are interpolated between.
+        """
+        return grid_indices(t_vals, self.tbins, *self.t_grid, self.num_threads)
+
+    def __call__(self, t_vals, out=None, window=None):
+        x_i = self.node_indices(t_vals)
+        if out is None:
+            out = (None, None, None)
+        if window is None:
+            window = (0, -1)
         c_vals, m_vals, v_vals = interp1d_spec(
             self.cosmic_spec,
             self.metal_spec,
@@ -41,30 +112,136 @@ class SpectralInterpolator1D:
             self.tbins,
             x_i,
             self.do_var,
+            *out,
+            *window,
+            num_threads=self.num_threads,
         )
         return c_vals, m_vals, v_vals
 
+    def total_spectrum(self, t_vals, metalZ, elemZ, out, cdf=None, window=None):
+        """
+        Interpolate the total spectra at *t_vals* of cells with metallicities
+        *metalZ* and variable element abundances *elemZ* into *out*, with
+        negative values set to zero, without making the spectra of the
+        components. The normalized CDFs of the spectra are written into
+        *cdf*, if it is given. Returns the sums of the spectra.
+        """
+        x_i = self.node_indices(t_vals)
+        if window is None:
+            window = (0, -1)
+        return interp1d_tot_spec(
+            self.cosmic_spec,
+            self.metal_spec,
+            self.var_spec,
+            t_vals,
+            self.tbins,
+            x_i,
+            metalZ.astype("float64", copy=False),
+            elemZ.astype("float64", copy=False) if self.do_var else None,
+            self.do_var,
+            out,
+            cdf,
+            *window,
+            num_threads=self.num_threads,
+        )
+
+    def cell_windows(self, t_vals):
+        """
+        Get the energy windows of the spectra at *t_vals*, which are
+        the unions of the windows of the two nodes that each spectrum
+        is interpolated between.
+        """
+        x_i = self.node_weights(t_vals)[0]
+        # Empty windows are left out of the unions
+        node_lo, node_hi = self.windows.T
+        empty = node_lo == node_hi
+        node_lo = np.where(empty, self.cosmic_spec.shape[-1], node_lo)
+        node_hi = np.where(empty, 0, node_hi)
+        lo = np.minimum(node_lo[x_i], node_lo[x_i + 1])
+        hi = np.maximum(node_hi[x_i], node_hi[x_i + 1])
+        return np.minimum(lo, hi), hi
+
+    def node_weights(self, t_vals):
+        """
+        Get the indices of the lower of the two table nodes that the
+        spectra at *t_vals* are interpolated between, and the weights of
+        the lower and upper nodes. Beyond the ends of the table the spectrum
+        of the nearest node is used.
+        """
+        x_i = self.node_indices(t_vals).astype("int64")
+        xp = (t_vals - self.tbins[x_i]) / (self.tbins[x_i + 1] - self.tbins[x_i])
+        np.clip(xp, 0.0, 1.0, out=xp)
+        return x_i, 1.0 - xp, xp
+
+    def is_non_negative(self):
+        """
+        Whether all of the spectra of the table are non-negative, so that
+        the spectra interpolated from them never need to be clipped.
+        """
+        tables = [self.cosmic_spec, self.metal_spec]
+        if self.do_var:
+            tables.append(self.var_spec)
+        return all(np.all(table >= 0.0) for table in tables)
+
+    def weighted_spectrum(self, weights):
+        """
+        Get the sum of the spectra of the components of the table at all
+        of the nodes, weighted by *weights*, which has a row for each
+        component, in the order cosmic, metal, and variable elements.
+        Since the spectra are interpolated linearly, this is the sum of the
+        spectra of any cells within the table whose interpolation weights
+        add up to these.
+        """
+        spec = weights[0] @ self.cosmic_spec.astype("float64", copy=False)
+        spec += weights[1] @ self.metal_spec.astype("float64", copy=False)
+        if self.do_var:
+            for k in range(self.var_spec.shape[0]):
+                spec += weights[2 + k] @ self.var_spec[k].astype("float64", copy=False)
+        return spec
+
+    def node_cdfs(self):
+        """
+        Get the total of each component of the table at each node, and the
+        cumulative distribution functions of their spectra over the edges
+        of the energy bins, with a row for each node of each component.
+        """
+        spec = [self.cosmic_spec[np.newaxis], self.metal_spec[np.newaxis]]
+        if self.do_var:
+            spec.append(self.var_spec)
+        spec = np.concatenate(spec)
+        if np.any(spec < 0.0):
+            raise RuntimeError(
+                "The spectra of this model cannot be sampled as mixtures "
+                "because some of them are negative!"
+            )
+        num_comps, num_nodes, nbins = spec.shape
+        sums = spec.sum(axis=-1, dtype="float64")
+        cdfs = np.zeros((num_comps, num_nodes, nbins + 1))
+        np.cumsum(spec, axis=-1, dtype="float64", out=cdfs[:, :, 1:])
+        has_emission = sums > 0.0
+        cdfs[has_emission] /= sums[has_emission][:, np.newaxis]
+        return sums, cdfs.reshape(num_comps * num_nodes, nbins + 1)
+
 
 class SpectralInterpolator2D:
-    def __init__(self, tbins, dbins, cosmic_spec, metal_spec, var_spec):
+    def __init__(self, tbins, dbins, cosmic_spec, metal_spec, var_spec, num_threads=1):
         self.tbins = tbins.astype("float64")
         self.dbins = dbins.astype("float64")
-        self.cosmic_spec = cosmic_spec
-        self.metal_spec = metal_spec
+        self.t_grid = _grid_spacing(self.tbins)
+        self.d_grid = _grid_spacing(self.dbins)
+        self.num_threads = num_threads
+        self.cosmic_spec = np.ascontiguousarray(cosmic_spec)
+        self.metal_spec = np.ascontiguousarray(metal_spec)
         if var_spec is None:
-            self.var_spec = np.zeros((1, 1, 1))
+            self.var_spec = np.zeros((1, 1, 1), dtype=cosmic_spec.dtype)
             self.do_var = False
         else:
-            self.var_spec = var_spec
+            self.var_spec = np.ascontiguousarray(var_spec)
             self.do_var = True
 
     def __call__(self, t_vals, d_vals):
-        x_i = (np.digitize(t_vals, self.tbins) - 1).astype("int32")
-        if np.any((x_i == -1) | (x_i == len(self.tbins) - 1)):
-            x_i = np.minimum(np.maximum(x_i, 0), len(self.tbins) - 2)
-        y_i = (np.digitize(d_vals, self.dbins) - 1).astype("int32")
-        if np.any((y_i == -1) | (y_i == len(self.dbins) - 1)):
-            y_i = np.minimum(np.maximum(y_i, 0), len(self.dbins) - 2)
+        x_i = grid_indices(t_vals, self.tbins, *self.t_grid, self.num_threads)
+        y_i = grid_indices(d_vals, self.dbins, *self.d_grid, self.num_threads)
         c_vals, m_vals, v_vals = interp2d_spec(
             self.cosmic_spec,
             self.metal_spec,
@@ -76,12 +253,173 @@ class SpectralInterpolator2D:
             self.dbins,
             y_i,
             self.do_var,
+            num_threads=self.num_threads,
         )
         return c_vals, m_vals, v_vals
 
 
+def _parse_dtype(dtype):
+    dtype = np.dtype(dtype).name
+    if dtype not in ["float32", "float64"]:
+        raise ValueError(f"The spectral tables cannot be of type {dtype}!")
+    return dtype
+
+
+def _cast_table(table, dtype):
+    table = table.astype(dtype, copy=False)
+    if dtype == "float32":
+        # Values which are too small to be normal single precision numbers
+        # are set to zero, since computing with them is very slow
+        table[np.abs(table) < np.finfo(dtype).tiny] = 0.0
+    return table
+
+
+def _abund_key(abund_table):
+    if isinstance(abund_table, str):
+        return abund_table
+    return tuple(np.asarray(abund_table, dtype="float64"))
+
+
+def _rest_frame_grid(emin, emax, nbins, binscale, max_redshift, oversample):
+    # A grid of bins *oversample* times finer than those from *emin* to
+    # *emax*, which covers their rest-frame energies up to *max_redshift*
+    if binscale == "log":
+        dx = np.log(emax / emin) / (nbins * oversample)
+        nrest = int(np.ceil(np.log(emax * (1.0 + max_redshift) / emin) / dx))
+        return emin, emin * np.exp(nrest * dx), nrest
+    else:
+        dx = (emax - emin) / (nbins * oversample)
+        nrest = int(np.ceil((emax * (1.0 + max_redshift) - emin) / dx))
+        return emin, emin + nrest * dx, nrest
+
+
+def _rebin_tables(tables, rest_ebins, ebins):
+    """
+    Rebin the spectral *tables*, with bin edges *rest_ebins*, to the bins
+    with edges *ebins*, assuming that the emission is spread uniformly
+    across each of the original bins.
+    """
+    # The bin of the tables that each new edge falls in, and how far
+    # across the bin it is
+    idxs = np.searchsorted(rest_ebins, ebins, side="right") - 1
+    idxs = np.clip(idxs, 0, rest_ebins.size - 2)
+    frac = (ebins - rest_ebins[idxs]) / (rest_ebins[idxs + 1] - rest_ebins[idxs])
+    frac = np.clip(frac, 0.0, 1.0)
+    new_tables = []
+    for table in tables:
+        if table is None:
+            new_tables.append(None)
+            continue
+        # The emission in the whole bins from the bin of each edge up to
+        # that of the next edge, less the part of the first before the
+        # edge, plus the part of the last before the next edge. This is
+        # not a difference of cumulative sums, which would lose the faint
+        # bins to roundoff.
+        new_table = np.add.reduceat(table, idxs, axis=-1)[..., :-1]
+        new_table[..., idxs[1:] == idxs[:-1]] = 0.0
+        edge = frac * table[..., idxs]
+        new_table += edge[..., 1:]
+        new_table -= edge[..., :-1]
+        new_tables.append(new_table)
+    return new_tables
+
+
+class BandFluxTable:
+    """
+    The fluxes of the cosmic, metal, and variable element spectra of a
+    thermal model within a band, tabulated at the temperature nodes of
+    the model. Calling it with temperatures *kT* in keV interpolates the
+    fluxes linearly, in a compiled loop which releases the GIL, and
+    returns them as the cosmic, metal, and variable element fluxes. The
+    fluxes beyond the ends of the table are zero.
+    """
+
+    def __init__(self, Tvals, fluxes, do_var, logT):
+        self.Tvals = np.ascontiguousarray(Tvals, dtype="float64")
+        self.fluxes = np.ascontiguousarray(fluxes, dtype="float64")
+        self.do_var = do_var
+        self.logT = logT
+
+    def __call__(self, kT):
+        kT = np.asarray(kT, dtype="float64")
+        if self.logT:
+            kT = np.log10(kT * K_per_keV)
+        flux = interp1d_flux(self.fluxes, self.Tvals, np.ravel(kT))
+        flux = flux.reshape((-1,) + kT.shape)
+        vflux = flux[2:] if self.do_var else None
+        return flux[0], flux[1], vflux
+
+
+class IGMBandFluxTable:
+    """
+    The fluxes of the cosmic, metal, and variable element spectra of the
+    IGM model within a band, tabulated at the temperature and density
+    nodes of its table, along with the :class:`BandFluxTable` of its CIE
+    model. Calling it with temperatures *kT* in keV and hydrogen number
+    densities *nH* in cm**-3 interpolates the fluxes of each cell from the
+    IGM table, divided by the density, if it lies within *limits*, and
+    from the CIE table otherwise, in a single compiled loop.
+    """
+
+    def __init__(self, Tvals, Dvals, fluxes, cie_fluxf, limits, do_var):
+        self.Tvals = np.ascontiguousarray(Tvals, dtype="float64")
+        self.Dvals = np.ascontiguousarray(Dvals, dtype="float64")
+        self.t_grid = _grid_spacing(self.Tvals)
+        self.d_grid = _grid_spacing(self.Dvals)
+        self.fluxes = np.ascontiguousarray(fluxes, dtype="float64")
+        self.cie_fluxf = cie_fluxf
+        self.cie_grid = _grid_spacing(cie_fluxf.Tvals)
+        self.limits = limits
+        self.do_var = do_var
+
+    def __call__(self, kT, nH):
+        kT = np.atleast_1d(np.asarray(kT, dtype="float64"))
+        nH = np.atleast_1d(np.asarray(nH, dtype="float64"))
+        flux = igm_cie_flux(
+            self.fluxes,
+            self.cie_fluxf.fluxes,
+            kT,
+            nH,
+            self.Tvals,
+            self.t_grid,
+            self.Dvals,
+            self.d_grid,
+            self.cie_fluxf.Tvals,
+            self.cie_grid,
+            self.limits,
+            K_per_keV,
+        )
+        vflux = flux[2:] if self.do_var else None
+        return flux[0], flux[1], vflux
+
+
 class ThermalSpectralModel:
     _logT = False
+    dtype = "float64"
+    flux_tol = None
+    model_vers = None
+    _table_params = ()
+    _zobs = None
+    _mapped = False
+    max_redshift = None
+    rest_oversample = 4
+    num_threads = 1
+    _rest_model = None
+    _rest_tables = None
+
+    def __getstate__(self):
+        # Tables which are mapped from the table cache are not sent to
+        # other processes, which map them from the cache themselves
+        state = self.__dict__.copy()
+        if self._mapped:
+            for name in ["cosmic_spec", "metal_spec", "var_spec", "si"]:
+                state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._mapped:
+            self.prepare_spectrum(self._zobs)
 
     def _Tconv(self, kT):
         if self._logT:
@@ -89,51 +427,132 @@ class ThermalSpectralModel:
         else:
             return kT
 
-    def get_spectrum(self, kT):
+    def get_spectrum(self, kT, out=None, window=None):
         """
         Get the thermal emission spectrum given a temperature *kT* in keV.
+        The cosmic, metal, and variable element spectra are written into
+        the arrays of the tuple *out*, if it is given. If a *window* of
+        bins (start, stop) is given, only the spectra in it are computed.
         """
         kT = np.atleast_1d(self._Tconv(kT))
-        return self.si(kT)
+        return self.si(kT, out=out, window=window)
 
-    def make_fluxf(self, emin, emax, energy=False):
-        eidxs = (self.ebins[:-1] > emin) & (self.ebins[1:] < emax)
-        emid = self.emid[eidxs]
-        if energy:
-            cosmic_flux = (self.cosmic_spec[:, eidxs] * emid).sum(axis=-1)
-            metal_flux = (self.metal_spec[:, eidxs] * emid).sum(axis=-1)
+    def get_total_spectrum(self, kT, metalZ, elemZ, out, cdf=None, window=None):
+        """
+        Get the total thermal emission spectra given temperatures *kT* in
+        keV, metallicities *metalZ*, and abundances *elemZ* of the variable
+        elements, one row for each, written into the array *out*. The
+        normalized CDFs of the spectra are written into *cdf*, if it is
+        given. Returns the sums of the spectra.
+        """
+        kT = np.atleast_1d(self._Tconv(kT))
+        return self.si.total_spectrum(kT, metalZ, elemZ, out, cdf=cdf, window=window)
+
+    def _table_key(self):
+        """
+        A key which identifies the tables of the model, as they were last
+        prepared by prepare_spectrum.
+        """
+        return (
+            type(self).__name__,
+            self.model_vers,
+            float(self.ebins[0]),
+            float(self.ebins[-1]),
+            self.nbins,
+            self.binscale,
+            self.dtype,
+            self._zobs,
+            self.max_redshift,
+            self.rest_oversample,
+        ) + self._table_params
+
+    def _get_tables(self, zobs):
+        """
+        Get the cosmic, metal, and variable element tables of the model
+        prepared for the redshift *zobs*, from the table cache if they
+        have been stored there, or else made by _make_tables.
+        """
+        self._zobs = float(zobs)
+        if self.max_redshift is None:
+            make_tables = partial(self._make_tables, zobs)
         else:
-            cosmic_flux = self.cosmic_spec[:, eidxs].sum(axis=-1)
-            metal_flux = self.metal_spec[:, eidxs].sum(axis=-1)
-        cf = interp1d(
-            self.Tvals, cosmic_flux, fill_value=0.0, assume_sorted=True, copy=False
-        )
-        mf = interp1d(
-            self.Tvals, metal_flux, fill_value=0.0, assume_sorted=True, copy=False
+            make_tables = partial(self._rebin_rest_frame, zobs)
+        tables = get_tables(self._table_key(), make_tables)
+        self._mapped = isinstance(tables[0], np.memmap)
+        return tables
+
+    def _rest_frame_model(self, emin, emax, nbins):
+        return type(self)(
+            emin=emin, emax=emax, nbins=nbins, binscale=self.binscale, **self._init_args
         )
-        if self.var_spec is not None:
-            if energy:
-                var_flux = (self.var_spec[:, :, eidxs] * emid).sum(axis=-1)
-            else:
-                var_flux = self.var_spec[:, :, eidxs].sum(axis=-1)
-            vf = interp1d(
-                self.Tvals,
-                var_flux,
-                axis=1,
-                fill_value=0.0,
-                assume_sorted=True,
-                copy=False,
-            )
-        else:
 
-            def vf(kT):
-                pass
+    def _rebin_rest_frame(self, zobs):
+        """
+        Make the tables of the model at the redshift *zobs* by rebinning
+        its rest-frame tables, which are made the first time they are
+        needed and then kept for all of the redshifts after.
+        """
+        if zobs > self.max_redshift:
+            raise ValueError(
+                f"The redshift {zobs} is higher than the maximum redshift "
+                f"{self.max_redshift} that this spectral model was set up for!"
+            )
+        if self._rest_tables is None:
+            emin, emax, nbins = _rest_frame_grid(
+                float(self.ebins[0]),
+                float(self.ebins[-1]),
+                self.nbins,
+                self.binscale,
+                self.max_redshift,
+                self.rest_oversample,
+            )
+            self._rest_model = self._rest_frame_model(emin, emax, nbins)
+            self._rest_tables = self._rest_model._get_tables(0.0)
+        tables = _rebin_tables(
+            self._rest_tables, self._rest_model.ebins, self.ebins * (1.0 + zobs)
+        )
+        # The photons are spread over (1+z) times the time in the observer
+        # frame, as the tables made for a redshift by soxs are
+        scale_factor = 1.0 / (1.0 + zobs)
+        return [
+            None if table is None else _cast_table(table * scale_factor, self.dtype)
+            for table in tables
+        ]
 
-        def _fluxf(kT):
-            kT = self._Tconv(kT)
-            return cf(kT), mf(kT), vf(kT)
+    def make_fluxf(self, emin, emax, energy=False):
+        """
+        Get a :class:`BandFluxTable` of the fluxes of the model between
+        *emin* and *emax* in keV, in energy or photons. The tables are
+        cached, so they are only made once for each band.
+        """
+        key = (self._table_key(), float(emin), float(emax), energy)
+        fluxf = _band_flux_cache.get(key)
+        if fluxf is not None:
+            return fluxf
+        fluxf = BandFluxTable(
+            self.Tvals,
+            self._band_fluxes(emin, emax, energy),
+            self.var_spec is not None,
+            self._logT,
+        )
+        _band_flux_cache[key] = fluxf
+        return fluxf
 
-        return _fluxf
+    def _band_fluxes(self, emin, emax, energy):
+        # The fluxes of the cosmic, metal, and variable element tables
+        # between emin and emax at each node, one row for each
+        eidxs = (self.ebins[:-1] > emin) & (self.ebins[1:] < emax)
+        emid = self.emid[eidxs]
+        spec = [self.cosmic_spec[np.newaxis], self.metal_spec[np.newaxis]]
+        if self.var_spec is not None:
+            spec.append(self.var_spec)
+        fluxes = []
+        for table in spec:
+            table = table[:, :, eidxs]
+            if energy:
+                table = table * emid
+            fluxes.append(table.sum(axis=-1, dtype="float64"))
+        return np.concatenate(fluxes)
 
 
 class TableCIEModel(ThermalSpectralModel):
@@ -189,6 +608,27 @@ class TableCIEModel(ThermalSpectralModel):
     nei : boolean, optional
         If True, use the non-equilibrium ionization tables. Only available
         for the "apec" model. Default: False
+    dtype : string, optional
+        The precision of the spectral tables and of the spectra which are
+        interpolated from them, "float64" or "float32". Single precision
+        halves the memory which they take up. Default: "float64"
+    flux_tol : float, optional
+        If set, the energy window of the spectrum at each temperature node
+        which holds all but this fraction of its flux is found, and the
+        spectra are only computed and sampled from within these windows.
+        Zero leaves out only the bins with no emission. Default: None,
+        which uses all of the bins
+    max_redshift : float, optional
+        If set, the tables are made once in the rest frame, for the energies
+        of the bins at all redshifts up to this one, and the tables for each
+        redshift that the model is prepared for are rebinned from them,
+        rather than made again from the raw tables. Default: None
+    rest_oversample : integer, optional
+        How many times finer the bins of the rest-frame tables are than
+        those of the model, if *max_redshift* is set. Default: 4
+    num_threads : integer, optional
+        The number of threads which interpolate the spectra of the cells
+        in parallel. Default: 1
 
     Examples
     --------
@@ -212,6 +652,11 @@ class TableCIEModel(ThermalSpectralModel):
         nolines=False,
         abund_table="angr",
         nei=False,
+        dtype="float64",
+        flux_tol=None,
+        max_redshift=None,
+        rest_oversample=4,
+        num_threads=1,
     ):
         self.cgen = CIEGenerator(
             model,
@@ -245,26 +690,73 @@ class TableCIEModel(ThermalSpectralModel):
         self.dTvals = np.diff(self.Tvals)
         self.model_vers = self.cgen.model_vers
         self.model_root = self.cgen.model_root
+        self.binscale = binscale
+        self.dtype = _parse_dtype(dtype)
+        self.flux_tol = flux_tol
+        self.max_redshift = max_redshift
+        self.rest_oversample = rest_oversample
+        self.num_threads = num_threads
+        self._init_args = {
+            "model": model,
+            "kT_min": kT_min,
+            "kT_max": kT_max,
+            "var_elem": var_elem,
+            "model_root": self.model_root,
+            "model_vers": self.model_vers,
+            "thermal_broad": thermal_broad,
+            "nolines": nolines,
+            "abund_table": abund_table,
+            "nei": nei,
+        }
+        self._table_params = (
+            model,
+            tuple(self.var_elem_names or ()),
+            self.model_root,
+            thermal_broad,
+            nolines,
+            _abund_key(abund_table),
+            nei,
+            self.idx_min,
+            self.idx_max,
+        )
+
+    def _make_tables(self, zobs):
+        cosmic_spec, metal_spec, var_spec = self.cgen._get_table(
+            list(range(self.idx_min, self.idx_max)), zobs, 0.0
+        )
+        cosmic_spec = _cast_table(cosmic_spec, self.dtype)
+        metal_spec = _cast_table(metal_spec, self.dtype)
+        if var_spec is not None:
+            var_spec = _cast_table(var_spec, self.dtype)
+        return cosmic_spec, metal_spec, var_spec
 
     def prepare_spectrum(self, zobs):
         """
         Prepare the thermal model for execution given a redshift *zobs* for the spectrum.
         """
-        cosmic_spec, metal_spec, var_spec = self.cgen._get_table(
-            list(range(self.idx_min, self.idx_max)), zobs, 0.0
-        )
-        self.cosmic_spec = cosmic_spec
-        self.metal_spec = metal_spec
-        self.var_spec = var_spec
+        self.cosmic_spec, self.metal_spec, self.var_spec = self._get_tables(zobs)
         self.si = SpectralInterpolator1D(
-            self.Tvals, self.cosmic_spec, self.metal_spec, self.var_spec
+            self.Tvals,
+            self.cosmic_spec,
+            self.metal_spec,
+            self.var_spec,
+            flux_tol=self.flux_tol,
+            num_threads=self.num_threads,
         )
 
 
 class Atable1DSpectralModel(ThermalSpectralModel):
     _logT = True
 
-    def __init__(self, sgen):
+    def __init__(
+        self,
+        sgen,
+        dtype="float64",
+        flux_tol=None,
+        max_redshift=None,
+        rest_oversample=4,
+        num_threads=1,
+    ):
         self.sgen = sgen
         self.nbins = self.sgen.nbins
         self.ebins = self.sgen.ebins
@@ -275,23 +767,51 @@ class Atable1DSpectralModel(ThermalSpectralModel):
         self.de = self.sgen.de
         self.binscale = self.sgen.binscale
         self.Tvals = self.sgen.Tvals
+        self.dtype = _parse_dtype(dtype)
+        self.flux_tol = flux_tol
+        self.max_redshift = max_redshift
+        self.rest_oversample = rest_oversample
+        self.num_threads = num_threads
+        self._table_params = (tuple(self.var_elem or ()),)
 
-    def prepare_spectrum(self, zobs):
+    def _make_tables(self, zobs):
         eidxs, ne, ebins, emid, de = self.sgen._get_energies(zobs)
         cosmic_spec, metal_spec, var_spec = self.sgen._get_table(ne, eidxs, zobs)
-        self.cosmic_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, cosmic_spec)
-        self.metal_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, metal_spec)
+        cosmic_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, cosmic_spec)
+        metal_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, metal_spec)
+        cosmic_spec = _cast_table(cosmic_spec, self.dtype)
+        metal_spec = _cast_table(metal_spec, self.dtype)
         if var_spec is not None:
             var_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, var_spec)
-        self.var_spec = var_spec
+            var_spec = _cast_table(var_spec, self.dtype)
+        return cosmic_spec, metal_spec, var_spec
+
+    def prepare_spectrum(self, zobs):
+        self.cosmic_spec, self.metal_spec, self.var_spec = self._get_tables(zobs)
         self.si = SpectralInterpolator1D(
-            self.Tvals, self.cosmic_spec, self.metal_spec, self.var_spec
+            self.Tvals,
+            self.cosmic_spec,
+            self.metal_spec,
+            self.var_spec,
+            flux_tol=self.flux_tol,
+            num_threads=self.num_threads,
         )
 
 
 class MekalSpectralModel(Atable1DSpectralModel):
     def __init__(
-        self, emin, emax, nbins, binscale="linear", var_elem=None, abund_table="angr"
+        self,
+        emin,
+        emax,
+        nbins,
+        binscale="linear",
+        var_elem=None,
+        abund_table="angr",
+        dtype="float64",
+        flux_tol=None,
+        max_redshift=None,
+        rest_oversample=4,
+        num_threads=1,
     ):
         mgen = MekalGenerator(
             emin,
@@ -301,8 +821,17 @@ class MekalSpectralModel(Atable1DSpectralModel):
             var_elem=var_elem,
             abund_table=abund_table,
         )
-        super().__init__(mgen)
+        super().__init__(
+            mgen,
+            dtype=dtype,
+            flux_tol=flux_tol,
+            max_redshift=max_redshift,
+            rest_oversample=rest_oversample,
+            num_threads=num_threads,
+        )
         self.var_ion_names = []
+        self._init_args = {"var_elem": var_elem, "abund_table": abund_table}
+        self._table_params += (_abund_key(abund_table),)
 
 
 class CloudyCIESpectralModel(Atable1DSpectralModel):
@@ -314,6 +843,11 @@ class CloudyCIESpectralModel(Atable1DSpectralModel):
         binscale="linear",
         var_elem=None,
         model_vers=None,
+        dtype="float64",
+        flux_tol=None,
+        max_redshift=None,
+        rest_oversample=4,
+        num_threads=1,
     ):
         cgen = CloudyCIEGenerator(
             emin,
@@ -323,9 +857,17 @@ class CloudyCIESpectralModel(Atable1DSpectralModel):
             var_elem=var_elem,
             model_vers=model_vers,
         )
-        super().__init__(cgen)
+        super().__init__(
+            cgen,
+            dtype=dtype,
+            flux_tol=flux_tol,
+            max_redshift=max_redshift,
+            rest_oversample=rest_oversample,
+            num_threads=num_threads,
+        )
         self.var_ion_names = []
         self.model_vers = cgen.model_vers
+        self._init_args = {"var_elem": var_elem, "model_vers": self.model_vers}
 
 
 class IGMSpectralModel(ThermalSpectralModel):
@@ -362,6 +904,21 @@ class IGMSpectralModel(ThermalSpectralModel):
         The names of elements to allow to vary freely
         from the single abundance parameter. Default:
         None
+    dtype : string, optional
+        The precision of the spectral tables and of the spectra which are
+        interpolated from them, "float64" or "float32". Single precision
+        halves the memory which they take up. Default: "float64"
+    max_redshift : float, optional
+        If set, the tables are made once in the rest frame, for the energies
+        of the bins at all redshifts up to this one, and the tables for each
+        redshift that the model is prepared for are rebinned from them,
+        rather than made again from the raw tables. Default: None
+    rest_oversample : integer, optional
+        How many times finer the bins of the rest-frame tables are than
+        those of the model, if *max_redshift* is set. Default: 4
+    num_threads : integer, optional
+        The number of threads which interpolate the spectra of the cells
+        in parallel. Default: 1
     """
 
     def __init__(
@@ -374,6 +931,10 @@ class IGMSpectralModel(ThermalSpectralModel):
         cxb_factor=0.5,
         var_elem=None,
         model_vers=None,
+        dtype="float64",
+        max_redshift=None,
+        rest_oversample=4,
+        num_threads=1,
     ):
         self.igen = IGMGenerator(
             emin,
@@ -402,6 +963,7 @@ class IGMSpectralModel(ThermalSpectralModel):
         self.n_T = self.igen.n_T
         self.n_D = self.igen.n_D
         self.binscale = self.igen.binscale
+        self.dtype = _parse_dtype(dtype)
         self.cie_model = CloudyCIESpectralModel(
             emin,
             emax,
@@ -409,136 +971,114 @@ class IGMSpectralModel(ThermalSpectralModel):
             binscale=self.binscale,
             var_elem=self.var_elem,
             model_vers=model_vers,
+            dtype=self.dtype,
+            max_redshift=max_redshift,
+            rest_oversample=rest_oversample,
+            num_threads=num_threads,
         )
         self.model_vers = self.igen.model_vers
+        self.max_redshift = max_redshift
+        self.rest_oversample = rest_oversample
+        self.num_threads = num_threads
+        self._init_args = {
+            "resonant_scattering": resonant_scattering,
+            "cxb_factor": cxb_factor,
+            "var_elem": var_elem,
+            "model_vers": self.model_vers,
+        }
+        self._table_params = (
+            tuple(self.var_elem or ()),
+            resonant_scattering,
+            cxb_factor,
+        )
 
-    def prepare_spectrum(self, zobs):
-        """
-        Prepare the thermal model for execution given a redshift *zobs* for the spectrum.
-        """
+    def _make_tables(self, zobs):
         eidxs, ne, ebins, emid, de = self.igen._get_energies(zobs)
         cosmic_spec, metal_spec, var_spec = self.igen._get_table(ne, eidxs, zobs)
-        self.cosmic_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, cosmic_spec)
-        self.metal_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, metal_spec)
+        cosmic_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, cosmic_spec)
+        metal_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, metal_spec)
+        cosmic_spec = _cast_table(cosmic_spec, self.dtype)
+        metal_spec = _cast_table(metal_spec, self.dtype)
         if var_spec is not None:
             var_spec = 1.0e-14 * regrid_spectrum(self.ebins, ebins, var_spec)
-        self.var_spec = var_spec
+            var_spec = _cast_table(var_spec, self.dtype)
+        return cosmic_spec, metal_spec, var_spec
+
+    def prepare_spectrum(self, zobs):
+        """
+        Prepare the thermal model for execution given a redshift *zobs* for the spectrum.
+        """
+        self.cosmic_spec, self.metal_spec, self.var_spec = self._get_tables(zobs)
         self.cie_model.prepare_spectrum(zobs)
         self.si = SpectralInterpolator2D(
-            self.Tvals, self.Dvals, self.cosmic_spec, self.metal_spec, self.var_spec
+            self.Tvals,
+            self.Dvals,
+            self.cosmic_spec,
+            self.metal_spec,
+            self.var_spec,
+            num_threads=self.num_threads,
+        )
+
+    def _table_limits(self):
+        return (
+            self.min_table_kT,
+            self.max_table_kT,
+            self.min_table_nH,
+            self.max_table_nH,
         )
 
     def get_spectrum(self, kT, nH):
-        kT = np.atleast_1d(kT)
-        nH = np.atleast_1d(nH)
-        use_igm = (kT >= self.min_table_kT) & (kT <= self.max_table_kT)
-        use_igm &= (nH >= self.min_table_nH) & (nH <= self.max_table_nH)
-        use_cie = ~use_igm
-        cspec = np.zeros((kT.size, self.nbins))
-        mspec = np.zeros((kT.size, self.nbins))
-        if self.var_spec is not None:
-            vspec = np.zeros((self.nvar_elem, kT.size, self.nbins))
-        else:
-            vspec = None
-        n_cie = use_cie.sum()
-        n_igm = use_igm.sum()
-        if n_igm > 0:
-            nHi = nH[use_igm]
-            c1, m1, v1 = self._get_spectrum_2d(kT[use_igm], nHi)
-            cspec[use_igm, :] = c1 / nHi[:, np.newaxis]
-            mspec[use_igm, :] = m1 / nHi[:, np.newaxis]
-            if self.var_spec is not None:
-                vspec[:, use_igm, :] = v1 / nHi[np.newaxis, :, np.newaxis]
-        if n_cie > 0:
-            c2, m2, v2 = self.cie_model.get_spectrum(kT[use_cie])
-            cspec[use_cie, :] = c2
-            mspec[use_cie, :] = m2
-            if self.var_spec is not None:
-                vspec[:, use_cie, :] = v2
-        return cspec, mspec, vspec
-
-    def _get_spectrum_2d(self, kT, nH):
-        lkT = np.atleast_1d(np.log10(kT * K_per_keV))
-        lnH = np.atleast_1d(np.log10(nH))
-        cspec, mspec, vspec = self.si(lkT, lnH)
-        return cspec, mspec, vspec
+        """
+        Get the thermal emission spectra given temperatures *kT* in keV and
+        hydrogen number densities *nH* in cm**-3. Each spectrum is
+        interpolated from the IGM table, and divided by the density, if the
+        temperature and density lie within the table, and otherwise from
+        the CIE table, in a single compiled loop.
+        """
+        kT = np.atleast_1d(np.asarray(kT, dtype="float64"))
+        nH = np.atleast_1d(np.asarray(nH, dtype="float64"))
+        cie_si = self.cie_model.si
+        return igm_cie_spec(
+            self.si.cosmic_spec,
+            self.si.metal_spec,
+            self.si.var_spec,
+            cie_si.cosmic_spec,
+            cie_si.metal_spec,
+            cie_si.var_spec,
+            kT,
+            nH,
+            self.si.tbins,
+            self.si.t_grid,
+            self.si.dbins,
+            self.si.d_grid,
+            cie_si.tbins,
+            cie_si.t_grid,
+            self._table_limits(),
+            K_per_keV,
+            self.si.do_var,
+            num_threads=self.num_threads,
+        )
 
     def make_fluxf(self, emin, emax, energy=False):
-        eidxs = (self.ebins[:-1] > emin) & (self.ebins[1:] < emax)
-        emid = self.emid[eidxs]
-        if energy:
-            cosmic_flux = (self.cosmic_spec[:, eidxs] * emid).sum(axis=-1)
-            metal_flux = (self.metal_spec[:, eidxs] * emid).sum(axis=-1)
-        else:
-            cosmic_flux = self.cosmic_spec[:, eidxs].sum(axis=-1)
-            metal_flux = self.metal_spec[:, eidxs].sum(axis=-1)
-        if self.var_spec is not None:
-            if energy:
-                var_flux = (self.var_spec[:, :, eidxs] * emid).sum(axis=-1)
-            else:
-                var_flux = self.var_spec[:, :, eidxs].sum(axis=-1)
-        else:
-            var_flux = None
-        cie_fluxf = self.cie_model.make_fluxf(emin, emax, energy=energy)
-
-        def _fluxf(kT, nH):
-            kT = np.atleast_1d(kT)
-            nH = np.atleast_1d(nH)
-            use_igm = (kT >= self.min_table_kT) & (kT <= self.max_table_kT)
-            use_igm &= (nH >= self.min_table_nH) & (nH <= self.max_table_nH)
-            use_cie = ~use_igm
-            cflux = np.zeros(kT.size)
-            mflux = np.zeros(kT.size)
-            if self.var_spec is not None:
-                vflux = np.zeros((self.nvar_elem, kT.size))
-            else:
-                vflux = None
-            n_cie = use_cie.sum()
-            n_igm = use_igm.sum()
-            if n_igm > 0:
-                nHi = nH[use_igm]
-                c1, m1, v1 = self._get_flux_2d(
-                    kT[use_igm], nHi, cosmic_flux, metal_flux, var_flux
-                )
-                cflux[use_igm] = c1 / nHi
-                mflux[use_igm] = m1 / nHi
-                if self.var_spec is not None:
-                    vflux[:, use_igm] = v1 / nHi[np.newaxis, :]
-            if n_cie > 0:
-                c2, m2, v2 = cie_fluxf(kT[use_cie])
-                cflux[use_cie] = c2
-                mflux[use_cie] = m2
-                if self.var_spec is not None:
-                    vflux[:, use_cie] = v2
-            return cflux, mflux, vflux
-
-        return _fluxf
-
-    def _get_flux_2d(self, kT, nH, cf, mf, vf):
-        lkT = np.atleast_1d(np.log10(kT * K_per_keV))
-        lnH = np.atleast_1d(np.log10(nH))
-        tidxs = np.searchsorted(self.Tvals, lkT) - 1
-        didxs = np.searchsorted(self.Dvals, lnH) - 1
-        dT = (lkT - self.Tvals[tidxs]) / self.dTvals[tidxs]
-        dn = (lnH - self.Dvals[didxs]) / self.dDvals[didxs]
-        idx1 = np.ravel_multi_index((didxs + 1, tidxs + 1), (self.n_D, self.n_T))
-        idx2 = np.ravel_multi_index((didxs + 1, tidxs), (self.n_D, self.n_T))
-        idx3 = np.ravel_multi_index((didxs, tidxs + 1), (self.n_D, self.n_T))
-        idx4 = np.ravel_multi_index((didxs, tidxs), (self.n_D, self.n_T))
-        dx1 = dT * dn
-        dx2 = dn - dx1
-        dx3 = dT - dx1
-        dx4 = 1.0 + dx1 - dT - dn
-        cflux = dx1 * cf[idx1] + dx2 * cf[idx2] + dx3 * cf[idx3] + dx4 * cf[idx4]
-        mflux = dx1 * mf[idx1] + dx2 * mf[idx2] + dx3 * mf[idx3] + dx4 * mf[idx4]
-        if vf is not None:
-            vflux = dx1[np.newaxis, :] * vf[:, idx1]
-            vflux += dx2[np.newaxis, :] * vf[:, idx2]
-            vflux += dx3[np.newaxis, :] * vf[:, idx3]
-            vflux += dx4[np.newaxis, :] * vf[:, idx4]
-        else:
-            vflux = None
-        return cflux, mflux, vflux
+        """
+        Get an :class:`IGMBandFluxTable` of the fluxes of the model between
+        *emin* and *emax* in keV, in energy or photons. The tables are
+        cached, so they are only made once for each band.
+        """
+        key = (self._table_key(), float(emin), float(emax), energy)
+        fluxf = _band_flux_cache.get(key)
+        if fluxf is not None:
+            return fluxf
+        fluxf = IGMBandFluxTable(
+            self.Tvals,
+            self.Dvals,
+            self._band_fluxes(emin, emax, energy),
+            self.cie_model.make_fluxf(emin, emax, energy=energy),
+            self._table_limits(),
+            self.var_spec is not None,
+        )
+        _band_flux_cache[key] = fluxf
+        return fluxf
 
 
 class AbsorptionModel:
@@ -0,0 +1,211 @@
+"""
+A persistent cache of the prepared tables of the thermal spectral models
+"""
+import hashlib
+import os
+import shutil
+import uuid
+
+import numpy as np
+from soxs import __version__ as soxs_version
+from yt.utilities.parallel_tools.parallel_analysis_interface import communication_system
+
+from pyxsim import __version__ as pyxsim_version
+from pyxsim.utils import mylog
+
+_table_names = ["cosmic_spec", "metal_spec", "var_spec"]
+
+# The version of the way the tables are made and stored, which is part of
+# the key of each entry, so that tables stored by an older version of
+# this code are never read
+_cache_version = 2
+
+# The cache is off unless a directory is given, either here or with
+# set_table_cache
+_cache_config = {
+    "cache_dir": os.environ.get("PYXSIM_TABLE_CACHE", None),
+    "max_size": 4.0e9,
+    "shared": False,
+}
+
+# Communicators of the processes on each node, for each MPI communicator
+_node_comms = {}
+
+
+def set_table_cache(cache_dir, max_size=4.0e9, shared=False):
+    """
+    Store the tables of the thermal spectral models, as they are prepared
+    for a redshift, in the directory *cache_dir*, so that preparing the
+    same model again reads them from there. The tables are memory-mapped
+    when they are read, so they are only loaded from disk as they are
+    used, and processes which use the same tables share them in memory.
+
+    Parameters
+    ----------
+    cache_dir : string
+        The directory to store the tables in. It is created if it does
+        not exist. If None, the cache is turned off. The default is the
+        value of the environment variable PYXSIM_TABLE_CACHE, if it is set.
+    max_size : float, optional
+        The maximum size of the cache in bytes. When it is exceeded, the
+        tables which were used least recently are removed. Default: 4 GB
+    shared : boolean, optional
+        If True, when running in parallel with MPI, the tables which are
+        not in the cache yet are made and stored by only one process on
+        each node, and the other processes wait for them and map them
+        from the cache. A directory on a memory-backed filesystem, such
+        as /dev/shm, then keeps a single copy of the tables in memory for
+        the whole node. All of the processes must prepare the same models
+        together. Default: False
+    """
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    _cache_config["cache_dir"] = cache_dir
+    _cache_config["max_size"] = max_size
+    _cache_config["shared"] = shared
+
+
+def table_cache_key(key):
+    """
+    The name of the entry of the cache which stores the tables identified
+    by *key*, a tuple of the parameters they were prepared with.
+    """
+    s = repr((_cache_version, pyxsim_version, soxs_version) + tuple(key))
+    return hashlib.md5(s.encode("utf-8")).hexdigest()
+
+
+def read_tables(key):
+    """
+    Read the tables identified by *key* from the cache, memory-mapped.
+    Returns None if the cache is off or the tables are not in it.
+    """
+    cache_dir = _cache_config["cache_dir"]
+    if cache_dir is None:
+        return None
+    entry = os.path.join(cache_dir, table_cache_key(key))
+    if not os.path.isdir(entry):
+        return None
+    tables = []
+    try:
+        for name in _table_names:
+            fn = os.path.join(entry, f"{name}.npy")
+            if name == "var_spec" and not os.path.exists(fn):
+                tables.append(None)
+            else:
+                tables.append(np.load(fn, mmap_mode="r"))
+        # Mark the entry as the most recently used one
+        os.utime(entry)
+    except (OSError, ValueError):
+        return None
+    mylog.debug("Read the spectral tables from %s.", entry)
+    return tables
+
+
+def write_tables(key, tables):
+    """
+    Store the cosmic, metal, and variable element *tables* identified by
+    *key* in the cache, if it is on, and remove the least recently used
+    tables if the cache has become too large. Returns whether the tables
+    were stored.
+    """
+    cache_dir = _cache_config["cache_dir"]
+    if cache_dir is None:
+        return False
+    name = table_cache_key(key)
+    entry = os.path.join(cache_dir, name)
+    # The tables are written to a temporary directory which is then
+    # renamed, so that other processes never read a partial entry
+    tmp_entry = os.path.join(cache_dir, f"{name}.{uuid.uuid4().hex}.tmp")
+    try:
+        os.makedirs(tmp_entry)
+        for table_name, table in zip(_table_names, tables):
+            if table is not None:
+                np.save(os.path.join(tmp_entry, f"{table_name}.npy"), table)
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Either another process has stored the same tables first, or
+        # the cache cannot be written to, in which case it is skipped
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        return False
+    mylog.debug("Stored the spectral tables in %s.", entry)
+    _evict(cache_dir, _cache_config["max_size"], keep=name)
+    return True
+
+
+def _node_comm():
+    comm = communication_system.communicators[-1]
+    if comm.size == 1:
+        return None
+    if id(comm.comm) not in _node_comms:
+        from mpi4py import MPI
+
+        _node_comms[id(comm.comm)] = comm.comm.Split_type(MPI.COMM_TYPE_SHARED)
+    return _node_comms[id(comm.comm)]
+
+
+def get_tables(key, make_tables):
+    """
+    Get the tables identified by *key* from the cache, if it is on. If
+    they are not in it, they are made by calling *make_tables* and then
+    stored, and mapped from the cache by this process and, if the cache
+    is shared, by the other processes on the same node.
+    """
+    if _cache_config["cache_dir"] is None:
+        return make_tables()
+    node_comm = _node_comm() if _cache_config["shared"] else None
+    tables = None
+    error = None
+    if node_comm is None or node_comm.rank == 0:
+        try:
+            tables = read_tables(key)
+            if tables is None:
+                tables = make_tables()
+                if write_tables(key, tables):
+                    # Map the stored tables instead of keeping a copy of them
+                    tables = None
+        except Exception as e:
+            if node_comm is None:
+                raise
+            error = e
+    if node_comm is not None:
+        # The other processes wait for the tables to be stored, and
+        # learn whether making them failed, so that they fail too
+        message = node_comm.bcast(None if error is None else repr(error), root=0)
+        if error is not None:
+            raise error
+        if message is not None:
+            raise RuntimeError(
+                f"The spectral tables could not be made by the first process "
+                f"on this node: {message}"
+            )
+    if tables is None:
+        tables = read_tables(key)
+    if tables is None:
+        # The tables could not be stored, so each process makes its own
+        tables = make_tables()
+    return tables
+
+
+def _evict(cache_dir, max_size, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith(".tmp") or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(
+                os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path)
+            )
+            entries.append((os.path.getmtime(path), size, name))
+        except OSError:
+            continue
+    tot_size = sum(entry[1] for entry in entries)
+    for _, size, name in sorted(entries):
+        if tot_size <= max_size:
+            break
+        if name == keep:
+            continue
+        # Processes which have the tables mapped keep them until they
+        # are done with them
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        tot_size -= size
@@ -54,7 +54,12 @@ def test_particle_beta_model_offaxis(check_dir):
     do_beta_model(bms, check_dir, prng=67, axis=[1.0, -2.0, 5.0])
 
 
-def do_beta_model(source, check_dir, axis="z", prng=None):
+def test_beta_model_counts_first(check_dir):
+    bms = BetaModelSource()
+    do_beta_model(bms, check_dir, prng=31, counts_first=True)
+
+
+def do_beta_model(source, check_dir, axis="z", prng=None, counts_first=False):
 
     tmpdir = tempfile.mkdtemp()
     curdir = os.getcwd()
@@ -75,7 +80,9 @@ def do_beta_model(source, check_dir, axis="z", prng=None):
     kT_sim = source.kT
     Z_sim = source.Z
 
-    thermal_model = CIESourceModel("apec", 0.1, 11.5, 20000, Z_sim, prng=prng)
+    thermal_model = CIESourceModel(
+        "apec", 0.1, 11.5, 20000, Z_sim, prng=prng, counts_first=counts_first
+    )
     make_photons("my_photons", sphere, redshift, A, exp_time, thermal_model)
 
     D_A = cosmo.angular_diameter_distance(0.0, redshift).to_value("cm")
@@ -267,3 +274,26 @@ def test_beta_model_spectrum():
     spec4 = thermal_model.make_spectrum(sphere, 0.2, 7.0, 2000)
 
     assert_allclose(spec3.flux.value, spec4.flux.value)
+
+
+def test_vapec_beta_model_spectrum():
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    sphere = ds.sphere("c", (0.5, "Mpc"))
+
+    norm = 1.0e-14 * sphere.sum(("gas", "emission_measure")).v
+
+    var_elem = {"O": ("stream", "oxygen"), "Ca": ("stream", "calcium")}
+
+    agen = ApecGenerator(0.2, 7.0, 2000, var_elem=["O", "Ca"])
+    spec1 = agen.get_spectrum(
+        bms.kT, bms.Z, 0.0, norm, elem_abund={"O": bms.O, "Ca": bms.Ca}
+    )
+
+    thermal_model = CIESourceModel(
+        "apec", 0.2, 7.0, 2000, ("gas", "metallicity"), var_elem=var_elem
+    )
+    spec2 = thermal_model.make_spectrum(sphere, 0.2, 7.0, 2000)
+
+    assert_allclose(spec1.flux.value, spec2.flux.value)
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+
+from pyxsim.chunk_manifest import ChunkManifest, get_chunk_manifest
+from pyxsim.tests.utils import BetaModelSource
+
+
+def test_chunk_manifest():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    sphere = ds.sphere("c", (0.5, "Mpc"))
+
+    fields = [("gas", "temperature"), ("gas", "density")]
+
+    manifest = get_chunk_manifest(sphere, fields)
+
+    assert manifest.tot_num_cells == sphere["gas", "temperature"].size
+
+    # A second call for the same data source should not rebuild it
+    assert get_chunk_manifest(sphere, fields) is manifest
+
+    dle = ds.domain_left_edge.to_value("kpc")
+    dre = ds.domain_right_edge.to_value("kpc")
+    for ichunk, chunk in enumerate(sphere.chunks([], "io")):
+        dens = chunk["gas", "density"]
+        assert manifest.num_cells[ichunk] == dens.size
+        if dens.size == 0:
+            assert manifest.field_range(ichunk, ("gas", "density")) == (
+                np.inf,
+                -np.inf,
+            )
+            continue
+        dmin, dmax = manifest.field_range(ichunk, ("gas", "density"), "g/cm**3")
+        assert_allclose(dmin, dens.to_value("g/cm**3").min())
+        assert_allclose(dmax, dens.to_value("g/cm**3").max())
+        kT_lo, kT_hi = manifest.field_range(
+            ichunk, ("gas", "temperature"), "keV", "thermal"
+        )
+        assert_allclose([kT_lo, kT_hi], bms.kT)
+        assert np.all(manifest.left_edge[ichunk] >= dle)
+        assert np.all(manifest.right_edge[ichunk] <= dre)
+
+    stats = np.array([1.0, 2.0])
+    manifest.write("manifest.h5", "sphere", stats)
+    manifest2 = ChunkManifest.read("manifest.h5", "sphere", stats)
+    assert_equal(manifest2.fields, manifest.fields)
+    assert_equal(manifest2.units, manifest.units)
+    assert_equal(manifest2.num_cells, manifest.num_cells)
+    assert_equal(manifest2.field_min, manifest.field_min)
+    assert_equal(manifest2.field_max, manifest.field_max)
+
+    # The manifest is invalid if the dataset file has changed
+    assert ChunkManifest.read("manifest.h5", "sphere", stats + 1.0) is None
+    assert ChunkManifest.read("manifest.h5", "region", stats) is None
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_chunk_manifest_redefined_field():
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    sphere = ds.sphere("c", (0.5, "Mpc"))
+
+    def _kTx(field, data):
+        return data.ds.arr(np.full(data["gas", "density"].shape, 0.01), "keV")
+
+    ds.add_field(("gas", "kTx"), _kTx, sampling_type="local", units="keV")
+    fields = [("gas", "kTx")]
+    manifest = get_chunk_manifest(sphere, fields)
+    assert_allclose(manifest.field_range(0, ("gas", "kTx")), 0.01)
+
+    # The ranges of a redefined field are not reused
+    def _kTx(field, data):
+        return data.ds.arr(np.full(data["gas", "density"].shape, 5.0), "keV")
+
+    ds.add_field(
+        ("gas", "kTx"), _kTx, sampling_type="local", units="keV", force_override=True
+    )
+    manifest2 = get_chunk_manifest(sphere, fields)
+    assert manifest2 is not manifest
+    assert_allclose(manifest2.field_range(0, ("gas", "kTx")), 5.0)
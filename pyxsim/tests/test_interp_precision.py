@@ -0,0 +1,136 @@
+import numpy as np
+from numpy.testing import assert_allclose
+
+from pyxsim.spectral_models import SpectralInterpolator1D, SpectralInterpolator2D
+
+
+def make_tables(prng, num_nodes, nbins, dtype):
+    tables = [prng.random((num_nodes, nbins)), prng.random((num_nodes, nbins))]
+    tables.append(prng.random((3, num_nodes, nbins)))
+    return [1.0e-14 * table.astype(dtype) for table in tables]
+
+
+def test_interp_float32():
+    prng = np.random.default_rng(25)
+    tbins = np.linspace(0.1, 10.0, 40)
+    dbins = np.linspace(-6.0, -1.0, 5)
+    t_vals = prng.uniform(0.0, 11.0, size=200)
+    d_vals = prng.uniform(-6.0, -1.0, size=200)
+
+    tables = make_tables(prng, tbins.size, 1000, "float32")
+    si32 = SpectralInterpolator1D(tbins, *tables)
+    si64 = SpectralInterpolator1D(tbins, *[t.astype("float64") for t in tables])
+    for s32, s64 in zip(si32(t_vals), si64(t_vals)):
+        assert s32.dtype == np.float32
+        assert_allclose(s32, s64, rtol=1.0e-6, atol=1.0e-20)
+
+    # The CDFs are accumulated in double precision
+    sums32, cdfs32 = si32.node_cdfs()
+    sums64, cdfs64 = si64.node_cdfs()
+    assert cdfs32.dtype == np.float64
+    assert_allclose(sums32, sums64, rtol=1.0e-12)
+    assert_allclose(cdfs32, cdfs64, rtol=1.0e-12)
+
+    # Without variable elements
+    si32 = SpectralInterpolator1D(tbins, tables[0], tables[1], None)
+    c32, m32, v32 = si32(t_vals)
+    assert c32.dtype == m32.dtype == np.float32
+    assert v32 is None
+
+    tables = make_tables(prng, tbins.size * dbins.size, 1000, "float32")
+    si32 = SpectralInterpolator2D(tbins, dbins, *tables)
+    si64 = SpectralInterpolator2D(tbins, dbins, *[t.astype("float64") for t in tables])
+    for s32, s64 in zip(si32(t_vals, d_vals), si64(t_vals, d_vals)):
+        assert s32.dtype == np.float32
+        assert_allclose(s32, s64, rtol=1.0e-6, atol=1.0e-20)
+
+
+def test_total_spectrum():
+    prng = np.random.default_rng(26)
+    tbins = np.linspace(0.1, 10.0, 40)
+    t_vals = prng.uniform(0.0, 11.0, size=200)
+    metalZ = prng.uniform(0.0, 1.0, size=200)
+    elemZ = prng.uniform(0.0, 2.0, size=(3, 200))
+    window = (100, 900)
+    for dtype, rtol in [("float64", 1.0e-12), ("float32", 1.0e-5)]:
+        tables = make_tables(prng, tbins.size, 1000, dtype)
+        # Some of the spectra are negative, and are clipped to zero
+        tables[1] -= 0.3e-14
+        si = SpectralInterpolator1D(tbins, *tables)
+        cspec, mspec, vspec = [s.astype("float64") for s in si(t_vals, window=window)]
+        spec = cspec + metalZ[:, np.newaxis] * mspec
+        spec += np.sum(elemZ[:, :, np.newaxis] * vspec, axis=0)
+        np.clip(spec, 0.0, None, out=spec)
+        # Non-contiguous abundances are accepted
+        elemZ_nc = np.zeros((3, 400))
+        elemZ_nc[:, ::2] = elemZ
+        out = np.empty((200, 800), dtype=dtype)
+        cdf = np.empty((200, 801))
+        sums = si.total_spectrum(
+            t_vals, metalZ, elemZ_nc[:, ::2], out, cdf=cdf, window=window
+        )
+        assert_allclose(out, spec, rtol=rtol, atol=1.0e-20)
+        assert_allclose(sums, spec.sum(axis=-1), rtol=rtol)
+        assert np.all(out >= 0.0)
+        cp = np.cumsum(spec, axis=-1) / spec.sum(axis=-1)[:, np.newaxis]
+        assert_allclose(cdf[:, 1:], cp, rtol=rtol, atol=1.0e-12)
+        assert_allclose(cdf[:, 0], 0.0)
+
+
+def test_weighted_spectrum():
+    prng = np.random.default_rng(27)
+    tbins = np.linspace(0.1, 10.0, 40)
+    t_vals = prng.uniform(0.1, 10.0, size=500)
+    abund = prng.uniform(0.0, 2.0, size=(5, 500))
+    abund[0] = 1.0
+    tables = make_tables(prng, tbins.size, 1000, "float32")
+    si = SpectralInterpolator1D(tbins, *tables)
+    assert si.is_non_negative()
+    # The sum of the spectra of the cells is the sum of the spectra at
+    # the nodes, weighted by the sums of the weights of the cells
+    x_i, xm, xp = si.node_weights(t_vals)
+    weights = np.zeros((5, tbins.size))
+    for k in range(5):
+        weights[k] += np.bincount(x_i, weights=abund[k] * xm, minlength=tbins.size)
+        weights[k] += np.bincount(x_i + 1, weights=abund[k] * xp, minlength=tbins.size)
+    out = np.empty((500, 1000), dtype="float32")
+    si.total_spectrum(t_vals, abund[1], abund[2:], out)
+    assert_allclose(si.weighted_spectrum(weights), out.sum(axis=0), rtol=1.0e-5)
+
+
+def test_interp_threads():
+    prng = np.random.default_rng(28)
+    t_vals = prng.uniform(0.0, 11.0, size=500)
+    t_vals[:3] = [np.nan, 0.1, 10.0]
+    d_vals = prng.uniform(-7.0, 0.0, size=500)
+    # Linear, logarithmic, and irregular grids
+    grids = [
+        np.linspace(0.1, 10.0, 40),
+        np.logspace(-1.0, 1.0, 40),
+        np.sort(prng.uniform(0.1, 10.0, size=40)),
+    ]
+    for tbins in grids:
+        tables = make_tables(prng, tbins.size, 1000, "float64")
+        si = SpectralInterpolator1D(tbins, *tables)
+        x_i = np.clip(np.digitize(t_vals, tbins) - 1, 0, tbins.size - 2)
+        np.testing.assert_array_equal(si.node_indices(t_vals), x_i)
+        # The spectra do not depend on the number of threads
+        si_mt = SpectralInterpolator1D(tbins, *tables, num_threads=3)
+        for s, s_mt in zip(si(t_vals[1:]), si_mt(t_vals[1:])):
+            np.testing.assert_array_equal(s, s_mt)
+        out = np.empty((499, 1000))
+        out_mt = np.empty((499, 1000))
+        sums = si.total_spectrum(t_vals[1:], d_vals[1:], tables[2][:, :499, 0], out)
+        sums_mt = si_mt.total_spectrum(
+            t_vals[1:], d_vals[1:], tables[2][:, :499, 0], out_mt
+        )
+        np.testing.assert_array_equal(out, out_mt)
+        np.testing.assert_array_equal(sums, sums_mt)
+
+    dbins = np.linspace(-6.0, -1.0, 5)
+    tbins = grids[0]
+    tables = make_tables(prng, tbins.size * dbins.size, 1000, "float64")
+    si = SpectralInterpolator2D(tbins, dbins, *tables)
+    si_mt = SpectralInterpolator2D(tbins, dbins, *tables, num_threads=3)
+    for s, s_mt in zip(si(t_vals[1:], d_vals[1:]), si_mt(t_vals[1:], d_vals[1:])):
+        np.testing.assert_array_equal(s, s_mt)
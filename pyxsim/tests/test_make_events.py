@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from yt.testing import fake_random_ds
+
+from pyxsim import (
+    EventList,
+    PowerLawSourceModel,
+    make_events,
+    make_photons,
+    project_photons,
+)
+
+
+def test_make_events():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    fields = ("density", "velocity_x", "velocity_y", "velocity_z")
+    units = ("g/cm**3", "km/s", "km/s", "km/s")
+    ds = fake_random_ds(16, nprocs=4, fields=fields, units=units, length_unit="Mpc")
+
+    def _emission(field, data):
+        return data.ds.quan(1.0e46, "cm**3/g/s/keV") * data["gas", "density"]
+
+    ds.add_field(
+        ("gas", "emission"),
+        function=_emission,
+        units="keV**-1*s**-1",
+        sampling_type="local",
+    )
+
+    dd = ds.all_data()
+
+    def plaw_model():
+        return PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+
+    args = (0.05, 1000.0, 1.0e5)
+
+    make_photons("photons", dd, *args, plaw_model())
+    n_events = project_photons(
+        "photons", "events", "z", [30.0, 45.0], no_shifting=True, prng=26
+    )
+
+    n_fused = make_events(
+        "fused", dd, *args, plaw_model(), "z", [30.0, 45.0], no_shifting=True, prng=26
+    )
+
+    # Without absorption or Doppler shifts every photon is an event, and
+    # the photons are generated in the same order, so only the sky
+    # positions differ
+    assert n_fused == n_events
+    events = EventList("events.h5")
+    fused = EventList("fused.h5")
+    assert fused.parameters["sky_center"].tolist() == [30.0, 45.0]
+    assert fused.parameters["normal"] == "z"
+    with h5py.File("events.h5", "r") as f1, h5py.File("fused.h5", "r") as f2:
+        d1 = events._read_events(f1)
+        d2 = fused._read_events(f2)
+        assert_equal(d1["eobs"], d2["eobs"])
+        for key in ["xsky", "ysky"]:
+            assert_allclose(d1[key].mean(), d2[key].mean(), rtol=1.0e-4)
+            assert_allclose(d1[key].std(), d2[key].std(), rtol=0.01)
+
+    # With threads the events do not depend on the number of threads
+    n = []
+    for n_threads in [1, 3]:
+        n.append(
+            make_events(
+                f"threads{n_threads}",
+                dd,
+                *args,
+                plaw_model(),
+                [0.1, 0.2, 1.0],
+                [30.0, 45.0],
+                absorb_model="wabs",
+                nH=0.1,
+                prng=27,
+                n_threads=n_threads,
+                estimate_counts=True,
+            )
+        )
+    assert n[0] == n[1]
+    assert 0 < n[0] < n_events
+    with h5py.File("threads1.h5", "r") as f1, h5py.File("threads3.h5", "r") as f3:
+        for key in f1["data"]:
+            assert_equal(f1["data"][key][()], f3["data"][key][()])
+
+    # All-sky events for an internal observer, which is much closer to
+    # the source so the exposure is much shorter
+    n_allsky = make_events(
+        "allsky",
+        dd,
+        0.0,
+        10.0,
+        1.0,
+        plaw_model(),
+        [1.0, 0.0, 0.0],
+        None,
+        observer="internal",
+        center=[0.5, 0.5, 0.5],
+        north_vector=[0.0, 0.0, 1.0],
+        prng=28,
+    )
+    allsky = EventList("allsky.h5")
+    assert allsky.observer == "internal"
+    assert allsky.tot_num_events == n_allsky > 0
+    with h5py.File("allsky.h5", "r") as f:
+        d = allsky._read_events(f)
+        assert np.all((d["ysky"] >= -90.0) & (d["ysky"] <= 90.0))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
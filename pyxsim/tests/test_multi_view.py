@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose, assert_equal
+from yt.testing import fake_random_ds
+
+from pyxsim import (
+    EventList,
+    PowerLawSourceModel,
+    make_photons,
+    project_photons,
+    project_photons_allsky,
+)
+
+
+def test_multi_view():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    fields = ("density", "velocity_x", "velocity_y", "velocity_z")
+    units = ("g/cm**3", "km/s", "km/s", "km/s")
+    ds = fake_random_ds(16, fields=fields, units=units, length_unit="Mpc")
+
+    def _emission(field, data):
+        return data.ds.quan(1.0e46, "cm**3/g/s/keV") * data["gas", "density"]
+
+    ds.add_field(
+        ("gas", "emission"),
+        function=_emission,
+        units="keV**-1*s**-1",
+        sampling_type="local",
+    )
+
+    dd = ds.all_data()
+
+    plaw_model = PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+    make_photons("photons", dd, 0.05, 1000.0, 1.0e5, plaw_model)
+
+    L = [0.1, 0.2, 1.0]
+    prefixes = ["view_z", "view_x", "view_L"]
+    n_views = project_photons(
+        "photons",
+        prefixes,
+        ["z", "x", L],
+        [[30.0, 45.0], [30.0, 45.0], [60.0, -10.0]],
+        north_vector=[None, None, [0.0, 1.0, 0.0]],
+        no_shifting=True,
+        prng=26,
+    )
+    assert len(n_views) == 3
+
+    # With only one view, the events are the same as they were before
+    n_single = project_photons(
+        "photons", ["single_z"], "z", [30.0, 45.0], no_shifting=True, prng=26
+    )
+    n_events = project_photons(
+        "photons", "events_z", "z", [30.0, 45.0], no_shifting=True, prng=26
+    )
+    assert n_single == [n_events]
+    with h5py.File("single_z.h5", "r") as f1, h5py.File("events_z.h5", "r") as f2:
+        for key in f2["data"]:
+            assert_equal(f1["data"][key][()], f2["data"][key][()])
+
+    # Each view is projected with its own parameters, and without
+    # absorption or Doppler shifts every photon is an event in every view
+    for prefix, n, normal in zip(prefixes, n_views, ["z", "x", L]):
+        events = EventList(f"{prefix}.h5")
+        assert events.tot_num_events == n == n_events
+        if isinstance(normal, str):
+            assert events.parameters["normal"] == normal
+        else:
+            assert_allclose(events.parameters["normal"], normal)
+    assert EventList("view_L.h5").parameters["sky_center"].tolist() == [60.0, -10.0]
+    with h5py.File("events_z.h5", "r") as f1, h5py.File("view_z.h5", "r") as f2:
+        assert_equal(f1["data"]["eobs"][()], f2["data"]["eobs"][()])
+        for key in ["xsky", "ysky"]:
+            assert_allclose(
+                f1["data"][key][()].mean(), f2["data"][key][()].mean(), rtol=1.0e-4
+            )
+
+    with pytest.raises(ValueError):
+        project_photons("photons", prefixes, ["z", "x"], [30.0, 45.0])
+    with pytest.raises(ValueError):
+        project_photons("photons", ["a", "a.h5"], "z", [30.0, 45.0])
+
+    # All-sky projections of an internal observer's photons
+    plaw_model = PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+    make_photons(
+        "photons_allsky",
+        dd,
+        0.0,
+        10.0,
+        1.0,
+        plaw_model,
+        observer="internal",
+        center=[0.5, 0.5, 0.5],
+    )
+    n_allsky = project_photons_allsky(
+        "photons_allsky",
+        ["allsky_x", "allsky_z"],
+        [[1.0, 0.0, 0.0], [0.0, 0.0, 1.0]],
+        prng=27,
+    )
+    for prefix, n in zip(["allsky_x", "allsky_z"], n_allsky):
+        with h5py.File(f"{prefix}.h5", "r") as f:
+            assert f["data"]["ysky"].size == n > 0
+            assert np.all(np.abs(f["data"]["ysky"][()]) <= 90.0)
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+from numpy.testing import assert_equal
+from yt.units.yt_array import YTQuantity
+from yt.utilities.cosmology import Cosmology
+from yt.utilities.physical_constants import mp
+
+from pyxsim import LineSourceModel, PowerLawSourceModel, make_photons, project_photons
+from pyxsim.tests.utils import BetaModelSource
+
+
+def test_photon_estimate():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    bms = BetaModelSource()
+    ds = bms.ds
+
+    def _hard_emission(field, data):
+        return (
+            data.ds.quan(1.0e-21, "s**-1*keV**-1")
+            * data["density"]
+            * data["cell_volume"]
+            / mp
+        )
+
+    ds.add_field(
+        ("gas", "hard_emission"),
+        function=_hard_emission,
+        units="keV**-1*s**-1",
+        sampling_type="local",
+    )
+
+    def _line_emission(field, data):
+        return (
+            data.ds.quan(1.0e-22, "s**-1") * data["density"] * data["cell_volume"] / mp
+        )
+
+    ds.add_field(
+        ("gas", "line_emission"),
+        function=_line_emission,
+        units="s**-1",
+        sampling_type="local",
+    )
+
+    A = YTQuantity(2000.0, "cm**2")
+    exp_time = YTQuantity(2.0e5, "s")
+    redshift = 0.01
+
+    sphere = ds.sphere("c", (100.0, "kpc"))
+
+    def plaw_model():
+        return PowerLawSourceModel(1.0, 0.01, 11.0, "hard_emission", 1.1, prng=33)
+
+    def line_model():
+        return LineSourceModel(3.5, "line_emission", sigma=(500.0, "km/s"), prng=32)
+
+    for model in [plaw_model, line_model]:
+
+        n_ph1, n_cells1 = make_photons(
+            "photons1.h5", sphere, redshift, A, exp_time, model()
+        )
+        n_ph2, n_cells2 = make_photons(
+            "photons2.h5",
+            sphere,
+            redshift,
+            A,
+            exp_time,
+            model(),
+            estimate_counts=True,
+        )
+
+        # Presizing must not change the photons which are generated
+        assert n_ph1 == n_ph2
+        assert n_cells1 == n_cells2
+        with h5py.File("photons1.h5", "r") as f1, h5py.File("photons2.h5", "r") as f2:
+            for key in f1["data"]:
+                assert_equal(f1["data"][key][()], f2["data"][key][()])
+
+        m = model()
+        m.setup_model("photons", sphere, redshift)
+        D_A = Cosmology().angular_diameter_distance(0.0, redshift).to_value("cm")
+        spectral_norm = float(A * exp_time) / (
+            4.0 * np.pi * D_A * D_A * (1.0 + redshift) ** 2
+        )
+        m.set_pv(*([None] * 7), "external")
+        est_ph, est_cells = m.estimate_photons(sphere, spectral_norm)
+        assert np.abs(n_ph1 - est_ph) < 5.0 * np.sqrt(est_ph)
+        assert np.abs(n_cells1 - est_cells) < 5.0 * np.sqrt(est_cells)
+
+    n_events = project_photons("photons2.h5", "events.h5", "z", [30.0, 45.0], prng=34)
+    # Without absorption every photon becomes an event, so the event
+    # list fills its presized datasets exactly
+    assert n_events == n_ph2
+    with h5py.File("events.h5", "r") as f:
+        assert f["data"]["eobs"].size == n_events
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
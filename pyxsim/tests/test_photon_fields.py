@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+from numpy.testing import assert_allclose
+from yt.testing import fake_random_ds
+
+from pyxsim import PowerLawSourceModel, make_photons
+
+
+def test_photon_fields():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    fields = ("density", "velocity_x", "velocity_y", "velocity_z")
+    units = ("g/cm**3", "cm/s", "cm/s", "cm/s")
+    ds = fake_random_ds(16, fields=fields, units=units, length_unit="Mpc")
+
+    def _emission(field, data):
+        return data.ds.quan(1.0e46, "cm**3/g/s/keV") * data["gas", "density"]
+
+    ds.add_field(
+        ("gas", "emission"),
+        function=_emission,
+        units="keV**-1*s**-1",
+        sampling_type="local",
+    )
+
+    # A sphere which crosses the periodic boundaries of the domain
+    sp = ds.sphere([0.05, 0.5, 0.95], (0.3, "Mpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+    make_photons(
+        "photons",
+        sp,
+        0.05,
+        1000.0,
+        1.0e5,
+        plaw_model,
+        fields_to_keep=[("gas", "density")],
+    )
+
+    dx_max = ds.index.get_smallest_dx().to_value("kpc")
+    v_max = np.sqrt(
+        sum(sp["gas", f"velocity_{ax}"].to_value("km/s") ** 2 for ax in "xyz")
+    ).max()
+    with h5py.File("photons.h5", "r") as f:
+        d = f["data"]
+        # The positions are wrapped across the boundaries and centered, and
+        # the velocities are in km/s
+        r = np.sqrt(d["x"][()] ** 2 + d["y"][()] ** 2 + d["z"][()] ** 2)
+        assert r.max() <= 300.0 + np.sqrt(3.0) * dx_max
+        v = np.sqrt(d["vx"][()] ** 2 + d["vy"][()] ** 2 + d["vz"][()] ** 2)
+        assert_allclose(v.max(), v_max, rtol=0.1)
+        assert np.all(d["dx"][()] == dx_max)
+        assert np.all(np.isin(d["density"][()], sp["gas", "density"].d))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+import yt
+from numpy.testing import assert_allclose, assert_equal
+from yt.testing import fake_random_ds
+from yt.utilities.grid_data_format.writer import write_to_gdf
+
+from pyxsim import (
+    EventList,
+    PhotonList,
+    PowerLawSourceModel,
+    make_photons,
+    project_photons,
+)
+
+
+def _emission(field, data):
+    return data.ds.quan(1.0e46, "cm**3/g/s/keV") * data["gas", "density"]
+
+
+def _load_dataset(filename):
+    ds = yt.load(filename)
+    ds.add_field(
+        ("gas", "emission"),
+        function=_emission,
+        units="keV**-1*s**-1",
+        sampling_type="local",
+    )
+    return ds
+
+
+def test_process_pool():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    fields = ("density", "velocity_x", "velocity_y", "velocity_z")
+    units = ("g/cm**3", "cm/s", "cm/s", "cm/s")
+    fake_ds = fake_random_ds(
+        32, nprocs=8, fields=fields, units=units, length_unit="Mpc"
+    )
+    write_to_gdf(fake_ds, "fake.gdf")
+
+    ds = _load_dataset("fake.gdf")
+    sp = ds.sphere("c", (0.4, "Mpc"))
+
+    plaw_model = PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+    n_ph1, n_cells1 = make_photons(
+        "photons1", sp, 0.05, 1000.0, 1.0e5, plaw_model, n_threads=1
+    )
+
+    contexts = ["fork", "spawn"]
+    for i, method in enumerate(contexts):
+        mp_context = multiprocessing.get_context(method)
+        with ProcessPoolExecutor(max_workers=3, mp_context=mp_context) as pool:
+            plaw_model = PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+            n_ph2, n_cells2 = make_photons(
+                f"photons_{method}",
+                sp,
+                0.05,
+                1000.0,
+                1.0e5,
+                plaw_model,
+                pool=pool,
+                load_func=_load_dataset,
+            )
+            if i == 0:
+                n_events, n_events_x = project_photons(
+                    f"photons_{method}",
+                    ["events", "events_x"],
+                    ["z", "x"],
+                    [30.0, 45.0],
+                    prng=34,
+                    pool=pool,
+                )
+
+        for j in range(3):
+            assert os.path.exists(f"photons_{method}.{j:04d}.h5")
+
+        # The same photons are generated as with threads, though the
+        # order of the chunks differs
+        assert n_ph1 == n_ph2
+        assert n_cells1 == n_cells2
+        with h5py.File("photons1.h5", "r") as f1, h5py.File(
+            f"photons_{method}.h5", "r"
+        ) as f2:
+            for key in f1["data"]:
+                assert_equal(np.sort(f1["data"][key][()]), np.sort(f2["data"][key][()]))
+
+        photons = PhotonList(f"photons_{method}.h5")
+        assert photons.tot_num_photons == n_ph1
+
+    events = EventList("events.h5")
+    assert events.tot_num_events == n_events
+    assert n_events == n_ph1
+    assert EventList("events_x.h5").tot_num_events == n_events_x
+    with h5py.File("events.h5", "r") as fe, h5py.File("photons1.h5", "r") as fp:
+        assert_allclose(fe["data"]["eobs"][()].sum(), fp["data"]["energy"][()].sum())
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
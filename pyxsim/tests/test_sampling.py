@@ -0,0 +1,132 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from pyxsim.lib.spectra import alias_sample, alias_tables, invert_cdf, mixture_sample
+from pyxsim.spectral_models import SpectralInterpolator1D
+
+
+def test_invert_cdf():
+    prng = np.random.default_rng(24)
+    num_cells, nbins = 50, 300
+    edges = np.linspace(0.1, 10.0, nbins + 1)
+    spec = prng.random((num_cells, nbins))
+    # Some bins and whole bands of the spectra have no emission
+    spec[:, 100:120] = 0.0
+    spec[spec < 0.05] = 0.0
+    p = spec / spec.sum(axis=-1)[:, np.newaxis]
+    cp = np.insert(np.cumsum(p, axis=-1), 0, 0.0, axis=1)
+    # Cells with none, few, and many photons
+    n_ph = prng.poisson(lam=prng.choice([0.5, 5.0, 500.0], size=num_cells))
+    randvec = prng.uniform(size=n_ph.sum())
+
+    energies = []
+    start = 0
+    for icell in range(num_cells):
+        u = np.sort(randvec[start : start + n_ph[icell]])
+        energies.append(np.interp(u, cp[icell, :], edges))
+        start += n_ph[icell]
+
+    assert_array_equal(invert_cdf(cp, edges, n_ph, randvec), np.concatenate(energies))
+
+
+def test_alias_sample():
+    prng = np.random.default_rng(25)
+    nbins = 200
+    spec = prng.random((3, nbins))
+    spec[:, 50:60] = 0.0
+    spec[1, :] = 0.0
+    spec[1, 17] = 3.0
+    spec[2, :] **= 8
+    prob, alias = alias_tables(spec)
+    n_ph = np.array([1000000, 1000, 1000000])
+    bins = alias_sample(prob, alias, n_ph, prng.uniform(size=n_ph.sum()))
+    assert np.all((bins >= 0) & (bins < nbins))
+    start = 0
+    for i, n in enumerate(n_ph):
+        counts = np.bincount(bins[start : start + n], minlength=nbins)
+        start += n
+        # Bins without emission are never drawn
+        assert np.all(counts[spec[i] == 0.0] == 0)
+        expected = n * spec[i] / spec[i].sum()
+        assert_allclose(counts, expected, atol=5.0 * np.sqrt(expected.max()))
+
+
+def test_mixture_sample():
+    prng = np.random.default_rng(26)
+    num_nodes, nbins = 10, 100
+    tbins = np.linspace(0.1, 10.0, num_nodes)
+    ebins = np.linspace(0.5, 5.0, nbins + 1)
+    cosmic_spec = prng.random((num_nodes, nbins))
+    metal_spec = prng.random((num_nodes, nbins)) ** 4
+    var_spec = prng.random((2, num_nodes, nbins)) ** 8
+    var_spec[1, 3, :] = 0.0
+    si = SpectralInterpolator1D(tbins, cosmic_spec, metal_spec, var_spec)
+    sums, cdfs = si.node_cdfs()
+    assert cdfs.shape == (4 * num_nodes, nbins + 1)
+
+    # The interpolated spectra are mixtures of the spectra at the nodes
+    kT = np.array([0.1, 2.5, 3.0, 9.99])
+    Z = np.array([[0.3, 1.0, 0.0, 2.0], [0.5, 0.2, 1.0, 0.1], [1.0, 0.0, 3.0, 1.0]])
+    cspec, mspec, vspec = si(kT)
+    spec = cspec + Z[0, :, np.newaxis] * mspec
+    spec += np.sum(Z[1:, :, np.newaxis] * vspec, axis=0)
+    x_i, xm, xp = si.node_weights(kT)
+    coeffs = np.vstack([np.ones(kT.size), Z]).T
+    weights = np.empty((kT.size, 4, 2))
+    weights[:, :, 0] = xm[:, np.newaxis] * coeffs * sums[:, x_i].T
+    weights[:, :, 1] = xp[:, np.newaxis] * coeffs * sums[:, x_i + 1].T
+    weights = weights.reshape(kT.size, 8)
+    node_spec = np.diff(cdfs, axis=-1).reshape(4, num_nodes, nbins)
+    mix_spec = np.zeros_like(spec)
+    for m in range(8):
+        rows = node_spec[m // 2, x_i + m % 2]
+        mix_spec += weights[:, m, np.newaxis] * rows
+    assert_allclose(mix_spec, spec, rtol=1.0e-10)
+
+    n_ph = np.array([200000, 0, 200000, 200000])
+    energies = mixture_sample(
+        cdfs, ebins, n_ph, x_i, weights, num_nodes, prng.uniform(size=2 * n_ph.sum())
+    )
+    assert np.all((energies >= ebins[0]) & (energies <= ebins[-1]))
+    start = 0
+    for i, n in enumerate(n_ph):
+        counts = np.histogram(energies[start : start + n], bins=ebins)[0]
+        start += n
+        expected = n * spec[i] / spec[i].sum()
+        assert_allclose(counts, expected, atol=5.0 * np.sqrt(expected.max()))
+
+
+def test_energy_windows():
+    num_nodes, nbins = 20, 2000
+    tbins = np.linspace(0.02, 10.0, num_nodes)
+    emid = np.linspace(0.05, 50.0, nbins)
+    kT = tbins[:, np.newaxis]
+    cosmic_spec = np.exp(-emid / kT)
+    metal_spec = np.exp(-0.5 * ((emid - 0.1 - 0.2 * kT) / 0.01) ** 2)
+    var_spec = np.array([np.exp(-emid / (2.0 * kT)), np.zeros((num_nodes, nbins))])
+    flux_tol = 1.0e-8
+    si = SpectralInterpolator1D(
+        tbins, cosmic_spec, metal_spec, var_spec, flux_tol=flux_tol
+    )
+    lo, hi = si.windows.T
+    # The windows of the cool nodes are much smaller than the band
+    assert hi[0] - lo[0] < nbins // 10
+    for spec in [cosmic_spec, metal_spec] + list(var_spec):
+        for i in range(num_nodes):
+            outside = spec[i, : lo[i]].sum() + spec[i, hi[i] :].sum()
+            assert outside <= flux_tol * spec[i].sum()
+
+    # The spectra in a window are the same as those over the whole band
+    t_vals = np.array([0.05, 0.5, 5.0])
+    c_lo, c_hi = si.cell_windows(t_vals)
+    window = (c_lo.min(), c_hi.max())
+    for s_win, s_all in zip(si(t_vals, window=window), si(t_vals)):
+        assert s_win.shape[-1] == window[1] - window[0]
+        assert_array_equal(s_win, s_all[..., window[0] : window[1]])
+
+    # With no tolerance, only the bins with no emission are left out
+    spec = np.zeros((2, nbins))
+    spec[0, 100:200] = 1.0
+    si = SpectralInterpolator1D(tbins[:2], spec, spec, None, flux_tol=0.0)
+    assert_array_equal(si.windows, [[100, 200], [0, 0]])
+    assert_array_equal(si.cell_windows(tbins[:2]), [[100, 100], [200, 200]])
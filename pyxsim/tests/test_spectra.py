@@ -1,7 +1,15 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
 import soxs
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_array_equal
+from soxs.constants import K_per_keV
 
+from pyxsim import table_cache
 from pyxsim.spectral_models import IGMSpectralModel, TableCIEModel
+from pyxsim.table_cache import get_tables, set_table_cache, table_cache_key
 
 
 def test_apec():
@@ -33,6 +41,23 @@ def test_apec():
     )
 
 
+def test_apec_float32():
+
+    kwargs = {"var_elem": ["O", "Fe"], "thermal_broad": True}
+    amod64 = TableCIEModel("apec", 0.1, 10.0, 10000, 1.0, 10.0, **kwargs)
+    amod32 = TableCIEModel(
+        "apec", 0.1, 10.0, 10000, 1.0, 10.0, dtype="float32", **kwargs
+    )
+    amod64.prepare_spectrum(0.2)
+    amod32.prepare_spectrum(0.2)
+    assert amod32.cosmic_spec.dtype == np.float32
+
+    kT = np.linspace(1.0, 10.0, 50)
+    for s32, s64 in zip(amod32.get_spectrum(kT), amod64.get_spectrum(kT)):
+        assert s32.dtype == np.float32
+        assert_allclose(s32, s64, rtol=1.0e-6, atol=1.0e-6 * s64.max())
+
+
 def test_igm():
 
     imod = IGMSpectralModel(0.2, 3.0, 1000)
@@ -76,3 +101,165 @@ def test_igm():
     assert_allclose(
         ec2 + 0.3 * em2, (spec4.emid * spec4.flux * spec4.de)[eidxs].value.sum()
     )
+
+
+def test_igm_cie_dispatch():
+
+    imod = IGMSpectralModel(0.2, 3.0, 1000, var_elem=["O", "Fe"])
+    imod.prepare_spectrum(0.05)
+
+    prng = np.random.default_rng(24)
+    kT = 10 ** prng.uniform(-3.0, 1.0, size=200)
+    nH = 10 ** prng.uniform(-7.0, 0.0, size=200)
+    use_igm = (kT >= imod.min_table_kT) & (kT <= imod.max_table_kT)
+    use_igm &= (nH >= imod.min_table_nH) & (nH <= imod.max_table_nH)
+    assert use_igm.any() and not use_igm.all()
+
+    # Each cell is interpolated from the IGM table, divided by its
+    # density, or from the CIE table
+    spec = imod.get_spectrum(kT, nH)
+    igm_spec = imod.si(np.log10(kT[use_igm] * K_per_keV), np.log10(nH[use_igm]))
+    cie_spec = imod.cie_model.get_spectrum(kT[~use_igm])
+    for s, s1, s2 in zip(spec, igm_spec, cie_spec):
+        s1 = s1 / nH[use_igm, np.newaxis]
+        atol = 1.0e-10 * np.abs(s1).max()
+        assert_allclose(s[..., use_igm, :], s1, rtol=1.0e-10, atol=atol)
+        assert_allclose(s[..., ~use_igm, :], s2, rtol=1.0e-10)
+
+    eidxs = (imod.ebins[:-1] > 0.5) & (imod.ebins[1:] < 2.0)
+    flux = imod.make_fluxf(0.5, 2.0)(kT, nH)
+    for f, s in zip(flux, spec):
+        assert_allclose(f, s[..., eidxs].sum(axis=-1), rtol=1.0e-8)
+
+
+def test_band_flux_cache():
+
+    kwargs = {"var_elem": ["O", "Fe"], "thermal_broad": True}
+    amod1 = TableCIEModel("apec", 0.1, 10.0, 10000, 0.1, 20.0, **kwargs)
+    amod2 = TableCIEModel("apec", 0.1, 10.0, 10000, 0.1, 20.0, **kwargs)
+    amod1.prepare_spectrum(0.0)
+    amod2.prepare_spectrum(0.0)
+
+    # Models with the same tables share their flux tables
+    pf = amod1.make_fluxf(0.5, 7.0)
+    assert amod2.make_fluxf(0.5, 7.0) is pf
+    assert amod1.make_fluxf(0.5, 7.0, energy=True) is not pf
+    amod2.prepare_spectrum(0.1)
+    assert amod2.make_fluxf(0.5, 7.0) is not pf
+
+    kT = np.linspace(0.2, 15.0, 100)
+    eidxs = (amod1.ebins[:-1] > 0.5) & (amod1.ebins[1:] < 7.0)
+    c, m, v = pf(kT)
+    cspec, mspec, vspec = amod1.get_spectrum(kT)
+    assert_allclose(c, cspec[:, eidxs].sum(axis=-1), rtol=1.0e-10)
+    assert_allclose(m, mspec[:, eidxs].sum(axis=-1), rtol=1.0e-10)
+    assert_allclose(v, vspec[:, :, eidxs].sum(axis=-1), rtol=1.0e-10)
+
+
+def test_table_cache(tmp_path):
+
+    kwargs = {"var_elem": ["O", "Fe"], "thermal_broad": True}
+    amod = TableCIEModel("apec", 0.1, 10.0, 10000, 0.1, 20.0, **kwargs)
+    amod.prepare_spectrum(0.05)
+
+    set_table_cache(str(tmp_path))
+    try:
+        amod1 = TableCIEModel("apec", 0.1, 10.0, 10000, 0.1, 20.0, **kwargs)
+        amod1.prepare_spectrum(0.05)
+        assert len(os.listdir(tmp_path)) == 1
+        # The tables are mapped from the cache as soon as they are stored
+        assert isinstance(amod1.cosmic_spec, np.memmap)
+        # The second model reads the tables stored by the first
+        amod2 = TableCIEModel("apec", 0.1, 10.0, 10000, 0.1, 20.0, **kwargs)
+        amod2.prepare_spectrum(0.05)
+        assert isinstance(amod2.cosmic_spec, np.memmap)
+        for name in ["cosmic_spec", "metal_spec", "var_spec"]:
+            assert_array_equal(getattr(amod2, name), getattr(amod, name))
+        kT = np.linspace(0.2, 15.0, 100)
+        for s1, s2 in zip(amod.get_spectrum(kT), amod2.get_spectrum(kT)):
+            assert_array_equal(s1, s2)
+
+        # Tables for other redshifts are stored separately, and the least
+        # recently used ones are removed when the cache is too large
+        entry_size = sum(
+            os.path.getsize(os.path.join(root, fn))
+            for root, _, fns in os.walk(tmp_path)
+            for fn in fns
+        )
+        set_table_cache(str(tmp_path), max_size=2.5 * entry_size)
+        amod2.prepare_spectrum(0.1)
+        entry = table_cache_key(amod2._table_key())
+        amod2.prepare_spectrum(0.05)
+        amod2.prepare_spectrum(0.2)
+        assert len(os.listdir(tmp_path)) == 2
+        assert entry not in os.listdir(tmp_path)
+
+        # Mapped tables are not pickled, but mapped again from the cache
+        amod3 = pickle.loads(pickle.dumps(amod2))
+        assert len(pickle.dumps(amod2)) < amod2.cosmic_spec.nbytes
+        assert isinstance(amod3.cosmic_spec, np.memmap)
+        assert amod3._zobs == 0.2
+        for s1, s2 in zip(amod2.get_spectrum(kT), amod3.get_spectrum(kT)):
+            assert_array_equal(s1, s2)
+    finally:
+        set_table_cache(None)
+
+
+class FakeNodeComm:
+    def __init__(self, rank, root_message=None):
+        self.rank = rank
+        self.root_message = root_message
+
+    def bcast(self, obj, root=0):
+        return obj if self.rank == root else self.root_message
+
+
+def test_table_cache_shared_error(tmp_path, monkeypatch):
+    def make_tables():
+        raise OSError("No space left on device")
+
+    set_table_cache(str(tmp_path), shared=True)
+    try:
+        # The process which makes the tables raises its own error, and
+        # the other processes on the node raise one too instead of waiting
+        monkeypatch.setattr(table_cache, "_node_comm", lambda: FakeNodeComm(0))
+        with pytest.raises(OSError):
+            get_tables(("test",), make_tables)
+        message = repr(OSError("No space left on device"))
+        monkeypatch.setattr(table_cache, "_node_comm", lambda: FakeNodeComm(1, message))
+        with pytest.raises(RuntimeError, match="No space left on device"):
+            get_tables(("test",), make_tables)
+    finally:
+        set_table_cache(None)
+
+
+def test_max_redshift():
+
+    kwargs = {"var_elem": ["O", "Fe"], "thermal_broad": True}
+    amod1 = TableCIEModel(
+        "apec", 0.1, 10.0, 2000, 0.1, 20.0, max_redshift=1.0, **kwargs
+    )
+    amod2 = TableCIEModel("apec", 0.1, 10.0, 2000, 0.1, 20.0, **kwargs)
+
+    kT = np.linspace(0.2, 15.0, 20)
+    for z in [0.0, 0.1, 0.5, 1.0]:
+        amod1.prepare_spectrum(z)
+        amod2.prepare_spectrum(z)
+        for s1, s2 in zip(amod1.get_spectrum(kT), amod2.get_spectrum(kT)):
+            # Lines may be shifted by up to a bin of the rest-frame tables,
+            # so the total fluxes and mean energies of the spectra are compared
+            assert_allclose(s1.sum(axis=-1), s2.sum(axis=-1), rtol=1.0e-2)
+            assert_allclose(
+                (s1 * amod1.emid).sum(axis=-1) / s1.sum(axis=-1),
+                (s2 * amod2.emid).sum(axis=-1) / s2.sum(axis=-1),
+                rtol=1.0e-3,
+            )
+    # The rest-frame tables are only made once
+    rest_model = amod1._rest_model
+    assert rest_model.nbins >= 8000
+    assert rest_model.ebins[-1] >= 20.0
+    amod1.prepare_spectrum(0.3)
+    assert amod1._rest_model is rest_model
+
+    with pytest.raises(ValueError):
+        amod1.prepare_spectrum(1.5)
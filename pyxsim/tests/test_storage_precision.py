@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose, assert_equal
+from yt.testing import fake_random_ds
+
+from pyxsim import (
+    EventList,
+    PowerLawSourceModel,
+    make_photons,
+    merge_files,
+    project_photons,
+)
+
+
+def test_storage_precision():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    fields = ("density", "velocity_x", "velocity_y", "velocity_z")
+    units = ("g/cm**3", "km/s", "km/s", "km/s")
+    ds = fake_random_ds(16, fields=fields, units=units, length_unit="Mpc")
+
+    def _emission(field, data):
+        return data.ds.quan(1.0e46, "cm**3/g/s/keV") * data["gas", "density"]
+
+    ds.add_field(
+        ("gas", "emission"),
+        function=_emission,
+        units="keV**-1*s**-1",
+        sampling_type="local",
+    )
+
+    dd = ds.all_data()
+
+    for precision in ["float64", "uint16"]:
+        plaw_model = PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+        make_photons(
+            f"photons_{precision}",
+            dd,
+            0.05,
+            1000.0,
+            1.0e5,
+            plaw_model,
+            storage_precision=precision,
+        )
+        project_photons(
+            f"photons_{precision}",
+            f"events_{precision}",
+            "z",
+            [30.0, 45.0],
+            prng=26,
+        )
+
+    with h5py.File("photons_float64.h5", "r") as f64, h5py.File(
+        "photons_uint16.h5", "r"
+    ) as f16:
+        assert "storage_precision" not in f64["parameters"]
+        assert f16["parameters"]["storage_precision"].asstr()[()] == "uint16"
+        assert f16["data"]["x"].dtype == np.float32
+        assert f16["data"]["energy"].dtype == np.uint16
+        assert_equal(f64["data"]["num_photons"][()], f16["data"]["num_photons"][()])
+        for key in ["x", "y", "z", "vx", "vy", "vz", "dx"]:
+            assert_allclose(f64["data"][key][()], f16["data"][key][()], rtol=1.0e-6)
+        # Energies are rounded to the nearest code
+        scale = f16["parameters"]["energy_scale"][()]
+        e16 = f16["parameters"]["energy_offset"][()] + scale * f16["data"]["energy"][()]
+        assert np.abs(f64["data"]["energy"][()] - e16).max() <= 0.5 * scale
+
+    events64 = EventList("events_float64.h5")
+    events16 = EventList("events_uint16.h5")
+    assert events16.parameters["storage_precision"] == "uint16"
+    assert events64.tot_num_events == events16.tot_num_events
+    with h5py.File("events_float64.h5", "r") as f64, h5py.File(
+        "events_uint16.h5", "r"
+    ) as f16:
+        d64 = events64._read_events(f64)
+        d16 = events16._read_events(f16)
+        assert f16["data"]["xsky"].dtype == np.float32
+        assert_allclose(d64["xsky"], d16["xsky"], rtol=1.0e-9)
+        assert_allclose(d64["ysky"], d16["ysky"], rtol=1.0e-9)
+        assert_allclose(d64["eobs"], d16["eobs"], atol=1.0e-3)
+
+    # Files stored the same way are merged as they are stored
+    merge_files(["events_uint16.h5", "events_uint16.h5"], "merged_uint16.h5")
+    with h5py.File("merged_uint16.h5", "r") as f:
+        assert f["data"]["eobs"].dtype == np.uint16
+    merged = EventList("merged_uint16.h5")
+    with h5py.File("merged_uint16.h5", "r") as f:
+        assert_equal(merged._read_events(f)["eobs"], np.tile(d16["eobs"], 2))
+
+    # Otherwise they are decoded
+    merge_files(["events_float64.h5", "events_uint16.h5"], "merged.h5")
+    merged = EventList("merged.h5")
+    assert "storage_precision" not in merged.parameters
+    with h5py.File("merged.h5", "r") as f:
+        assert f["data"]["eobs"].dtype == np.float64
+        assert_equal(f["data"]["eobs"][()], np.concatenate([d64["eobs"], d16["eobs"]]))
+
+    with pytest.raises(RuntimeError):
+        merge_files(
+            ["events_float64.h5", "events_uint16.h5"],
+            "virtual.h5",
+            virtual=True,
+        )
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+from numpy.testing import assert_equal
+from yt.testing import fake_random_ds
+
+from pyxsim import PowerLawSourceModel, make_photons
+
+
+def test_threads():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    fields = ("density", "velocity_x", "velocity_y", "velocity_z")
+    units = ("g/cm**3", "cm/s", "cm/s", "cm/s")
+    ds = fake_random_ds(32, nprocs=8, fields=fields, units=units, length_unit="Mpc")
+
+    def _emission(field, data):
+        return data.ds.quan(1.0e46, "cm**3/g/s/keV") * data["gas", "density"]
+
+    ds.add_field(
+        ("gas", "emission"),
+        function=_emission,
+        units="keV**-1*s**-1",
+        sampling_type="local",
+    )
+
+    dd = ds.all_data()
+
+    n = []
+    for i, n_threads in enumerate([1, 3]):
+        plaw_model = PowerLawSourceModel(1.0, 0.1, 10.0, "emission", 1.2, prng=25)
+        n.append(
+            make_photons(
+                f"photons{i}",
+                dd,
+                0.05,
+                1000.0,
+                1.0e5,
+                plaw_model,
+                n_threads=n_threads,
+            )
+        )
+
+    # The photons should not depend on the number of threads
+    assert n[0] == n[1]
+    assert n[0][0] > 0
+    with h5py.File("photons0.h5", "r") as f0, h5py.File("photons1.h5", "r") as f1:
+        for key in f0["data"]:
+            assert_equal(f0["data"][key][()], f1["data"][key][()])
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
@@ -1,7 +1,12 @@
+import pickle
+import threading
+
+import numpy as np
 from astropy.units import Quantity
+from numpy.testing import assert_equal
 from yt import YTQuantity
 
-from pyxsim.utils import parse_value
+from pyxsim.utils import BufferPool, parse_value
 
 
 def test_parse_value():
@@ -13,3 +18,24 @@ def test_parse_value():
     assert t_astropy == t_yt
     assert t_float == t_yt
     assert t_tuple == t_yt
+
+
+def test_buffer_pool():
+    pool = BufferPool()
+    a = pool.get("a", (10,))
+    a[:] = np.arange(10)
+    # Growing the array keeps the values which are asked for
+    b = pool.get("a", (4, 5), keep=10)
+    assert b.shape == (4, 5)
+    assert_equal(b.ravel()[:10], np.arange(10))
+    # Smaller arrays are views of the same memory
+    c = pool.get("a", (3,))
+    assert np.shares_memory(b, c)
+
+    # Other threads and processes get their own arrays
+    other = []
+    t = threading.Thread(target=lambda: other.append(pool.get("a", (3,))))
+    t.start()
+    t.join()
+    assert not np.shares_memory(other[0], c)
+    assert "a" not in pickle.loads(pickle.dumps(pool))._local.__dict__
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+import pytest
+from numpy.testing import assert_equal
+
+from pyxsim.utils import merge_files
+from pyxsim.writers import BackgroundWriter, DatasetAppender, StoragePolicy
+
+
+def test_dataset_appender():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    prng = np.random.RandomState(24)
+
+    with h5py.File("appender.h5", "w") as f:
+        app = DatasetAppender(f, ["a", "n"], dtypes={"n": "int64"}, init_size=10)
+        a = []
+        n = []
+        for size in [3, 0, 25, 7]:
+            a.append(prng.uniform(size=size))
+            n.append(prng.randint(0, 100, size=size))
+            app.append({"a": a[-1], "n": n[-1]})
+        app.finalize()
+        assert f["n"].dtype == np.dtype("int64")
+        assert_equal(f["a"][()], np.concatenate(a))
+        assert_equal(f["n"][()], np.concatenate(n))
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_storage_policy():
+
+    tmpdir = tempfile.mkdtemp()
+    curdir = os.getcwd()
+    os.chdir(tmpdir)
+
+    prng = np.random.RandomState(25)
+    a = prng.uniform(size=5000)
+
+    policies = [
+        StoragePolicy(chunk_size=1000),
+        StoragePolicy(compression="gzip", compression_level=6),
+        StoragePolicy(compression="lzf", shuffle=False, chunk_size=700),
+    ]
+    try:
+        import hdf5plugin  # noqa: F401
+
+        policies.append(StoragePolicy(compression="blosc", blosc_compressor="zstd"))
+    except ImportError:
+        pass
+
+    for i, policy in enumerate(policies):
+        fn = f"policy{i}.h5"
+        with h5py.File(fn, "w") as f:
+            f.create_group("parameters").create_dataset("exp_time", data=1.0)
+            f.create_group("info")
+            d = f.create_group("data")
+            app = DatasetAppender(d, ["a"], init_size=100, policy=policy)
+            for start in range(0, a.size, 1500):
+                app.append({"a": a[start : start + 1500]})
+            app.finalize()
+            dset = d["a"]
+            if policy.chunk_size is not None:
+                assert dset.chunks == (policy.chunk_size,)
+            if policy.compression in ["gzip", "lzf"]:
+                assert dset.compression == policy.compression
+                assert dset.shuffle == policy.shuffle
+            assert_equal(dset[()], a)
+        merge_files([fn, fn], f"merged{i}.h5", storage_policy=policy)
+        with h5py.File(f"merged{i}.h5", "r") as f:
+            dset = f["data"]["a"]
+            if policy.compression in ["gzip", "lzf"]:
+                assert dset.compression == policy.compression
+            assert_equal(dset[()], np.tile(a, 2))
+
+    with pytest.raises(ValueError):
+        StoragePolicy(compression="bzip2")
+
+    os.chdir(curdir)
+    shutil.rmtree(tmpdir)
+
+
+def test_background_writer():
+
+    for queue_size in [0, 1, 3]:
+        written = []
+        flushes = []
+        writer = BackgroundWriter(
+            written.append,
+            lambda: flushes.append(len(written)),
+            queue_size=queue_size,
+            flush_every=2,
+        )
+        for i in range(5):
+            writer.put(i)
+        writer.close()
+        # Buffers are written in the order they are put
+        assert written == list(range(5))
+        # The last flush is the one on close
+        assert flushes == [2, 4, 5]
+
+
+def test_background_writer_error():
+    def write_func(buf):
+        if buf == 1:
+            raise OSError("Disk full!")
+
+    writer = BackgroundWriter(write_func, queue_size=1)
+    try:
+        for i in range(10):
+            writer.put(i)
+        writer.close()
+    except RuntimeError as e:
+        assert isinstance(e.__cause__, OSError)
+    else:
+        raise AssertionError("The write error was not raised!")
@@ -1,4 +1,5 @@
 import logging
+import threading
 
 import numpy as np
 from astropy.units import Quantity
@@ -56,11 +57,30 @@ def ensure_list(obj):
     return list(always_iterable(obj))
 
 
+def draw_seed(prng):
+    """
+    Draw an integer seed from the random number generator *prng*.
+    """
+    if isinstance(prng, np.random.Generator):
+        return int(prng.integers(np.iinfo("int64").max))
+    return int(prng.randint(np.iinfo("int32").max))
+
+
+def chunk_prng(seed, ichunk):
+    """
+    Return a random number generator for the chunk *ichunk* of a
+    data source, seeded from *seed* and the chunk index so that every
+    chunk has an independent stream of random numbers which does not
+    depend on the order that the chunks are processed in.
+    """
+    return np.random.default_rng([seed, ichunk])
+
+
 def validate_parameters(first, second, skip=None):
     if skip is None:
         skip = []
-    keys1 = list(first.keys())
-    keys2 = list(second.keys())
+    keys1 = [k for k in first.keys() if k not in skip]
+    keys2 = [k for k in second.keys() if k not in skip]
     keys1.sort()
     keys2.sort()
     if keys1 != keys2:
@@ -87,7 +107,14 @@ def validate_parameters(first, second, skip=None):
                 )
 
 
-def merge_files(input_files, output_file, overwrite=False, add_exposure_times=False):
+def merge_files(
+    input_files,
+    output_file,
+    overwrite=False,
+    add_exposure_times=False,
+    virtual=False,
+    storage_policy=None,
+):
     r"""
     Helper function for merging PhotonList or EventList HDF5 files.
     Parameters
@@ -102,6 +129,22 @@ def merge_files(input_files, output_file, overwrite=False, add_exposure_times=Fa
     add_exposure_times : boolean, default False
         If set to True, exposure times will be added together. Otherwise,
         the exposure times of all of the files must be the same.
+    virtual : boolean, default False
+        If set to True, the data in the merged file are virtual datasets
+        which refer to the data in the input files instead of copies of
+        them, so the input files must be kept alongside it.
+    storage_policy : :class:`~pyxsim.writers.StoragePolicy`, optional
+        The HDF5 chunk layout and compression of the merged data. This
+        is not used for virtual datasets, which keep the layout of the
+        input files. If not set, the merged data are not chunked or
+        compressed.
+
+    Files which were stored at a reduced precision (see the
+    *storage_precision* argument of :func:`~pyxsim.photon_list.make_photons`)
+    are merged at that precision if they were all stored the same way.
+    Otherwise, their data are decoded and the merged file is stored in
+    double precision, which cannot be done with *virtual*.
+
     Examples
     --------
     >>> from pyxsim import merge_files
@@ -113,17 +156,39 @@ def merge_files(input_files, output_file, overwrite=False, add_exposure_times=Fa
     same values, with the exception of the exposure time parameter "exp_time". If
     add_exposure_times=False, the maximum exposure time will be used.
     """
+    import os
     from collections import defaultdict
 
     import h5py
     from pathlib import Path
 
+    from pyxsim.writers import StorageFormat
+
     if Path(output_file).exists() and not overwrite:
         raise IOError(
             f"Cannot overwrite existing file {output_file}. "
             "If you want to do this, set overwrite=True."
         )
 
+    storage = []
+    for fn in input_files:
+        with h5py.File(fn, "r") as f:
+            storage.append(StorageFormat.from_parameters(f["parameters"]))
+    decode = any(fmt != storage[0] for fmt in storage[1:])
+    if decode and virtual:
+        raise RuntimeError(
+            "Cannot make a virtual merged file from files which were "
+            "stored at different precisions!"
+        )
+    # The keys of the parameters which record how a file is stored
+    storage_keys = []
+    if decode:
+        for fmt in storage:
+            if fmt.precision != "float64":
+                storage_keys.append("storage_precision")
+            storage_keys += [f"{field}_offset" for field in fmt.offsets]
+            storage_keys += [f"{field}_scale" for field in fmt.scales]
+
     f_in = h5py.File(input_files[0], "r")
     f_out = h5py.File(output_file, "w")
 
@@ -132,10 +197,12 @@ def merge_files(input_files, output_file, overwrite=False, add_exposure_times=Fa
     for key, param in f_in["parameters"].items():
         if key.endswith("exp_time"):
             exp_time_key = key
-        else:
+        elif key not in storage_keys:
             p_out[key] = param[()]
 
-    skip = [exp_time_key] if add_exposure_times else []
+    skip = storage_keys.copy()
+    if add_exposure_times:
+        skip.append(exp_time_key)
     for fn in input_files[1:]:
         with h5py.File(fn, "r") as f:
             validate_parameters(f_in["parameters"], f["parameters"], skip=skip)
@@ -154,7 +221,23 @@ def merge_files(input_files, output_file, overwrite=False, add_exposure_times=Fa
             else:
                 tot_exp_time = max(tot_exp_time, f["/parameters"][exp_time_key][()])
             for key in f["/data"]:
-                data[key].append(f["/data"][key][:])
+                if virtual:
+                    # The input files are referred to relative to the
+                    # merged file, so that they can be moved together
+                    fn_rel = os.path.relpath(
+                        os.path.abspath(fn),
+                        os.path.dirname(os.path.abspath(output_file)),
+                    )
+                    dset = f["/data"][key]
+                    data[key].append(
+                        h5py.VirtualSource(
+                            fn_rel, dset.name, shape=dset.shape, dtype=dset.dtype
+                        )
+                    )
+                elif decode:
+                    data[key].append(storage[i].read_field(f["/data"], key))
+                else:
+                    data[key].append(f["/data"][key][:])
             for key, value in f["info"].attrs.items():
                 info.attrs[f"{key}_{i}"] = value
 
@@ -164,7 +247,28 @@ def merge_files(input_files, output_file, overwrite=False, add_exposure_times=Fa
 
     d = f_out.create_group("data")
     for k in data:
-        d.create_dataset(k, data=np.concatenate(data[k]))
+        if virtual:
+            sources = [src for src in data[k] if src.shape[0] > 0]
+            n = sum(src.shape[0] for src in sources)
+            if n == 0:
+                d.create_dataset(k, data=np.zeros(0, dtype=data[k][0].dtype))
+                continue
+            layout = h5py.VirtualLayout(shape=(n,), dtype=data[k][0].dtype)
+            offset = 0
+            for src in sources:
+                layout[offset : offset + src.shape[0]] = src
+                offset += src.shape[0]
+            d.create_virtual_dataset(k, layout)
+        else:
+            merged = np.concatenate(data[k])
+            kwargs = {}
+            if storage_policy is not None and merged.size > 0:
+                kwargs = storage_policy.dataset_kwargs(
+                    merged.size, itemsize=merged.itemsize
+                )
+                # Chunks cannot be larger than a dataset of fixed size
+                kwargs["chunks"] = (min(kwargs["chunks"][0], merged.size),)
+            d.create_dataset(k, data=merged, **kwargs)
 
     f_out.close()
 
@@ -234,3 +338,46 @@ class ParallelProgressBar:
 
     def close(self):
         mylog.info("Finishing %s", self.title)
+
+
+class BufferPool:
+    """
+    Scratch arrays which are reused from one call to the next, and are
+    only ever grown. Each thread gets its own arrays, and a pool which
+    is sent to another process starts out empty there.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self._local = threading.local()
+
+    def get(self, name, shape, keep=0, dtype="float64"):
+        """
+        Get the scratch array *name* with the given *shape* and *dtype*.
+        Its values are not initialized, except that the first *keep* values
+        of the flattened array are those from the last time it was gotten.
+        """
+        buffers = self._local.__dict__
+        size = int(np.prod(shape))
+        buf = buffers.get(name)
+        if buf is not None and buf.dtype == dtype and buf.size >= size:
+            return buf[:size].reshape(shape)
+        new_size = size
+        if buf is not None and buf.dtype == dtype:
+            new_size = max(size, 2 * buf.size)
+        new_buf = np.empty(new_size, dtype=dtype)
+        if keep > 0:
+            new_buf[:keep] = buf[:keep]
+        buffers[name] = new_buf
+        return new_buf[:size].reshape(shape)
+
+    def clear(self):
+        """
+        Free the arrays of the current thread.
+        """
+        self._local.__dict__.clear()
@@ -0,0 +1,468 @@
+"""
+Writers for photon and event lists
+"""
+import queue
+import threading
+import time
+
+import numpy as np
+
+from pyxsim.utils import mylog
+
+
+def presize(n_expected, margin=0.05):
+    """
+    The number of rows to allocate for a dataset which is expected
+    to hold *n_expected* Poisson-distributed rows: the expectation
+    plus a fractional *margin* and five standard deviations.
+    """
+    n_expected = max(float(n_expected), 0.0)
+    return int(np.ceil(n_expected * (1.0 + margin) + 5.0 * np.sqrt(n_expected))) + 1
+
+
+def chunk_rows(size, itemsize=8, target_bytes=1 << 20):
+    """
+    The number of rows in an HDF5 chunk of a 1D dataset which has
+    *size* rows of *itemsize* bytes, aiming for chunks of about
+    *target_bytes*.
+    """
+    return int(max(1, min(size, target_bytes // itemsize)))
+
+
+class StoragePolicy:
+    """
+    The HDF5 chunk layout and compression of the datasets of photon and
+    event lists.
+
+    Parameters
+    ----------
+    chunk_size : integer, optional
+        The number of elements in each HDF5 chunk. If not set, it is
+        chosen from the expected size of the dataset, aiming for chunks
+        of about 1 MB.
+    compression : string, optional
+        The compression filter: "gzip", "lzf", or "blosc". Blosc requires
+        the hdf5plugin package, and the files can then only be read where
+        it is installed. If not set, the datasets are not compressed.
+    compression_level : integer, optional
+        The compression level, from 0 to 9, for "gzip" and "blosc". Not
+        used for "lzf". Default: 4
+    shuffle : boolean, optional
+        Whether to shuffle the bytes of the elements before they are
+        compressed, which usually compresses floating-point data better.
+        For "blosc", Blosc's own byte shuffle is used. Default: True
+    blosc_compressor : string, optional
+        The compressor used inside Blosc, e.g. "lz4", "lz4hc", "zstd", or
+        "zlib". Default: "lz4"
+
+    Examples
+    --------
+    >>> policy = StoragePolicy(compression="lzf", chunk_size=131072)
+    >>> pyxsim.make_photons("my_photons", sp, redshift, area, time,
+    ...                     thermal_model, storage_policy=policy)
+    """
+
+    def __init__(
+        self,
+        chunk_size=None,
+        compression=None,
+        compression_level=4,
+        shuffle=True,
+        blosc_compressor="lz4",
+    ):
+        if compression not in (None, "gzip", "lzf", "blosc"):
+            raise ValueError(f"Unknown compression filter '{compression}'!")
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.shuffle = shuffle
+        self.blosc_compressor = blosc_compressor
+
+    def __repr__(self):
+        return (
+            f"StoragePolicy(chunk_size={self.chunk_size}, "
+            f"compression={self.compression!r}, "
+            f"compression_level={self.compression_level}, "
+            f"shuffle={self.shuffle}, "
+            f"blosc_compressor={self.blosc_compressor!r})"
+        )
+
+    def dataset_kwargs(self, size, itemsize=8):
+        """
+        The keyword arguments for :meth:`~h5py.Group.create_dataset`
+        which lay out a 1D dataset which is expected to have *size*
+        elements of *itemsize* bytes.
+        """
+        if self.chunk_size is None:
+            rows = chunk_rows(size, itemsize=itemsize)
+        else:
+            rows = self.chunk_size
+        kwargs = {"chunks": (max(int(rows), 1),)}
+        if self.compression == "blosc":
+            try:
+                import hdf5plugin
+            except ImportError:
+                raise ImportError("Blosc compression requires the hdf5plugin package!")
+            shuffle = hdf5plugin.Blosc.SHUFFLE if self.shuffle else 0
+            kwargs.update(
+                hdf5plugin.Blosc(
+                    cname=self.blosc_compressor,
+                    clevel=self.compression_level,
+                    shuffle=shuffle,
+                )
+            )
+        elif self.compression is not None:
+            kwargs["compression"] = self.compression
+            if self.compression == "gzip":
+                kwargs["compression_opts"] = self.compression_level
+            kwargs["shuffle"] = self.shuffle
+        return kwargs
+
+
+storage_precisions = ("float64", "float32", "uint16", "uint32")
+
+
+class StorageFormat:
+    """
+    How the floating-point columns of a photon or event list are stored
+    on disk. With a precision of "float64" they are stored as they are.
+    Otherwise the position and velocity columns, which are stored
+    relative to an origin, are stored as "float32", and the energy
+    column is stored either as "float32" or, for the "uint16" and
+    "uint32" precisions, as integer codes on an evenly spaced grid
+    between the minimum and maximum energy. A stored column is decoded
+    as ``offset + scale * stored``, and the offsets and scales are
+    recorded in the parameters of the file.
+
+    Parameters
+    ----------
+    precision : string, optional
+        One of "float64", "float32", "uint16", or "uint32". Default: "float64"
+    float_fields : list of strings, optional
+        The columns which are stored as "float32" unless the precision
+        is "float64".
+    offsets : dict, optional
+        Values which are subtracted from columns before they are stored,
+        keyed by column name.
+    energy_field : string, optional
+        The name of the energy column.
+    energy_range : tuple of floats, optional
+        The minimum and maximum energy, which set the grid of the integer
+        codes. Energies outside of this range are clipped to it. If not
+        set, the energies are stored as "float32" for the "uint16" and
+        "uint32" precisions.
+    """
+
+    def __init__(
+        self,
+        precision="float64",
+        float_fields=None,
+        offsets=None,
+        energy_field=None,
+        energy_range=None,
+    ):
+        if precision not in storage_precisions:
+            raise ValueError(
+                f"'storage_precision' must be one of {storage_precisions}, "
+                f"not '{precision}'!"
+            )
+        self.precision = precision
+        self.dtypes = {}
+        self.offsets = {}
+        self.scales = {}
+        if precision == "float64":
+            return
+        if float_fields is None:
+            float_fields = []
+        for field in float_fields:
+            self.dtypes[field] = "float32"
+        if offsets is not None:
+            self.offsets.update(offsets)
+        if energy_field is not None:
+            self.dtypes[energy_field] = "float32"
+            if precision.startswith("uint"):
+                if energy_range is None:
+                    mylog.warning(
+                        "The range of the energies is not known, so they "
+                        "will be stored as 'float32' instead of '%s'.",
+                        precision,
+                    )
+                else:
+                    emin, emax = energy_range
+                    n_codes = np.iinfo(precision).max
+                    self.dtypes[energy_field] = precision
+                    self.offsets[energy_field] = float(emin)
+                    # All of the energies get code 0 if they are the same
+                    self.scales[energy_field] = float(emax - emin) / n_codes or 1.0
+
+    def __eq__(self, other):
+        return (
+            self.precision == other.precision
+            and self.offsets == other.offsets
+            and self.scales == other.scales
+        )
+
+    @classmethod
+    def from_parameters(cls, p):
+        """
+        Read the storage format of a photon or event list from its
+        parameters group *p*.
+        """
+        if "storage_precision" not in p:
+            return cls()
+        fmt = cls(p["storage_precision"].asstr()[()])
+        for key in p:
+            if key.endswith("_offset"):
+                fmt.offsets[key[: -len("_offset")]] = float(p[key][()])
+            elif key.endswith("_scale"):
+                fmt.scales[key[: -len("_scale")]] = float(p[key][()])
+        return fmt
+
+    def write_parameters(self, p):
+        """
+        Record the storage format in the parameters group *p*.
+        Nothing is recorded for "float64".
+        """
+        if self.precision == "float64":
+            return
+        p.create_dataset("storage_precision", data=self.precision)
+        for field, offset in self.offsets.items():
+            p.create_dataset(f"{field}_offset", data=offset)
+        for field, scale in self.scales.items():
+            p.create_dataset(f"{field}_scale", data=scale)
+
+    def encode(self, data):
+        """
+        Convert the arrays in the dict *data*, keyed by column name, to
+        the way they are stored.
+        """
+        out = {}
+        for field, values in data.items():
+            if field in self.dtypes and values is not None:
+                if field in self.offsets:
+                    values = values - self.offsets[field]
+                if field in self.scales:
+                    n_codes = np.iinfo(self.dtypes[field]).max
+                    values = np.clip(np.rint(values / self.scales[field]), 0, n_codes)
+                values = values.astype(self.dtypes[field])
+            out[field] = values
+        return out
+
+    def decode(self, field, values):
+        """
+        Convert the stored *values* of the column *field* back to
+        "float64" values.
+        """
+        if field in self.scales:
+            values = values * self.scales[field]
+        elif values.dtype == np.float32:
+            values = values.astype("float64")
+        if field in self.offsets:
+            values = values + self.offsets[field]
+        return values
+
+    def read_field(self, group, field, sel=slice(None)):
+        """
+        Read and decode the selection *sel* of the column *field* from
+        the HDF5 group *group*.
+        """
+        return self.decode(field, group[field][sel])
+
+
+class DatasetAppender:
+    """
+    Append rows to a set of resizable 1D HDF5 datasets which all have
+    the same length, such as the per-cell fields of a photon list.
+
+    Parameters
+    ----------
+    group : :class:`~h5py.Group`
+        The HDF5 group to create the datasets in.
+    fields : list of strings
+        The names of the datasets.
+    dtypes : dict, optional
+        The data types of the datasets, keyed by name. Datasets which are
+        not in this dict are "float64".
+    init_size : integer, optional
+        The initial size of the datasets. They are doubled in size
+        whenever they run out of room. Default: 100000
+    chunk_rows : integer, optional
+        The number of rows in each HDF5 chunk of the datasets. If not
+        set, h5py guesses a chunk shape from the initial size.
+    policy : :class:`~pyxsim.writers.StoragePolicy`, optional
+        The chunk layout and compression of the datasets. The chunk size
+        of the policy takes precedence over *chunk_rows*, which is used
+        in its place if the policy does not set one.
+    """
+
+    def __init__(
+        self,
+        group,
+        fields,
+        dtypes=None,
+        init_size=100000,
+        chunk_rows=None,
+        policy=None,
+    ):
+        if dtypes is None:
+            dtypes = {}
+        self.fields = list(fields)
+        self.size = max(init_size, 1)
+        self.offset = 0
+        self.datasets = {}
+        for field in self.fields:
+            dtype = np.dtype(dtypes.get(field, "float64"))
+            if policy is not None:
+                size = self.size if chunk_rows is None else chunk_rows
+                kwargs = policy.dataset_kwargs(size, itemsize=dtype.itemsize)
+            elif chunk_rows is None:
+                kwargs = {"chunks": True}
+            else:
+                kwargs = {"chunks": (chunk_rows,)}
+            # Storage is only allocated as chunks are written, so a
+            # generous initial size does not cost anything up front
+            self.datasets[field] = group.create_dataset(
+                field,
+                shape=(self.size,),
+                maxshape=(None,),
+                dtype=dtype,
+                **kwargs,
+            )
+
+    def append(self, data):
+        """
+        Append the arrays in the dict *data*, keyed by dataset name.
+        """
+        n = data[self.fields[0]].size
+        if n == 0:
+            return
+        if self.size < self.offset + n:
+            while self.offset + n > self.size:
+                self.size *= 2
+            for field in self.fields:
+                self.datasets[field].resize((self.size,))
+        for field in self.fields:
+            self.datasets[field][self.offset : self.offset + n] = data[field]
+        self.offset += n
+
+    def finalize(self):
+        """
+        Shrink the datasets to the number of rows which were written.
+        """
+        if self.size != self.offset:
+            for field in self.fields:
+                self.datasets[field].resize((self.offset,))
+            self.size = self.offset
+
+
+class BackgroundWriter:
+    """
+    Hand buffers of data to a write function which runs on a background
+    thread, so that computing the data for the next buffer can overlap
+    with writing and flushing the last one. Buffers wait in a bounded
+    queue, and :meth:`put` blocks when the queue is full.
+
+    Parameters
+    ----------
+    write_func : callable
+        The function which writes a single buffer.
+    flush_func : callable, optional
+        The function which flushes the written data to disk.
+    queue_size : integer, optional
+        The maximum number of buffers which can wait to be written. If 0,
+        buffers are written synchronously by :meth:`put` without using a
+        background thread. Default: 2
+    flush_every : integer, optional
+        Flush after this many buffers have been written. If None, only
+        flush when the writer is closed. Default: 1
+
+    Attributes
+    ----------
+    put_wait_time : float
+        The time in seconds that :meth:`put` spent waiting for room in
+        the queue, i.e. how long computation stalled on writing.
+    get_wait_time : float
+        The time in seconds that the writer spent waiting for buffers,
+        i.e. how long writing stalled on computation.
+    write_time : float
+        The time in seconds spent writing and flushing buffers.
+    """
+
+    def __init__(self, write_func, flush_func=None, queue_size=2, flush_every=1):
+        self.write_func = write_func
+        self.flush_func = flush_func
+        self.queue_size = queue_size
+        self.flush_every = flush_every
+        self.num_written = 0
+        self.put_wait_time = 0.0
+        self.get_wait_time = 0.0
+        self.write_time = 0.0
+        self._error = None
+        if queue_size > 0:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        else:
+            self._queue = None
+            self._thread = None
+
+    def _write(self, buf):
+        t0 = time.perf_counter()
+        self.write_func(buf)
+        self.num_written += 1
+        if self.flush_func is not None and self.flush_every:
+            if self.num_written % self.flush_every == 0:
+                self.flush_func()
+        self.write_time += time.perf_counter() - t0
+
+    def _run(self):
+        while True:
+            t0 = time.perf_counter()
+            buf = self._queue.get()
+            self.get_wait_time += time.perf_counter() - t0
+            if buf is None:
+                break
+            # After an error we keep draining the queue so that put()
+            # never blocks forever, but we don't write anything else
+            if self._error is None:
+                try:
+                    self._write(buf)
+                except Exception as e:
+                    self._error = e
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError("The background writer failed!") from self._error
+
+    def put(self, buf):
+        """
+        Queue the buffer *buf* to be written.
+        """
+        self._check_error()
+        if self._thread is None:
+            self._write(buf)
+            return
+        t0 = time.perf_counter()
+        self._queue.put(buf)
+        self.put_wait_time += time.perf_counter() - t0
+
+    def close(self):
+        """
+        Wait for all of the queued buffers to be written and do a final
+        flush.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check_error()
+        if self.flush_func is not None:
+            self.flush_func()
+        mylog.info(
+            "Wrote %d buffers in %g s. Waited %g s for room in the write "
+            "queue, and the writer waited %g s for buffers.",
+            self.num_written,
+            self.write_time,
+            self.put_wait_time,
+            self.get_wait_time,
+        )
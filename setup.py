@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 import os
+import subprocess
+import sysconfig
+import tempfile
 
 import numpy as np
 from setuptools import find_packages, setup
@@ -10,6 +13,32 @@ if os.name == "nt":
 else:
     std_libs = ["m"]
 
+
+def check_for_openmp():
+    # Not every compiler supports OpenMP (e.g. Apple's clang), in which
+    # case the interpolation kernels are built without it and use one thread
+    if os.name == "nt":
+        return ["/openmp"], []
+    cc = os.environ.get("CC", sysconfig.get_config_var("CC") or "cc").split()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, "test_openmp.c")
+        with open(fn, "w") as f:
+            f.write("#include <omp.h>\n")
+            f.write("int main(void) { return omp_get_max_threads() < 1; }\n")
+        try:
+            ret = subprocess.run(
+                cc + ["-fopenmp", fn, "-o", os.path.join(tmpdir, "test_openmp")],
+                capture_output=True,
+            )
+        except OSError:
+            return [], []
+    if ret.returncode != 0:
+        return [], []
+    return ["-fopenmp"], ["-fopenmp"]
+
+
+omp_compile_args, omp_link_args = check_for_openmp()
+
 cython_extensions = [
     Extension(
         "pyxsim.lib.sky_functions",
@@ -21,7 +50,7 @@ cython_extensions = [
     Extension(
         "pyxsim.lib.spectra",
         ["pyxsim/lib/spectra.pyx"],
-        language="c",
+        language="c++",
         libraries=std_libs,
         include_dirs=[np.get_include()],
     ),
@@ -31,6 +60,8 @@ cython_extensions = [
         language="c",
         libraries=std_libs,
         include_dirs=[np.get_include()],
+        extra_compile_args=omp_compile_args,
+        extra_link_args=omp_link_args,
     ),
 ]
 